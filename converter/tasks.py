@@ -16,6 +16,7 @@ import os
 import tempfile
 import logging
 import shutil
+import hashlib
 from threading import Lock
 
 from knossos import progress, util
@@ -53,7 +54,7 @@ class ChecksumTask(progress.Task):
                 path = os.path.join(base_path, str(idx) + '_' + f_name)
                 idx += 1
 
-            res = self._download(links, path, tstamp)
+            res, csum = self._download(links, path, tstamp)
 
             for i, link in reversed(list(enumerate(links))):
                 for pref in self.rem_prefixes:
@@ -67,7 +68,7 @@ class ChecksumTask(progress.Task):
                 logging.info('Inspecting "%s"...', name)
                 progress.update(0.999, 'Inspecting "%s"...' % name)
                 
-                csum, content = self._inspect_file(id_, archive, dest, path)
+                csum, content = self._inspect_file(id_, archive, dest, path, csum)
 
                 if csum != 'FAILED':
                     if self.dl_mirror is not None:
@@ -81,10 +82,11 @@ class ChecksumTask(progress.Task):
                 # None of the links worked!
                 self.post((id_, 'FAILED', None, 0))
 
+    # Returns the download's result and the file's checksum (None if it wasn't calculated).
     def _download(self, links, path, tstamp):
         from . import download
 
-        all_links = links[:]
+        all_links = util.MIRROR_STATS.sort(links)
         retries = 5
 
         # Remove all indirect links.
@@ -100,18 +102,23 @@ class ChecksumTask(progress.Task):
                     link_path = os.path.join(self.dl_path, link[len(self.dl_mirror):].lstrip('/'))
                     if os.path.isfile(link_path):
                         shutil.copyfile(link_path, path)
-                        return True
+                        return True, None
 
+                hasher = hashlib.md5()
                 with open(path, 'wb') as stream:
-                    res = util.download(link, stream, headers={'If-Modified': str(tstamp)})
+                    res = util.download(link, stream, headers={'If-Modified': str(tstamp)}, hasher=hasher)
 
-                if res == 304 or res:
-                    return res
+                if res == 304:
+                    return res, None
+                elif res:
+                    return res, hasher.hexdigest()
 
-        return False
+        return False, None
+
+    def _inspect_file(self, id_, archive, dest, path, csum=None):
+        if csum is None:
+            csum = util.gen_hash(path)
 
-    def _inspect_file(self, id_, archive, dest, path):
-        csum = util.gen_hash(path)
         content = {}
 
         if archive:
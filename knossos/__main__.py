@@ -21,6 +21,11 @@ if __package__ is None and not hasattr(sys, 'frozen'):
     path = os.path.realpath(os.path.abspath(__file__))
     sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
 
+if hasattr(sys, 'frozen'):
+    # Our process pool (see parallel.py) relaunches this executable to start its workers.
+    import multiprocessing
+    multiprocessing.freeze_support()
+
 
 if len(sys.argv) > 1 and sys.argv[1] == '--cpuinfo':
     # We don't need to initialize knossos if we only need to fetch the CPU info.
@@ -118,6 +123,7 @@ elif len(sys.argv) > 1 and sys.argv[1] == '--lib-paths':
         'sdl2': clibs.sdl._name if clibs.sdl else None,
         'openal': clibs.alc._name if clibs.alc else None
     }))
-else:
+elif __name__ == '__main__':
+    # Pool processes on Windows and Mac OS run this file as __mp_main__; they must not launch the UI.
     from knossos import launcher
     launcher.main()
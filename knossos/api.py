@@ -40,11 +40,10 @@ translate = QtCore.QCoreApplication.translate
 
 
 def save_settings():
-    center.settings['hash_cache'] = dict()
-    for path, info in util.HASH_CACHE.items():
-        # Skip deleted files
-        if os.path.exists(path):
-            center.settings['hash_cache'][path] = info
+    util.HASH_CACHE.prune()
+    util.HASH_CACHE.flush()
+
+    center.settings['mirror_stats'] = util.MIRROR_STATS.dump()
 
     for mod in center.settings['cmdlines'].copy():
         if mod != '#default' and mod not in center.installed.mods:
@@ -301,6 +300,18 @@ def check_retail_files():
         run_task(CheckTask())
 
 
+# Called by the file watcher if something changed inside the mod folders.
+def check_changed_files():
+    if center.file_watcher is None or not center.file_watcher.has_changes():
+        return
+
+    if center.pmaster.has_tasks():
+        # Most tasks run a CheckTask once they're done. If they don't, we try again later.
+        QtCore.QTimer.singleShot(5000, check_changed_files)
+    else:
+        run_task(CheckTask())
+
+
 ##############
 # Public API #
 ##############
@@ -499,6 +510,7 @@ def init_self():
     setup_ipc()
     center.signals.fs2_path_changed.connect(_read_default_cmdline)
     center.signals.fs2_path_changed.connect(check_retail_files)
+    center.signals.files_changed.connect(check_changed_files)
 
     if center.settings['update_notify'] and not center.VERSION.endswith('-dev'):
         run_task(CheckUpdateTask())
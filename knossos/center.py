@@ -36,6 +36,7 @@ LANGUAGES = {
 app = None
 main_win = None
 fs2_watcher = None
+file_watcher = None
 pmaster = None
 mods = None
 installed = None
@@ -52,8 +53,16 @@ settings = {
     'base_dirs': [],
     'pins': {},
     'cmdlines': {},
-    'hash_cache': None,
     'max_downloads': 3,
+    'download_segments': 4,
+    'max_host_downloads': 4,
+    'mirror_stats': {},
+    'process_workers': 0,
+    'io_workers': 0,
+    'cpu_workers': 0,
+    'watch_files': True,
+    'watch_interval': 30,
+    'watch_poll': False,
     'repos': [('https://fsnebula.org/repo/master.json', 'FSNebula')],
     'nebula_link': 'https://fsnebula.org/',
     'update_channel': 'stable',
@@ -90,6 +99,7 @@ class _SignalContainer(QtCore.QObject):
     repo_updated = QtCore.Signal()
     update_avail = QtCore.Signal('QVariant')
     task_launched = QtCore.Signal(QtCore.QObject)
+    files_changed = QtCore.Signal()
 
 
 signals = _SignalContainer()
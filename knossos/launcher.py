@@ -137,16 +137,26 @@ def load_settings():
             settings['repos'] = defaults['repos']
             settings['s_version'] = 4
 
+        if settings['s_version'] < 5:
+            # The checksums moved to hash_cache.sqlite. The old entries only stored the mtime which isn't enough
+            # to validate them so we just drop them.
+            if 'hash_cache' in settings:
+                del settings['hash_cache']
+
+            settings['s_version'] = 5
+
         del defaults
     else:
         # Most recent settings version
-        settings['s_version'] = 4
+        settings['s_version'] = 5
 
     if '#default' not in settings['cmdlines']:
         settings['cmdlines']['#default'] = api.read_fso_cmdline()
 
-    if settings['hash_cache'] is not None:
-        util.HASH_CACHE = settings['hash_cache']
+    util.HASH_CACHE.open(os.path.join(center.settings_path, 'hash_cache.sqlite'))
+    util.MIRROR_STATS.load(settings['mirror_stats'])
+    util.HTTP_CACHE.open(os.path.join(center.settings_path, 'http_cache'))
+    util.PARTIAL_DOWNLOADS.open(os.path.join(center.settings_path, 'downloads'))
 
     if settings['use_raven']:
         api.enable_raven()
@@ -157,7 +167,7 @@ def load_settings():
 def run_knossos():
     global app
 
-    from . import repo, progress, api, integration
+    from . import repo, progress, api, integration, parallel, watcher
     from .windows import HellWindow
 
     if sys.platform.startswith('win') and os.path.isfile('7z.exe'):
@@ -174,26 +184,44 @@ def run_knossos():
         return
 
     util.DL_POOL.set_capacity(center.settings['max_downloads'])
+    util.init_http()
+    parallel.set_workers(center.settings['process_workers'])
 
     center.app = app
     center.installed = repo.InstalledRepo()
     center.installed.pins = center.settings['pins']
     center.pmaster = progress.Master()
-    center.pmaster.start_workers(10)
+    center.pmaster.set_pool_size(progress.RESOURCE_IO, center.settings['io_workers'])
+    center.pmaster.set_pool_size(progress.RESOURCE_CPU, center.settings['cpu_workers'])
+    center.pmaster.start_workers()
     center.mods = repo.Repo()
 
+    if center.settings['watch_files']:
+        # CheckTask tells the watcher which folders to watch.
+        center.file_watcher = watcher.Watcher(center.settings['watch_interval'], center.settings['watch_poll'])
+
     integration.init()
     api.check_retail_files()
+    # The snapshot is a lot faster to load. mods.json contains the same mod list and is only used if the snapshot
+    # can't be read (i.e. after a Python update).
     mod_db = os.path.join(center.settings_path, 'mods.json')
-    if os.path.isfile(mod_db):
+    if not center.mods.load_snapshot(os.path.join(center.settings_path, 'mods.snap')) and os.path.isfile(mod_db):
         center.mods.load_json(mod_db)
 
+    center.installed.load_snapshot(os.path.join(center.settings_path, 'installed.snap'))
+
     center.main_win = HellWindow()
     center.main_win.open()
     app.exec_()
 
     api.save_settings()
     api.shutdown_ipc()
+    parallel.shutdown()
+
+    if center.file_watcher:
+        center.file_watcher.stop()
+
+    util.HASH_CACHE.close()
 
 
 def handle_ipc_error():
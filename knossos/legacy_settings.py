@@ -241,6 +241,7 @@ class SettingsWindow(Window):
 
         if num != old_num:
             util.DL_POOL.set_capacity(num)
+            util.init_http()
             api.save_settings()
 
     def get_ratio(self, w, h):
@@ -801,7 +802,7 @@ class SettingsWindow(Window):
         LogViewer(launcher.log_path)
 
     def clear_hash_cache(self):
-        util.HASH_CACHE = dict()
-        run_task(CheckTask())
+        util.HASH_CACHE.clear()
+        run_task(CheckTask(deep=True))
         QtWidgets.QMessageBox.information(None, 'Knossos', self.tr('Done!'))
 
@@ -0,0 +1,268 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+# NOTE: The pool processes import this module on Windows and Mac OS (they can't fork) so keep
+# its imports limited to the standard library. Pulling in Qt here would make every worker load it.
+
+import os
+import json
+import logging
+import hashlib
+import itertools
+import threading
+import multiprocessing
+
+HASH_CHUNK = 64 * 1024
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+# Progress reports from the pool processes: (job ID, progress, text)
+_progress_queue = None
+_progress_thread = None
+# job ID -> latest (progress, text) for every job started with run()
+_job_progress = {}
+_job_lock = threading.Lock()
+_job_ids = itertools.count(1)
+
+# Only set inside pool processes
+_worker_queue = None
+_worker_job = None
+# Used by report() if run() falls back to the current thread
+_local = threading.local()
+
+
+class JobAborted(Exception):
+    pass
+
+
+def get_worker_count():
+    if _pool_size > 0:
+        return _pool_size
+
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
+
+
+# 0 means one process per CPU core. The new size is used the next time the pool is started.
+def set_workers(num):
+    global _pool_size
+
+    _pool_size = max(int(num), 0)
+
+
+def _init_worker(queue):
+    global _worker_queue
+
+    _worker_queue = queue
+
+
+def _relay_progress(queue):
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+
+        with _job_lock:
+            if item[0] in _job_progress:
+                _job_progress[item[0]] = item[1:]
+
+
+# The pool is started once the UI, the HTTP sessions and the file watcher are running. A fork() at that point copies
+# every lock held by one of those threads (logging, sqlite, connection pools, ...) and the child could deadlock on them
+# so we always start fresh processes. Python 2 only supports fork() on Linux and Mac OS.
+def get_context():
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn')
+    else:
+        return multiprocessing
+
+
+def get_pool():
+    global _pool, _progress_queue, _progress_thread
+
+    with _pool_lock:
+        if _pool is None:
+            size = get_worker_count()
+            logging.debug('Starting a process pool with %d workers...', size)
+
+            ctx = get_context()
+            _progress_queue = ctx.Queue()
+            _pool = ctx.Pool(size, _init_worker, (_progress_queue,))
+
+            _progress_thread = threading.Thread(target=_relay_progress, args=(_progress_queue,),
+                                                name='ProcessProgress')
+            _progress_thread.daemon = True
+            _progress_thread.start()
+
+        return _pool
+
+
+def shutdown():
+    global _pool, _progress_queue, _progress_thread
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+
+            _progress_queue.put(None)
+            _progress_thread.join()
+            _progress_queue = None
+            _progress_thread = None
+
+
+# Runs func on every item in the process pool and yields the results in order.
+# If the pool can't be used (i.e. we're already inside a pool process) the items are processed right here.
+def imap(func, items, chunksize=1):
+    if multiprocessing.current_process().daemon:
+        return iter(map(func, items))
+
+    try:
+        pool = get_pool()
+    except:
+        logging.exception('Failed to start the process pool! Falling back to the current thread.')
+        return iter(map(func, items))
+
+    return pool.imap(func, items, chunksize)
+
+
+# Reports the progress of the current job. Only works inside functions called by run().
+def report(prog, text=''):
+    callback = getattr(_local, 'callback', None)
+    if callback is not None:
+        callback(prog, text)
+    elif _worker_queue is not None and _worker_job is not None:
+        _worker_queue.put((_worker_job, prog, text))
+
+
+def _run_job(job):
+    global _worker_job
+
+    _worker_job, func, args = job
+    try:
+        return func(*args)
+    finally:
+        _worker_job = None
+
+
+# Runs func(*args) in the process pool and returns the result. func, args and the result have to be picklable
+# (func has to be a module level function). The calling thread waits for the result and passes the progress which
+# func reports with report() on to the progress callback.
+# abort is an optional function. If it returns True while we're waiting, JobAborted is raised. The pool process
+# finishes the job anyway but its result is thrown away.
+def run(func, args=(), progress=None, abort=None, interval=0.1):
+    if multiprocessing.current_process().daemon:
+        pool = None
+    else:
+        try:
+            pool = get_pool()
+        except:
+            logging.exception('Failed to start the process pool! Falling back to the current thread.')
+            pool = None
+
+    if pool is None:
+        _local.callback = progress
+        try:
+            return func(*args)
+        finally:
+            _local.callback = None
+
+    job_id = next(_job_ids)
+    last = None
+
+    with _job_lock:
+        _job_progress[job_id] = None
+
+    try:
+        result = pool.apply_async(_run_job, ((job_id, func, args),))
+
+        while True:
+            result.wait(interval)
+
+            if progress is not None:
+                with _job_lock:
+                    info = _job_progress[job_id]
+
+                if info is not None and info != last:
+                    last = info
+                    progress(*info)
+
+            if result.ready():
+                return result.get()
+
+            if abort is not None and abort():
+                raise JobAborted()
+    finally:
+        with _job_lock:
+            del _job_progress[job_id]
+
+
+# Decodes a repository file. Returns the decoded data and a list with the stamp (see Repo.get_stamps()) of every mod.
+# This is the expensive part of Repo.parse() so it's a good candidate for run().
+# If lazy is True, the packages' file lists are encoded again as compact JSON strings (see Package._lazy). The file
+# lists make up most of a repository and sending them back from the process pool as strings is much cheaper than
+# pickling (and unpickling) all those dicts. They also aren't decoded in the UI process until they're needed.
+def decode_repo(text, lazy=False):
+    data = json.loads(text)
+    stamps = []
+
+    for values in data.get('mods', []):
+        stamps.append(hashlib.md5(json.dumps(values, sort_keys=True).encode('utf8')).hexdigest())
+
+        if lazy:
+            for pkg in values.get('packages', []):
+                pkg['_lazy'] = json.dumps({
+                    'files': pkg.pop('files', []),
+                    'filelist': pkg.pop('filelist', [])
+                }, separators=(',', ':'))
+
+    return data, stamps
+
+
+# Files are considered unchanged as long as this key stays the same.
+def stat_key(info):
+    mtime = getattr(info, 'st_mtime_ns', None)
+    if mtime is None:
+        # Python 2 doesn't have st_mtime_ns.
+        mtime = int(info.st_mtime * 1000000000)
+
+    return info.st_size, mtime, info.st_ino
+
+
+def hash_file(job):
+    path, algo = job
+
+    try:
+        info = os.stat(path)
+        h = hashlib.new(algo)
+
+        with open(path, 'rb') as stream:
+            while True:
+                chunk = stream.read(HASH_CHUNK)
+                if not chunk:
+                    break
+
+                h.update(chunk)
+    except (IOError, OSError):
+        logging.exception('Failed to hash "%s"!', path)
+        return path, None, None
+
+    return path, h.hexdigest(), stat_key(info)
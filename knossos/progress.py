@@ -15,13 +15,18 @@
 from __future__ import absolute_import, print_function
 
 import sys
+import time
 import logging
 import threading
+import multiprocessing
 import six
+from collections import deque
 
 from . import uhf
 uhf(__name__)
 
+from . import parallel
+
 from .qt import QtCore
 
 try:
@@ -34,6 +39,16 @@ if six.PY2:
 
 _progress = threading.local()
 
+# Workers always pick work from the tasks with the highest priority. Tasks with the same priority take turns.
+PRIORITY_BACKGROUND = -10
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 10
+
+# Every resource class has its own worker pool (see Master). Tasks which mostly wait for the network use RESOURCE_IO,
+# tasks which keep the CPU or the disk busy (hashing, extraction) use RESOURCE_CPU.
+RESOURCE_IO = 'io'
+RESOURCE_CPU = 'cpu'
+
 
 def reset():
     global _progress
@@ -93,17 +108,19 @@ def update(prog, text=''):
 
 # Task scheduler
 class Worker(threading.Thread):
+    pool = None
 
-    def __init__(self, master):
+    def __init__(self, master, pool):
         super(Worker, self).__init__()
 
         self._master = master
+        self.pool = pool
         self.daemon = True
         self.start()
 
     def run(self):
         while True:
-            task = self._master._get_work()
+            task = self._master._get_work(self)
             if task is None:
                 return
 
@@ -120,50 +137,151 @@ class Worker(threading.Thread):
             task[0]._deinit()
 
 
+def get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
+
+
+# Returns the number of workers we use for a resource class if the user didn't choose one.
+def get_default_workers(resource):
+    cpus = get_cpu_count()
+
+    if resource == RESOURCE_CPU:
+        # More threads than cores would only fight over the GIL and the disk.
+        return max(cpus, 2)
+    else:
+        # These mostly wait for the network.
+        return min(cpus + 4, 32)
+
+
+# The workers of one resource class. The pool starts with min_workers and grows up to max_workers while there's more
+# queued work than idle workers. Workers which stay idle for idle_timeout seconds quit until only min_workers are left.
+class WorkerPool(object):
+    resource = None
+    min_workers = 1
+    max_workers = 1
+    idle_timeout = 30
+    _master = None
+    _workers = None
+    _busy = 0
+    _cond = None
+
+    def __init__(self, master, resource, max_workers):
+        self._master = master
+        self.resource = resource
+        self.max_workers = max_workers
+        self._workers = []
+        # All conditions share the task list's lock. That way a worker can't miss a notification between looking
+        # for work and going to sleep.
+        self._cond = threading.Condition(master._tasks_lock)
+
+    # Has to be called with the task lock held.
+    def _spawn(self, num):
+        for n in range(num):
+            # New workers count as busy until they ask for work.
+            self._busy += 1
+            self._workers.append(Worker(self._master, self))
+
+
 class Master(object):
     _tasks = None
     _tasks_lock = None
-    _workers = None
+    _pools = None
     _stop_workers = False
-    _worker_cond = None
 
     def __init__(self):
         self._tasks = []
         self._tasks_lock = threading.Lock()
-        self._workers = []
-        self._worker_cond = threading.Condition()
+        self._pools = {}
+
+        for resource in (RESOURCE_IO, RESOURCE_CPU):
+            self._pools[resource] = WorkerPool(self, resource, get_default_workers(resource))
 
-    def start_workers(self, num):
-        for n in range(0, num):
-            self._workers.append(Worker(self))
+    # Sets the maximum number of workers for a resource class. 0 picks a number based on the CPU count.
+    def set_pool_size(self, resource, num):
+        num = max(int(num), 0)
+
+        with self._tasks_lock:
+            pool = self._pools[resource]
+            pool.max_workers = num or get_default_workers(resource)
+
+            # Wake everyone up so surplus workers can quit.
+            pool._cond.notify_all()
+
+    def get_pool_size(self, resource):
+        return self._pools[resource].max_workers
+
+    # Starts the minimum number of workers for every pool. The pools grow on their own once there's work to do.
+    # If num is set, no pool will use more than num workers.
+    def start_workers(self, num=None):
+        with self._tasks_lock:
+            for pool in self._pools.values():
+                if num is not None:
+                    pool.max_workers = num
+
+                pool._spawn(pool.min_workers - len(pool._workers))
 
     def stop_workers(self):
         self._stop_workers = True
 
-        with self._worker_cond:
-            self._worker_cond.notify_all()
+        workers = []
+        with self._tasks_lock:
+            for pool in self._pools.values():
+                pool._cond.notify_all()
+                workers.extend(pool._workers)
 
-        for w in self._workers:
+        for w in workers:
             w.join()
 
         self._stop_workers = False
-        self._workers = []
         self._tasks = []
 
-    def _get_work(self):
-        while True:
-            if self._stop_workers:
-                return None
+    def _get_work(self, worker):
+        pool = worker.pool
+
+        with self._tasks_lock:
+            pool._busy -= 1
+            idle_since = time.time()
+
+            while True:
+                if self._stop_workers or len(pool._workers) > pool.max_workers:
+                    pool._workers.remove(worker)
+                    return None
+
+                # sorted() is stable so tasks with the same priority stay in round-robin order.
+                for task in sorted(self._tasks, key=lambda t: -t.priority):
+                    if task.resource != pool.resource:
+                        continue
 
-            with self._tasks_lock:
-                for task in self._tasks:
                     work = task._get_work()
                     if work is not None:
+                        # Move this task to the end of the line so the next worker prefers another task
+                        # with the same priority.
+                        self._tasks.remove(task)
+                        self._tasks.append(task)
+
+                        pool._busy += 1
+                        self._balance(pool)
                         return work
 
-            # No work here... let's wait for more.
-            with self._worker_cond:
-                self._worker_cond.wait()
+                if len(pool._workers) > pool.min_workers and time.time() - idle_since >= pool.idle_timeout:
+                    pool._workers.remove(worker)
+                    return None
+
+                # No work here... let's wait for more.
+                pool._cond.wait(pool.idle_timeout)
+
+    # Starts more workers if the pool has more queued work than idle workers. Has to be called with the task lock held.
+    def _balance(self, pool):
+        depth = 0
+        for task in self._tasks:
+            if task.resource == pool.resource:
+                depth += task._get_demand()
+
+        idle = len(pool._workers) - pool._busy
+        pool._spawn(min(depth - idle, pool.max_workers - len(pool._workers)))
 
     def add_task(self, task):
         if not task._has_work():
@@ -179,10 +297,15 @@ class Master(object):
             task._master = self
             task._attached = True
 
+            pool = self._pools[task.resource]
+            self._balance(pool)
+            pool._cond.notify_all()
+
         task.done.connect(self.check_tasks)
 
-        with self._worker_cond:
-            self._worker_cond.notify_all()
+    def has_tasks(self):
+        with self._tasks_lock:
+            return len(self._tasks) > 0
 
     def check_tasks(self):
         with self._tasks_lock:
@@ -191,9 +314,19 @@ class Master(object):
                     self._tasks.remove(task)
                     task._attached = False
 
-    def wake_workers(self):
-        with self._worker_cond:
-            self._worker_cond.notify_all()
+    # Wakes up count workers (or all of them if count is None) of the given resource class (or all classes).
+    def wake_workers(self, count=None, resource=None):
+        with self._tasks_lock:
+            for pool in self._pools.values():
+                if resource is not None and pool.resource != resource:
+                    continue
+
+                self._balance(pool)
+
+                if count is None:
+                    pool._cond.notify_all()
+                else:
+                    pool._cond.notify(count)
 
 
 class Task(QtCore.QObject):
@@ -210,7 +343,17 @@ class Task(QtCore.QObject):
     _running = 0
     _pending = 0
     _threads = 0
+    _last_emit = 0
+    _emit_pending = False
+    _flush_timer = None
+    # Work loops can report their progress for every single file. We only pass it on to the UI this often
+    # (in seconds), everything in between just updates the stored values.
+    progress_interval = 1.0 / 15
     background = False
+    # Defaults to PRIORITY_BACKGROUND for background tasks and PRIORITY_NORMAL for everything else.
+    priority = None
+    # Multistep tasks can change this between steps.
+    resource = RESOURCE_IO
     can_abort = True
     aborted = False
     title = None
@@ -224,8 +367,11 @@ class Task(QtCore.QObject):
         if work is None:
             work = []
 
+        if self.priority is None:
+            self.priority = PRIORITY_BACKGROUND if self.background else PRIORITY_NORMAL
+
         self._results = []
-        self._work = work
+        self._work = deque(work)
         self._work_count = len(work)
         self._result_lock = threading.Lock()
         self._work_lock = threading.Lock()
@@ -243,18 +389,30 @@ class Task(QtCore.QObject):
                 return None
             else:
                 self._pending += 1
-                return (self, (self._work.pop(0),))
+                return (self, (self._work.popleft(),))
 
     def _has_work(self):
         with self._work_lock:
             return len(self._work) > 0
 
+    # Returns the number of workers which could start working on this task right now (see Master._balance()).
+    def _get_demand(self):
+        with self._work_lock:
+            queued = len(self._work)
+            if self._threads > 0:
+                queued = min(queued, max(self._threads - self._pending, 0))
+
+            return queued
+
     def _init(self):
         with self._progress_lock:
             self._progress[threading.get_ident()] = (0, 'Ready')
             self._running += 1
 
     def _deinit(self):
+        # Make sure the UI sees the last progress we skipped before this thread's entry is reset.
+        self._flush_progress()
+
         with self._progress_lock:
             with self._work_lock:
                 self._pending -= 1
@@ -267,25 +425,66 @@ class Task(QtCore.QObject):
                 self.done.emit()
 
     def _track_progress(self, prog, text):
+        now = time.time()
+
         with self._progress_lock:
             self._progress[threading.get_ident()] = (prog, text)
 
+            if now - self._last_emit < self.progress_interval:
+                self._emit_pending = True
+
+                if self._flush_timer is None:
+                    # Emit the latest value once the interval is over even if no further updates arrive.
+                    self._flush_timer = threading.Timer(self.progress_interval - (now - self._last_emit),
+                                                        self._flush_progress)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+
+                return
+
+            self._last_emit = now
+            self._emit_pending = False
+
+        self.progress.emit(self.get_progress())
+
+    # Emits the progress if the last update was skipped by _track_progress().
+    def _flush_progress(self):
+        with self._progress_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            if not self._emit_pending:
+                return
+
+            self._last_emit = time.time()
+            self._emit_pending = False
+
         self.progress.emit(self.get_progress())
 
+    # Runs func(*args) in the process pool and returns its result. Use this in work methods (or single steps of
+    # a MultistepTask) which would otherwise keep the CPU busy while holding the GIL. See parallel.run() for the
+    # restrictions on func. Progress reported with parallel.report() shows up as this task's progress and
+    # parallel.JobAborted is raised if the task is aborted in the meantime.
+    def run_in_process(self, func, *args):
+        return parallel.run(func, args, progress=update, abort=lambda: self.aborted)
+
     def post(self, result):
         with self._result_lock:
             self._results.append(result)
 
     def add_work(self, work):
         with self._work_lock:
+            count = len(self._work)
             self._work.extend(work)
+            count = len(self._work) - count
             self._work_count = max(self._work_count, len(self._work))
 
         if self._master is not None:
             if not self._attached:
                 self._master.add_task(self)
-            else:
-                self._master.wake_workers()
+            elif count > 0:
+                self._master.wake_workers(count, self.resource)
 
     def abort(self):
         if not self.can_abort:
@@ -294,7 +493,7 @@ class Task(QtCore.QObject):
         # Empty the work queue, this won't stop running workers but it will
         # stop calls to the work() method.
         with self._work_lock:
-            self._work = []
+            self._work = deque()
             self.aborted = True
 
         self._master.check_tasks()
@@ -370,7 +569,15 @@ class MultistepTask(Task):
                     return None
             else:
                 self._pending += 1
-                return (self, (self._work.pop(0),))
+                return (self, (self._work.popleft(),))
+
+    def _get_demand(self):
+        with self._work_lock:
+            if (len(self._work) == 0 or self._cur_step < 0) and not self._sdone and not self.aborted:
+                # _get_work() would hand out the step key.
+                return 1 if self._pending == 0 and self._running == 0 else 0
+
+        return super(MultistepTask, self)._get_demand()
 
     def work(self, arg):
         # Any better ideas for this magic key?
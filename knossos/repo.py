@@ -21,17 +21,48 @@ import json
 import re
 import shutil
 import hashlib
+import threading
 import semantic_version
+from collections import deque
 import six
+from six.moves import intern
 from datetime import datetime
 
 from . import uhf
 uhf(__name__)
 
-from . import center, util
+from . import center, util, snapshot, parallel
 
 # You have to fill this using https://github.com/workhorsy/py-cpuinfo .
 CPU_INFO = None
+# Guards Package._lazy. Packages are shared between the UI and the worker threads.
+_LAZY_LOCK = threading.Lock()
+
+
+# Strings like mod IDs and archive names are repeated a lot in large repositories. Interning them
+# makes all copies share the same object.
+def _intern(value):
+    try:
+        return intern(value)
+    except TypeError:
+        # Python 2 can only intern byte strings.
+        return value
+
+
+# mvs has to be sorted from the newest to the oldest version. Returns the position of the first mod
+# which isn't newer than version.
+def _find_version(mvs, version):
+    lo = 0
+    hi = len(mvs)
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mvs[mid].version > version:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo
 
 
 class ModNotFound(Exception):
@@ -54,12 +85,118 @@ class PackageNotFound(ModNotFound):
         self.package = package
 
 
+# Fetches the includes of a repository in parallel. Every link is only requested once even if several
+# repositories include it and repositories which were already parsed are shared.
+class IncludeLoader(object):
+    # The maximum number of concurrent requests
+    max_requests = 4
+    reuse = None
+    # Optional function which is used instead of parallel.decode_repo() to decode the includes (i.e. to run it in
+    # the process pool).
+    decode = None
+    _slots = None
+    _lock = None
+    _texts = None
+    _repos = None
+
+    def __init__(self, reuse=None):
+        self.reuse = reuse
+        self._slots = threading.Semaphore(self.max_requests)
+        self._lock = threading.Lock()
+        self._texts = {}
+        self._repos = {}
+
+    # Returns the result of util.get_cached() for link.
+    def get_text(self, link):
+        with self._lock:
+            entry = self._texts.get(link)
+            owner = entry is None
+
+            if owner:
+                entry = self._texts[link] = [threading.Event(), None]
+
+        if owner:
+            try:
+                # Only the request itself is limited. Holding a slot while waiting for nested includes could deadlock.
+                # The host's limit applies as well (see util.get_host_slots()).
+                with self._slots, util.get_host_slots(link):
+                    entry[1] = util.get_cached(link)
+            finally:
+                entry[0].set()
+        else:
+            entry[0].wait()
+
+        return entry[1]
+
+    # parents contains the links of all repositories which (indirectly) include link.
+    def load(self, link, parents):
+        if link in parents:
+            logging.error('The repository "%s" includes itself (through "%s")! Ignoring it.', link, parents[-1])
+            return None
+
+        with self._lock:
+            item = self._repos.get(link)
+
+        if item is None:
+            item = Repo()
+            item.fetch(link, self.reuse, self, parents)
+
+            with self._lock:
+                item = self._repos.setdefault(link, item)
+
+        return item
+
+    # Calls func for every item and returns the results in the same order as items. At most max_requests threads
+    # are started. Nested calls (includes of includes) get their own threads since waiting for a shared pool from
+    # inside it could deadlock.
+    def map(self, func, items):
+        results = [None] * len(items)
+        queue = deque(enumerate(items))
+
+        def worker():
+            while True:
+                try:
+                    i, item = queue.popleft()
+                except IndexError:
+                    return
+
+                try:
+                    results[i] = func(item)
+                except parallel.JobAborted:
+                    pass
+                except:
+                    logging.exception('Failed to load "%s"!', item)
+
+        count = min(self.max_requests, len(items))
+        if count <= 1:
+            worker()
+        else:
+            threads = []
+            for i in range(count):
+                t = threading.Thread(target=worker)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+            for t in threads:
+                t.join()
+
+        return results
+
+
 class Repo(object):
     base = None
     is_link = False
     mods = None
     includes = None
     pins = None
+    # The links this repo was built from (its own and those of all includes).
+    sources = None
+    # What FetchTask got from each repository link the last time (see get_fetched()). Stored in the snapshot so the
+    # repositories don't have to be parsed again after a restart.
+    fetched = None
+    # Incremented whenever mods are added or removed. Used to invalidate caches (see resolver.py).
+    generation = 0
 
     def __init__(self, data=None):
         self.mods = {}
@@ -74,6 +211,7 @@ class Repo(object):
     def clear(self):
         self.mods = {}
         self.pins = {}
+        self.generation += 1
 
     def load_json(self, path):
         self.base = os.path.dirname(path)
@@ -82,20 +220,80 @@ class Repo(object):
 
     def save_json(self, path):
         with open(path, 'w') as stream:
-            json.dump(self.get(), stream)
+            # Lazy file lists loaded from a snapshot are Blobs which contain JSON.
+            json.dump(self.get(lazy=True), stream, default=lambda blob: blob.get_text())
+
+    # Snapshots (see snapshot.py) are much faster to load than JSON but can only be read by the same Python version.
+    def save_snapshot(self, path):
+        data = self.get(lazy=True)
+        data['fetched'] = self.fetched or {}
+
+        # The stamps are needed to reuse the mods (see get_fetched()).
+        mods = [mod for mvs in self.mods.values() for mod in mvs]
+        for info, mod in zip(data['mods'], mods):
+            info['_stamp'] = mod._stamp
+
+        self._write_snapshot(path, data)
+
+    # Returns False if the snapshot couldn't be loaded. Use load_json() in that case.
+    def load_snapshot(self, path):
+        data = self._read_snapshot(path)
+        if data is None:
+            return False
+
+        self.base = os.path.dirname(path)
+        self.set(data)
+        self.fetched = data.get('fetched')
+
+        stamps = dict(((info['id'], info['version']), info.get('_stamp')) for info in data['mods'])
+        for mvs in self.mods.values():
+            for mod in mvs:
+                stamp = stamps.get((mod.mid, str(mod.version)))
+                if stamp is not None:
+                    mod._stamp = tuple(stamp)
+
+        return True
+
+    def _write_snapshot(self, path, data):
+        blobs = []
+        for mod in data['mods']:
+            for pkg in mod['packages']:
+                lazy = pkg.pop('_lazy')
+                if isinstance(lazy, snapshot.Blob):
+                    lazy = lazy.get_bytes()
+                else:
+                    lazy = lazy.encode('utf8')
+
+                pkg['_blob'] = len(blobs)
+                blobs.append(lazy)
+
+        snapshot.save(path, data, blobs)
+
+    def _read_snapshot(self, path):
+        res = snapshot.load(path)
+        if res is None:
+            return None
+
+        data, blobs = res
+        for mod in data['mods']:
+            for pkg in mod['packages']:
+                pkg['_lazy'] = blobs[pkg.pop('_blob')]
+
+        return data
 
     def set(self, info):
         for m, v in info['pins'].items():
-            self.pins[m] = semantic_version.Version(v)
+            self.pins[m] = util.get_version(v)
 
         for mod in info['mods']:
             self.add_mod(Mod(mod, self))
 
-    def get(self):
+    # If lazy is True, the packages' file lists are stored in their compact form (see Package.get()).
+    def get(self, lazy=False):
         mods = []
         for v in self.mods.values():
             for mod in v:
-                mods.append(mod.get())
+                mods.append(mod.get(lazy))
 
         pins = self.pins.copy()
         for m, v in pins.items():
@@ -106,10 +304,39 @@ class Repo(object):
             'mods': mods
         }
 
-    def fetch(self, link):
+    def fetch(self, link, reuse=None, loader=None, parents=()):
         self.base = os.path.dirname(link)
         self.is_link = True
-        self.parse(util.get(link))
+        self.sources = [link]
+
+        if loader is None:
+            res = util.get_cached(link)
+        else:
+            res = loader.get_text(link)
+
+        if res is not None:
+            if loader is not None and loader.decode is not None:
+                self.parse(loader.decode(res[1]), reuse, loader, parents)
+            else:
+                self.parse(res[1], reuse, loader, parents)
+
+    # Returns True if any of the links this repo was built from changed since it was fetched.
+    # Pass the IncludeLoader you're going to use for fetching the repo again. It keeps the responses so the changed
+    # links don't have to be requested a second time.
+    def is_outdated(self, loader=None):
+        if not self.sources:
+            return True
+
+        if loader is None:
+            loader = IncludeLoader()
+
+        links = []
+        for link in self.sources:
+            if link not in links:
+                links.append(link)
+
+        results = loader.map(loader.get_text, links)
+        return any(res is None or res[2] for res in results)
 
     def read(self, path):
         self.base = os.path.dirname(path)
@@ -117,29 +344,90 @@ class Repo(object):
         self.parse(h)
         h.close()
 
-    def parse(self, obj):
+    # obj can be a string, a file or the result of parallel.decode_repo().
+    # reuse can be a dict returned by get_stamps(). Mods which are still the same are taken from it instead of
+    # being parsed again.
+    # parents is only used for links. It contains the links of all repositories which include this one.
+    def parse(self, obj, reuse=None, loader=None, parents=()):
         if not obj:
             return
 
-        if isinstance(obj, six.string_types):
-            data = json.loads(obj)
+        if isinstance(obj, tuple):
+            data, stamps = obj
+        elif isinstance(obj, six.string_types):
+            data, stamps = parallel.decode_repo(obj)
         else:
-            data = json.load(obj)
+            data, stamps = parallel.decode_repo(obj.read())
 
         self.mods = {}
         self.includes = data.get('includes', [])
+        self.generation += 1
 
-        for inc in self.includes:
-            item = Repo()
-            if self.is_link:
-                item.fetch(util.url_join(self.base, inc))
-            else:
+        if self.is_link:
+            if self.sources is None:
+                self.sources = []
+
+            if loader is None:
+                loader = IncludeLoader(reuse)
+
+            parents = parents + tuple(self.sources[:1])
+            links = [util.url_join(self.base, inc) for inc in self.includes]
+
+            # The includes are fetched in parallel but merged in order since later mods overwrite earlier ones.
+            for item in loader.map(lambda link: loader.load(link, parents), links):
+                if item is not None:
+                    self.sources.extend(item.sources)
+                    self.merge(item)
+        else:
+            for inc in self.includes:
+                item = Repo()
                 item.read(os.path.join(self.base, inc))
+                self.merge(item)
 
-            self.merge(item)
+        for values, stamp in zip(data.get('mods', []), stamps):
+            # Relative URLs (logos, ...) are resolved against our base so a mod can only be reused if that's the same.
+            stamp = (self.base, stamp)
+            mod = reuse.get(stamp) if reuse else None
 
-        for mod in data.get('mods', []):
-            self.add_mod(Mod(mod, self))
+            if mod is None:
+                mod = Mod(values, self)
+                mod._stamp = stamp
+
+            self.add_mod(mod)
+
+    # Returns all mods which were parsed from a repository file keyed by their base and a hash of their JSON data.
+    def get_stamps(self):
+        stamps = {}
+        for mvs in self.mods.values():
+            for mod in mvs:
+                if mod._stamp is not None:
+                    stamps[mod._stamp] = mod
+
+        return stamps
+
+    # Returns a repo with copies of the mods FetchTask got from link the last time (see FetchTask.work()) or None if
+    # they're unknown. The result's sources are the links it was built from.
+    def get_fetched(self, link):
+        info = (self.fetched or {}).get(link)
+        if info is None:
+            return None
+
+        stamps = self.get_stamps()
+        result = Repo()
+        result.is_link = True
+        result.base = os.path.dirname(link)
+        result.sources = [src for src, chksum in info['sources']]
+
+        for stamp in info['stamps']:
+            mod = stamps.get(tuple(stamp))
+            if mod is None:
+                # Another repository overwrote this mod.
+                return None
+
+            # add_mod() would take the mod away from this repo.
+            result.add_mod(mod.clone(result))
+
+        return result
 
     def add_mod(self, mod):
         mid = mod.mid
@@ -148,25 +436,22 @@ class Repo(object):
             logging.warning('Mod %s is empty, ignoring it!', mod)
             return
 
-        if mid in self.mods:
-            inserted = False
-
-            for i, item in enumerate(self.mods[mid]):
-                if item.version == mod.version:
-                    if mod._repo is None:
-                        mod_base = 'None'
-                    else:
-                        mod_base = mod._repo.base
+        self.generation += 1
 
-                    logging.info('Mod "%s" (%s) from "%s" overwrites an existing mod version!', mid, mod.version, mod_base)
+        if mid in self.mods:
+            mvs = self.mods[mid]
+            i = _find_version(mvs, mod.version)
 
-                    self.mods[mid][i] = mod
-                    inserted = True
-                    break
+            if i < len(mvs) and mvs[i].version == mod.version:
+                if mod._repo is None:
+                    mod_base = 'None'
+                else:
+                    mod_base = mod._repo.base
 
-            if not inserted:
-                self.mods[mid].append(mod)
-                self.mods[mid].sort(key=lambda m: m.version, reverse=True)
+                logging.info('Mod "%s" (%s) from "%s" overwrites an existing mod version!', mid, mod.version, mod_base)
+                mvs[i] = mod
+            else:
+                mvs.insert(i, mod)
         else:
             self.mods[mid] = [mod]
 
@@ -178,16 +463,14 @@ class Repo(object):
         if mid not in self.mods:
             raise ModNotFound('Mod "%s" (%s) could not be removed from %s!' % (mid, mod.version, self.base))
 
-        idx = None
-        for i, item in enumerate(self.mods[mid]):
-            if item.version == mod.version:
-                idx = i
-                break
+        mvs = self.mods[mid]
+        idx = _find_version(mvs, mod.version)
 
-        if not idx:
+        if idx >= len(mvs) or mvs[idx].version != mod.version:
             raise ModNotFound('Mod "%s" (%s) could not be removed from %s because the exact version was missing!' % (mid, mod.version, self.base))
 
         del self.mods[mid][idx]
+        self.generation += 1
 
         if len(self.mods[mid]) == 0:
             del self.mods[mid]
@@ -197,6 +480,47 @@ class Repo(object):
             for mod in mvs:
                 self.add_mod(mod)
 
+    # Makes this repo contain the same mods as other. Mod objects which are in both repos are kept which means that
+    # only the actual changes are applied. Returns the number of added, changed and removed mod versions.
+    # If copy is True, the mods from other are copied (see Mod.clone()) before they're added. Use this if other's
+    # mods are still used elsewhere (i.e. by the repos FetchTask reuses) since they'd belong to this repo afterwards.
+    # Mods with the same stamp (see get_stamps()) are treated as unchanged in that case.
+    def update(self, other, copy=False):
+        added = changed = removed = 0
+        self.generation += 1
+
+        for mid in list(self.mods.keys()):
+            if mid not in other.mods:
+                removed += len(self.mods[mid])
+                del self.mods[mid]
+
+        for mid, mvs in other.mods.items():
+            old = dict((mod.version, mod) for mod in self.mods.get(mid, []))
+            new_mvs = []
+
+            for mod in mvs:
+                prev = old.pop(mod.version, None)
+                if prev is mod or (copy and prev is not None and prev._stamp is not None and
+                                   prev._stamp == mod._stamp):
+                    new_mvs.append(prev)
+                    continue
+                elif prev is None:
+                    added += 1
+                else:
+                    changed += 1
+
+                if copy:
+                    mod = mod.clone(self)
+                else:
+                    mod._repo = self
+
+                new_mvs.append(mod)
+
+            removed += len(old)
+            self.mods[mid] = new_mvs
+
+        return added, changed, removed
+
     def pin(self, mod, version=None):
         if isinstance(mod, Package):
             mod = mod.get_mod()
@@ -254,14 +578,21 @@ class Repo(object):
                 logging.warning('Repo.query(): Expected Spec but got Version instead! (%s)' % repr(spec))
                 spec = util.Spec.from_version(spec)
 
-            version = spec.select([mod.version for mod in candidates])
-            if not version:
-                raise ModNotFound('Mod "%s" %s wasn\'t found!' % (mid, spec), mid, spec)
-
-            for m in candidates:
-                if m.version == version:
-                    mod = m
-                    break
+            mod = None
+            if len(spec.specs) == 1 and spec.specs[0].kind == '==':
+                # Exact versions (the most common case) can be looked up directly.
+                i = _find_version(candidates, spec.specs[0].spec)
+                if i < len(candidates) and spec.match(candidates[i].version):
+                    mod = candidates[i]
+
+            if mod is None:
+                # The candidates are sorted so the first match is the latest matching version.
+                for m in candidates:
+                    if spec.match(m.version):
+                        mod = m
+                        break
+                else:
+                    raise ModNotFound('Mod "%s" %s wasn\'t found!' % (mid, spec), mid, spec)
 
         if pname is not None:
             for pkg in mod.packages:
@@ -295,60 +626,17 @@ class Repo(object):
         for mod in self.mods.values():
             yield mod[0]
 
-    # TODO: Is this overcomplicated?
+    # Returns the given packages together with all their (indirect) dependencies. See resolver.Resolver.
     def process_pkg_selection(self, pkgs):
-        dep_dict = {}
-        ndeps = pkgs
-
-        # Resolve the pkgs' dependencies
-        while len(ndeps) > 0:
-            _nd = ndeps
-            ndeps = []
-
-            for pkg in _nd:
-                for dep, version in pkg.resolve_deps():
-                    mid = dep.get_mod().mid
-
-                    if mid not in dep_dict:
-                        dep_dict[mid] = {}
-
-                    if dep.name not in dep_dict[mid]:
-                        dep_dict[mid][dep.name] = {}
-
-                    if version not in dep_dict[mid][dep.name]:
-                        dep_dict[mid][dep.name][version] = dep
-                        ndeps.append(dep)
-
-        # Check for conflicts (and try to resolve them if possible).
-        dep_list = set()
-        for mid, deps in dep_dict.items():
-            for name, variants in deps.items():
-                if len(variants) == 1:
-                    dep_list.add(next(iter(variants.values())))
-                else:
-                    specs = variants.keys()
-                    remains = []
-
-                    for v in variants.values():
-                        ok = True
-                        for spec in specs:
-                            if not spec.match(v.get_mod().version):
-                                ok = False
-                                break
-
-                        if ok:
-                            remains.append(v)
-
-                    if len(remains) == 0:
-                        v = (list(variants.values())[0].name, ','.join([str(s) for s in specs]))
-                        raise PackageNotFound('No version of package "%s" found for these constraints: %s' % v, mid, list(variants.values())[0].name)
-                    else:
-                        # Pick the latest
-                        remains.sort(key=lambda v: v.get_mod().version)
-                        dep_list.add(remains[-1])
+        from .resolver import Resolver
+
+        res = Resolver(self)
+        result = res.resolve(pkgs)
 
-        dep_list |= set(pkgs)
-        return dep_list
+        if center.DEBUG:
+            logging.debug('Resolved dependencies:\n%s', res.explain())
+
+        return result
 
     def save_logos(self, path):
         for mid, mvs in self.mods.items():
@@ -357,36 +645,35 @@ class Repo(object):
 
 
 class Mod(object):
-    _repo = None
-    mid = ''
-    title = ''
-    mtype = 'mod'
-    version = None
-    folder = None
-    cmdline = ''
-    logo = None
-    logo_path = None
-    tile = None
-    tile_path = None
-    description = ''
-    notes = ''
-    release_thread = None
-    videos = None
-    first_release = None
-    last_update = None
-    actions = None
-    packages = None
+    # Large repositories contain thousands of these so we avoid a __dict__ for every instance.
+    __slots__ = ('_repo', '_stamp', 'mid', 'title', 'mtype', 'version', 'folder', 'cmdline', 'logo', 'logo_path',
+        'tile', 'tile_path', 'description', 'notes', 'release_thread', 'videos', 'first_release', 'last_update',
+        'actions', 'packages')
 
     __fields__ = ('mid', 'title', 'type', 'version', 'folder', 'cmdline', 'logo', 'tile',
         'description', 'notes', 'actions', 'packages')
 
     def __init__(self, values=None, repo=None):
+        self._repo = repo
+        self._stamp = None
+        self.mid = ''
+        self.title = ''
+        self.mtype = 'mod'
+        self.version = None
+        self.folder = None
+        self.cmdline = ''
+        self.logo = None
+        self.logo_path = None
+        self.tile = None
+        self.tile_path = None
+        self.description = ''
+        self.notes = ''
+        self.release_thread = None
+        self.videos = []
+        self.first_release = None
+        self.last_update = None
         self.actions = []
         self.packages = []
-        self.videos = []
-
-        if repo is not None:
-            self._repo = repo
 
         if values is not None:
             self.set(values)
@@ -395,11 +682,11 @@ class Mod(object):
         return '<Mod "%s" %s (%s)>' % (self.title, self.version, self.mid)
 
     def set(self, values):
-        self.mid = values['id']
+        self.mid = _intern(values['id'])
         self.title = values['title']
-        self.mtype = values.get('type', 'mod')  # Backwards compatibility
-        self.version = semantic_version.Version(values['version'], partial=True)
-        self.folder = values.get('folder', self.mid).strip('/')  # make sure we have a relative path
+        self.mtype = _intern(values.get('type', 'mod'))  # Backwards compatibility
+        self.version = util.get_version(values['version'], partial=True)
+        self.folder = _intern(values.get('folder', self.mid).strip('/'))  # make sure we have a relative path
         self.cmdline = values.get('cmdline', '')
         self.logo = values.get('logo', None)
         self.tile = values.get('tile', None)
@@ -444,7 +731,8 @@ class Mod(object):
             if 'dest' in act:
                 act['dest'] = act['dest'].lstrip('/')
 
-    def get(self):
+    # If files is False, the packages' file lists are left out (i.e. for the mod list which doesn't need them).
+    def get(self, lazy=False, files=True):
         return {
             'id': self.mid,
             'title': self.title,
@@ -463,12 +751,23 @@ class Mod(object):
             'first_release': self.first_release.strftime('%Y-%m-%d') if self.first_release else None,
             'last_update': self.last_update.strftime('%Y-%m-%d') if self.last_update else None,
             'actions': self.actions,
-            'packages': [pkg.get() for pkg in self.packages]
+            'packages': [pkg.get(lazy, files) for pkg in self.packages]
         }
 
     def copy(self):
         return Mod(self.get(), self._repo)
 
+    # Returns a copy of this mod which belongs to repo. Unlike copy(), nothing is parsed again. The values (and the
+    # lazy file lists) are shared with this mod.
+    def clone(self, repo):
+        mod = Mod.__new__(Mod)
+        for name in Mod.__slots__:
+            setattr(mod, name, getattr(self, name))
+
+        mod._repo = repo
+        mod.packages = [pkg.clone(mod) for pkg in self.packages]
+        return mod
+
     def get_files(self):
         files = []
         for pkg in self.packages:
@@ -518,21 +817,20 @@ class Mod(object):
 
 
 class Package(object):
-    _mod = None
-    name = ''
-    notes = ''
-    status = 'recommended'
-    dependencies = None
-    environment = None
-    files = None
-    filelist = None
-    executables = None
+    __slots__ = ('_mod', 'name', 'notes', 'status', 'dependencies', 'environment', '_files', '_filelist',
+        'executables', '_lazy')
 
     def __init__(self, values=None, mod=None):
         self._mod = mod
+        self.name = ''
+        self.notes = ''
+        self.status = 'recommended'
         self.dependencies = []
         self.environment = []
-        self.files = {}
+        self._files = {}
+        self._filelist = None
+        self._lazy = None
+        self.executables = None
 
         if values is not None:
             self.set(values)
@@ -540,31 +838,100 @@ class Package(object):
     def __repr__(self):
         return '<Package "%s" of %s>' % (self.name, self._mod)
 
-    def set(self, values):
-        self.name = values['name']
-        self.notes = values.get('notes', '')
-        self.status = values.get('status', 'recommended').lower()
-        self.dependencies = values.get('dependencies', [])
-        self.environment = values.get('environment', [])
-        self.files = {}
-        self.filelist = values.get('filelist', [])
-        self.executables = values.get('executables', [])
+    # files and filelist are only needed for installs and checks. Packages loaded from mods.json keep
+    # them as a JSON string (_lazy) which is only decoded once one of them is accessed.
+    @property
+    def files(self):
+        if self._lazy is not None:
+            self._load_lazy()
+
+        return self._files
+
+    @files.setter
+    def files(self, value):
+        if self._lazy is not None:
+            self._load_lazy()
+
+        self._files = value
+
+    @property
+    def filelist(self):
+        if self._lazy is not None:
+            self._load_lazy()
+
+        return self._filelist
+
+    @filelist.setter
+    def filelist(self, value):
+        if self._lazy is not None:
+            self._load_lazy()
+
+        self._filelist = value
+
+    def _load_lazy(self):
+        lazy = self._lazy
+        if lazy is None:
+            return
+
+        # Decode outside of the lock. If another thread is faster, we just throw our result away.
+        if isinstance(lazy, snapshot.Blob):
+            data = lazy.load_json()
+        else:
+            data = json.loads(lazy)
+
+        filelist = data.get('filelist', [])
+        files = self._parse_files(data.get('files', []), filelist)
 
-        _files = values.get('files', [])
+        with _LAZY_LOCK:
+            if self._lazy is lazy:
+                # _lazy has to be cleared last since the properties only check that.
+                self._files = files
+                self._filelist = filelist
+                self._lazy = None
+
+    def _set_files(self, _files, filelist):
+        self._files = self._parse_files(_files, filelist)
+        self._filelist = filelist
+
+    def _parse_files(self, _files, filelist):
+        files = {}
+
+        for item in filelist:
+            if 'archive' in item:
+                item['archive'] = _intern(item['archive'])
 
         if isinstance(_files, dict):
-            self.files = _files
+            files = _files
             for name, item in _files.items():
                 item['filename'] = name
-                item['dest'] = item.get('dest', '').strip('/')  # make sure this is a relative path
+                item['dest'] = _intern(item.get('dest', '').strip('/'))  # make sure this is a relative path
 
         elif isinstance(_files, list):
             for item in _files:
-                item['dest'] = item.get('dest', '').strip('/')  # make sure this is a relative path
-                self.files[item['filename']] = item
+                item['dest'] = _intern(item.get('dest', '').strip('/'))  # make sure this is a relative path
+                files[item['filename']] = item
         else:
             logging.warning('"%s"\'s file list has an unknown type.', self.name)
 
+        return files
+
+    def set(self, values):
+        self.name = _intern(values['name'])
+        self.notes = values.get('notes', '')
+        self.status = _intern(values.get('status', 'recommended').lower())
+        self.dependencies = values.get('dependencies', [])
+        self.environment = values.get('environment', [])
+        self.executables = values.get('executables', [])
+
+        for info in self.dependencies:
+            info['id'] = _intern(info['id'])
+
+        if '_lazy' in values:
+            self._lazy = values['_lazy']
+        else:
+            self._lazy = None
+            self._set_files(values.get('files', []), values.get('filelist', []))
+
         has_mod_dep = False
         mid = self._mod.mid
 
@@ -583,21 +950,49 @@ class Package(object):
                 'packages': []
             })
 
-    def get(self):
-        return {
+    # If lazy is True, files and filelist are returned as a JSON string (or a snapshot.Blob) in the '_lazy' field.
+    # If files is False, they're left out completely.
+    def get(self, lazy=False, files=True):
+        data = {
             'name': self.name,
             'notes': self.notes,
             'status': self.status,
             'dependencies': self.dependencies,
             'environment': self.environment,
-            'files': list(self.files.values()),
-            'filelist': self.filelist,
             'executables': self.executables
         }
 
+        if not files:
+            return data
+
+        if lazy:
+            lazy_data = self._lazy
+            if lazy_data is not None:
+                data['_lazy'] = lazy_data
+            else:
+                data['_lazy'] = json.dumps({
+                    'files': list(self._files.values()),
+                    'filelist': self._filelist
+                })
+        else:
+            data['files'] = list(self.files.values())
+            data['filelist'] = self.filelist
+
+        return data
+
     def get_mod(self):
         return self._mod
 
+    # Returns a copy of this package which belongs to mod. See Mod.clone().
+    def clone(self, mod):
+        pkg = Package.__new__(Package)
+        with _LAZY_LOCK:
+            for name in Package.__slots__:
+                setattr(pkg, name, getattr(self, name))
+
+        pkg._mod = mod
+        return pkg
+
     def get_files(self):
         files = {}
         for name, item in self.files.items():
@@ -617,7 +1012,7 @@ class Package(object):
                 # Make a spec out of this version
                 version = '==' + version
 
-            version = util.Spec(version)
+            version = util.get_spec(version)
             mod = self._mod._repo.query(dep['id'], version)
             pkgs = dep.get('packages', [])
             found_pkgs = []
@@ -703,9 +1098,17 @@ class Package(object):
 # Keeps track of installed mods
 class InstalledRepo(Repo):
     base = '[INSTALLED]'
+    # CheckTask's directory cache: path -> [directory stat key, subdirectories, mod file, mod file stat key, mod]
+    scan_cache = None
+
+    def __init__(self, data=None):
+        self.scan_cache = {}
+
+        super(InstalledRepo, self).__init__(data)
 
     def clear(self):
         self.mods = {}
+        self.generation += 1
 
     def save_pins(self, path):
         with open(path, 'w') as stream:
@@ -717,11 +1120,42 @@ class InstalledRepo(Repo):
 
     def set(self, mods):
         for m, v in mods['pins'].items():
-            self.pins[m] = semantic_version.Version(v)
+            self.pins[m] = util.get_version(v)
 
         for mod in mods['mods']:
             self.add_mod(InstalledMod(mod))
 
+    # The snapshot lets us show the installed mods right away instead of waiting for CheckTask.
+    def save_snapshot(self, path):
+        mods = []
+        for mvs in self.mods.values():
+            for mod in mvs:
+                # IniMods are cheap to rebuild and can't be restored from their get() output.
+                if not isinstance(mod, IniMod):
+                    info = mod.get(lazy=True)
+                    info['folder'] = mod.folder
+                    # get() leaves these out but we need them to restore engines and their actions.
+                    info['type'] = mod.mtype
+                    info['notes'] = mod.notes
+                    info['actions'] = mod.actions
+                    info['check_notes'] = mod.check_notes
+                    mods.append(info)
+
+        self._write_snapshot(path, {'pins': {}, 'mods': mods})
+
+    def load_snapshot(self, path):
+        data = self._read_snapshot(path)
+        if data is None:
+            return False
+
+        for info in data['mods']:
+            mod = InstalledMod(info)
+            mod.logo_path = info.get('logo_path')
+            mod.tile_path = info.get('tile_path')
+            self.add_mod(mod)
+
+        return True
+
     def add_pkg(self, pkg):
         mod = pkg.get_mod()
         try:
@@ -748,16 +1182,13 @@ class InstalledRepo(Repo):
     def del_mod(self, mod):
         if mod.mid in self.mods:
             vs = self.mods[mod.mid]
-            rem = None
-            for m in vs:
-                if m.version == mod.version:
-                    rem = m
-                    break
+            i = _find_version(vs, mod.version)
 
-            if rem is None:
+            if i >= len(vs) or vs[i].version != mod.version:
                 logging.error('Tried to delete missing mod version!')
             else:
-                vs.remove(rem)
+                del vs[i]
+                self.generation += 1
                 if len(vs) == 0:
                     del self.mods[mod.mid]
 
@@ -857,7 +1288,7 @@ class InstalledMod(Mod):
         for pkg in pkgs:
             self.packages.append(InstalledPackage(pkg, self))
 
-    def get(self):
+    def get(self, lazy=False, files=True):
         return {
             'installed': True,
             'id': self.mid,
@@ -873,7 +1304,7 @@ class InstalledMod(Mod):
             'first_release': self.first_release.strftime('%Y-%m-%d') if self.first_release else None,
             'last_update': self.last_update.strftime('%Y-%m-%d') if self.last_update else None,
             'cmdline': self.cmdline,
-            'packages': [pkg.get() for pkg in self.packages]
+            'packages': [pkg.get(lazy, files) for pkg in self.packages]
         }
 
     def add_pkg(self, pkg):
@@ -1017,7 +1448,7 @@ class InstalledPackage(Package):
 
         self.check_notes = values.get('check_notes', '')
 
-    def get(self):
-        data = super(InstalledPackage, self).get()
+    def get(self, lazy=False, files=True):
+        data = super(InstalledPackage, self).get(lazy, files)
         data['check_notes'] = self.check_notes
         return data
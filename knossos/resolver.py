@@ -0,0 +1,203 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import re
+import logging
+import threading
+import weakref
+
+from . import util
+from .repo import ModNotFound, PackageNotFound
+
+# Candidate lists per repo: repo -> (generation, {(mid, spec string): [mods]})
+_CACHES = weakref.WeakKeyDictionary()
+_cache_lock = threading.Lock()
+
+
+def _get_cache(repo):
+    with _cache_lock:
+        entry = _CACHES.get(repo)
+        if entry is None or entry[0] != repo.generation:
+            entry = _CACHES[repo] = (repo.generation, {})
+
+        return entry[1]
+
+
+def parse_spec(version):
+    if re.match(r'\d', version):
+        # Make a spec out of this version
+        version = '==' + version
+
+    return util.get_spec(version)
+
+
+# Resolves the dependencies of a package selection.
+#
+# Every dependency adds a constraint on the depended-on mod. All constraints on a mod are intersected and the latest
+# version satisfying all of them is picked. Since another version can have different dependencies, this is repeated
+# until the selection stops changing.
+class Resolver(object):
+    max_rounds = 20
+    _repo = None
+    _cache = None
+    _specs = None
+    # mid -> chosen Mod
+    _choices = None
+    # mid -> list of (spec, requiring package)
+    _constraints = None
+    # mid -> set of requested package names
+    _requested = None
+
+    def __init__(self, repo):
+        self._repo = repo
+        self._cache = _get_cache(repo)
+        self._specs = {}
+        self._choices = {}
+
+    def get_spec(self, version):
+        spec = self._specs.get(version)
+        if spec is None:
+            spec = self._specs[version] = parse_spec(version)
+
+        return spec
+
+    # Returns all versions of mid which match spec (newest first).
+    def get_candidates(self, mid, spec):
+        key = (mid, str(spec))
+        result = self._cache.get(key)
+
+        if result is None:
+            if mid not in self._repo.mods:
+                raise ModNotFound('Mod "%s" wasn\'t found!' % mid, mid)
+
+            result = self._cache[key] = [mod for mod in self._repo.mods[mid] if spec.match(mod.version)]
+
+        return result
+
+    def _choose(self, mid):
+        constraints = self._constraints[mid]
+        candidates = None
+
+        for spec, pkg in constraints:
+            matches = self.get_candidates(mid, spec)
+            if candidates is None:
+                candidates = matches
+            else:
+                matches = set(id(mod) for mod in matches)
+                candidates = [mod for mod in candidates if id(mod) in matches]
+
+        if not candidates:
+            raise PackageNotFound('No version of mod "%s" found for these constraints:\n%s' % (
+                mid, self._explain_constraints(mid)), mid, list(self._requested.get(mid, [])))
+
+        # The candidates are sorted so the first one is the latest version.
+        return candidates[0]
+
+    def _collect(self, pkgs):
+        self._constraints = {}
+        self._requested = {}
+        # The version of each mod whose dependencies are followed in this round
+        visited = {}
+        queue = list(pkgs)
+        roots = set(id(pkg) for pkg in pkgs)
+        seen = set()
+
+        while queue:
+            pkg = queue.pop()
+            if id(pkg) in seen:
+                continue
+
+            seen.add(id(pkg))
+            own_mid = pkg.get_mod().mid
+
+            for dep in pkg.dependencies:
+                mid = dep['id']
+                if mid == own_mid and id(pkg) not in roots:
+                    # Every package depends on its own mod's version. This only matters for the packages we
+                    # were asked to install. For all others, the version is what we're trying to decide.
+                    continue
+
+                spec = self.get_spec(dep['version'])
+                self._constraints.setdefault(mid, []).append((spec, pkg))
+                names = self._requested.setdefault(mid, set())
+                names.update(dep.get('packages', []))
+
+                mod = visited.get(mid)
+                if mod is None:
+                    # Follow the version chosen in the last round or the latest one for now.
+                    mod = self._choices.get(mid)
+                    if mod is None:
+                        candidates = self.get_candidates(mid, spec)
+                        if not candidates:
+                            raise ModNotFound('Mod "%s" %s wasn\'t found!' % (mid, spec), mid, spec)
+
+                        mod = candidates[0]
+
+                    visited[mid] = mod
+
+                queue.extend(self._get_pkgs(mod, names))
+
+    def _get_pkgs(self, mod, names):
+        return [pkg for pkg in mod.packages if pkg.status == 'required' or pkg.name in names]
+
+    # Returns the set of packages that pkgs need (including pkgs).
+    def resolve(self, pkgs):
+        for i in range(self.max_rounds):
+            self._collect(pkgs)
+
+            choices = {}
+            for mid in self._constraints:
+                choices[mid] = self._choose(mid)
+
+            if choices == self._choices:
+                break
+
+            self._choices = choices
+        else:
+            logging.warning('The dependency resolution did not settle after %d rounds!', self.max_rounds)
+
+        result = set(pkgs)
+        for mid, mod in self._choices.items():
+            names = self._requested[mid]
+            found = set()
+
+            for pkg in self._get_pkgs(mod, names):
+                result.add(pkg)
+                found.add(pkg.name)
+
+            missing = names - found
+            if missing:
+                raise PackageNotFound('Package %s of mod %s (%s) couldn\'t be found!' % (
+                    next(iter(missing)), mid, mod.version), mid, missing)
+
+        return result
+
+    def _explain_constraints(self, mid):
+        lines = []
+        for spec, pkg in self._constraints.get(mid, []):
+            mod = pkg.get_mod()
+            lines.append('  %s (required by package "%s" of %s %s)' % (spec, pkg.name, mod.mid, mod.version))
+
+        return '\n'.join(lines)
+
+    # Returns a human readable description of the chosen versions and the constraints which led to them.
+    def explain(self):
+        lines = []
+        for mid in sorted(self._choices.keys()):
+            lines.append('%s %s:' % (mid, self._choices[mid].version))
+            lines.append(self._explain_constraints(mid))
+
+        return '\n'.join(lines)
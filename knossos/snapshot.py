@@ -0,0 +1,134 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import struct
+import marshal
+import logging
+import zlib
+
+# Snapshot files store the local mod catalog and the installed mods in a format which is a lot faster
+# to load than JSON.
+#
+# Layout:
+#   header (see HEADER)
+#   blob section: every entry is a 32 bit length followed by raw bytes (i.e. the JSON encoded file lists of packages)
+#   body: the actual data encoded with marshal
+#
+# marshal stores repeated (interned) strings only once and refers back to the first copy which gives us a string
+# table for free and the body is decoded entirely in C. Since marshal's format depends on the Python version,
+# snapshots written by a different version are rejected and the caller has to fall back to JSON.
+# Blobs are referenced in the body by their index and are returned as Blob objects which point into the file's
+# buffer and are only copied when they're actually needed.
+
+MAGIC = b'KNSNAP'
+FORMAT_VERSION = 1
+# magic, format version, Python major, Python minor, marshal version, blob count, body size, CRC32 of the body
+HEADER = struct.Struct('<6sHBBBxIII')
+ENTRY = struct.Struct('<I')
+
+_PY_VERSION = sys.version_info[:2]
+
+
+# A byte string inside a loaded snapshot.
+class Blob(object):
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def get_bytes(self):
+        return self._data.tobytes()
+
+    def get_text(self):
+        return self.get_bytes().decode('utf8')
+
+    def load_json(self):
+        return json.loads(self.get_text())
+
+
+def _replace(src, dest):
+    if hasattr(os, 'replace'):
+        os.replace(src, dest)
+    else:
+        # Python 2 on Windows can't rename over an existing file.
+        if sys.platform.startswith('win') and os.path.exists(dest):
+            os.unlink(dest)
+
+        os.rename(src, dest)
+
+
+# data may only contain dicts, lists, tuples, strings, numbers, booleans and None.
+# blobs is a list of byte strings. The file is written to a temporary file first and then moved over the old one
+# so readers never see a half-written snapshot.
+def save(path, data, blobs=()):
+    body = marshal.dumps(data)
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'wb') as stream:
+        stream.write(HEADER.pack(MAGIC, FORMAT_VERSION, _PY_VERSION[0], _PY_VERSION[1], marshal.version,
+                                 len(blobs), len(body), zlib.crc32(body) & 0xffffffff))
+
+        for item in blobs:
+            stream.write(ENTRY.pack(len(item)))
+            stream.write(item)
+
+        stream.write(body)
+        stream.flush()
+        os.fsync(stream.fileno())
+
+    _replace(tmp_path, path)
+
+
+# Returns (data, blobs) or None if the file is missing, damaged or was written by an incompatible version.
+def load(path):
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, 'rb') as stream:
+            raw = stream.read()
+
+        if len(raw) < HEADER.size:
+            return None
+
+        magic, version, major, minor, m_version, blob_count, body_size, crc = HEADER.unpack_from(raw)
+        if magic != MAGIC or version != FORMAT_VERSION or (major, minor) != _PY_VERSION or \
+                m_version != marshal.version:
+            logging.info('Ignoring snapshot "%s" since it was written by a different version.', path)
+            return None
+
+        view = memoryview(raw)
+        pos = HEADER.size
+        blobs = []
+
+        for i in range(blob_count):
+            size = ENTRY.unpack_from(raw, pos)[0]
+            pos += ENTRY.size
+            blobs.append(Blob(view[pos:pos + size]))
+            pos += size
+
+        body = raw[pos:pos + body_size]
+        if len(body) != body_size or zlib.crc32(body) & 0xffffffff != crc:
+            logging.warning('The snapshot "%s" is damaged!', path)
+            return None
+
+        return marshal.loads(body), blobs
+    except:
+        logging.exception('Failed to load the snapshot "%s"!', path)
+        return None
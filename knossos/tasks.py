@@ -26,28 +26,24 @@ import tempfile
 import threading
 import random
 import time
+import hashlib
+from collections import deque
 import semantic_version
 
-from . import center, util, progress, repo, api
+from . import center, util, progress, repo, api, parallel
 from .repo import Repo
+from .parallel import stat_key
 from .qt import QtCore, QtWidgets
 
 
 translate = QtCore.QCoreApplication.translate
 
-
 class FetchTask(progress.Task):
 
     def __init__(self):
         super(FetchTask, self).__init__()
         self.title = 'Fetching mod list...'
 
-        # Remove all logos.
-        for path in glob.glob(os.path.join(center.settings_path, 'logo*.*')):
-            if os.path.isfile(path):
-                logging.info('Removing old logo "%s"...', path)
-                os.unlink(path)
-
         self.done.connect(self.finish)
 
         if repo.CPU_INFO is None:
@@ -69,95 +65,291 @@ class FetchTask(progress.Task):
 
             progress.update(0.1, 'Fetching "%s"...' % link)
 
+            prev = self._get_prev(link)
+
+            # The server always sends the whole file but we only have to parse the mods which changed.
+            reuse = prev.get_stamps() if prev is not None else {}
+
+            # The loader keeps the responses from is_outdated() so the changed files aren't requested again below.
+            loader = repo.IncludeLoader(reuse)
+            loader.decode = self._decode_repo
+            if prev is not None and not prev.is_outdated(loader):
+                # Nothing changed. The logos were already saved the last time, too.
+                logging.info('"%s" is up to date.', link)
+                self.post((prio, prev, link, center.mods.fetched[link]))
+                return
+
             try:
-                raw_data = util.get(link, raw=True)
+                url, text, changed = loader.get_text(link)
+
+                progress.update(0.2, 'Parsing "%s"...' % link)
+                decoded = self._decode_repo(text)
 
                 data = Repo()
                 data.is_link = True
-                data.base = os.path.dirname(raw_data.url)
-                data.parse(raw_data.text)
+                data.base = os.path.dirname(url)
+                data.sources = [link]
+                data.parse(decoded, reuse, loader)
+            except parallel.JobAborted:
+                return
             except:
                 logging.exception('Failed to decode "%s"!', link)
                 return
 
+            # The loader still has all responses so this doesn't send any requests.
+            texts = [loader.get_text(src) for src in data.sources]
+            if all(texts):
+                info = {
+                    'sources': [(src, self._hash_text(res[1])) for src, res in zip(data.sources, texts)],
+                    'stamps': [mod._stamp for mvs in data.mods.values() for mod in mvs]
+                }
+            else:
+                # Some includes failed to load. We'll have to try again next time.
+                info = None
+
+            reused = set(id(mod) for mod in reuse.values())
             wl = []
             for mid, mvs in data.mods.items():
                 for mod in mvs:
-                    wl.append(('mod', mod))
+                    if id(mod) not in reused:
+                        wl.append(('mod', mod))
+
+            logging.info('Parsed %d new or changed mods from "%s".', len(wl), link)
 
             self.add_work(wl)
-            self.post((prio, data))
+            self.post((prio, data, link, info))
         else:
             mod = params[1]
             mod.save_logo(center.settings_path)
 
+    # Returns the repo we got from link the last time (see Repo.get_fetched()). It's only used if the HTTP cache
+    # still contains the responses it was parsed from. Otherwise is_outdated() could miss changes which were cached
+    # without being parsed (i.e. because the last fetch failed).
+    def _get_prev(self, link):
+        if center.mods is None:
+            return None
+
+        prev = center.mods.get_fetched(link)
+        if prev is None:
+            return None
+
+        for src, chksum in center.mods.fetched[link]['sources']:
+            entry = util.HTTP_CACHE.get(src)
+            if entry is None or self._hash_text(entry['text']) != chksum:
+                return None
+
+        return prev
+
+    def _hash_text(self, text):
+        return hashlib.md5(text.encode('utf8')).hexdigest()
+
+    # Decoding the JSON data is the slowest part so we do it in a separate process. The file lists are sent back as
+    # JSON strings (see parallel.decode_repo()) since unpickling them would take about as long as decoding them here.
+    def _decode_repo(self, text):
+        return self.run_in_process(parallel.decode_repo, text, True)
+
     def finish(self):
         if not self.aborted:
-            modlist = center.mods = Repo()
+            modlist = Repo()
             res = self.get_results()
             res.sort(key=lambda x: x[0])
 
-            for part in res:
-                modlist.merge(part[1])
+            fetched = {}
+            for prio, data, link, info in res:
+                modlist.merge(data)
+                fetched[link] = info
+
+            if center.mods is None:
+                center.mods = Repo()
+
+            added, changed, removed = center.mods.update(modlist, copy=True)
+            logging.info('Mod list updated: %d added, %d changed, %d removed.', added, changed, removed)
+
+            # The snapshot has to be saved if this changed, too. Otherwise the repositories are parsed again after
+            # the next start.
+            fetched_changed = center.mods.fetched != fetched
+            center.mods.fetched = fetched
+
+            snap_path = os.path.join(center.settings_path, 'mods.snap')
+            json_path = os.path.join(center.settings_path, 'mods.json')
+            dirty = added or changed or removed or fetched_changed
+            if dirty or not os.path.isfile(snap_path) or not os.path.isfile(json_path):
+                try:
+                    center.mods.save_snapshot(snap_path)
+                except:
+                    logging.exception('Failed to save the mod list snapshot!')
 
-            modlist.save_json(os.path.join(center.settings_path, 'mods.json'))
+                    # Don't load an outdated mod list on the next start.
+                    if os.path.isfile(snap_path):
+                        try:
+                            os.unlink(snap_path)
+                        except OSError:
+                            logging.exception('Failed to remove the old snapshot "%s"!', snap_path)
+
+                # The JSON file is used if the snapshot can't be read (i.e. after a Python update).
+                try:
+                    center.mods.save_json(json_path)
+                except:
+                    logging.exception('Failed to save the mod list!')
+
+            self._remove_old_logos(center.mods)
             api.save_settings()
 
         run_task(CheckTask())
 
+    def _remove_old_logos(self, modlist):
+        used = set()
+        for mvs in modlist.mods.values():
+            for mod in mvs:
+                used.add(mod.logo)
+                used.add(mod.tile)
+
+        for pattern in ('logo_*.*', 'tile_*.*'):
+            for path in glob.glob(os.path.join(center.settings_path, pattern)):
+                path = os.path.abspath(path)
 
+                if path not in used and os.path.isfile(path):
+                    logging.info('Removing old logo "%s"...', path)
+                    os.unlink(path)
+
+
+# Quick checks (the default) only read files whose size, mtime or inode changed since their checksum was cached.
+# Installs record the checksums of the files they write (see InstallTask) so checking a freshly installed mod
+# only needs a stat() per file. Deep checks ignore the cache and read every file again.
+# If the file watcher is running, quick checks only look at packages which contain changed files.
 class CheckTask(progress.MultistepTask):
     can_abort = False
+    deep = False
+    resource = progress.RESOURCE_CPU
+    _visited = None
+    _changes = None
     _steps = 2
 
-    def __init__(self):
+    def __init__(self, deep=False):
         super(CheckTask, self).__init__(threads=3)
 
+        self.deep = deep
         self.done.connect(self.finish)
         self.title = 'Checking installed mods...'
 
     def init1(self):
+        self._visited = set()
+
         if center.settings['base_path'] is None:
             logging.error('A CheckTask was launched even though no base path was set!')
         else:
-            center.installed.clear()
-            self.add_work(((center.settings['base_path'], None),))
-            self.add_work([(p, None) for p in center.settings['base_dirs']])
+            watcher = center.file_watcher
+            if watcher is not None:
+                watcher.set_paths([center.settings['base_path']] + center.settings['base_dirs'])
+
+                # We don't wait for the watches since adding them can take a while for big libraries and we'd block
+                # a worker in the meantime. Until they're in place, we check everything.
+                if not self.deep and watcher.wait_ready(0):
+                    # Changes which happen from now on will be picked up by the next check.
+                    self._changes = watcher.pop_changes()
+
+            self.add_work((center.settings['base_path'],))
+            self.add_work(center.settings['base_dirs'])
 
-    def work1(self, p):
-        mods = center.installed
-        path, base_mod = p
+    # Looks for mods in path. The folder of a mod isn't searched any further and folders whose mtime didn't change
+    # since the last scan aren't listed again. The mods are only parsed again if their mod.json (or mod.ini) changed.
+    def work1(self, path):
+        cache = center.installed.scan_cache
+        self._visited.add(path)
 
-        subs = []
-        mod_file = None
+        try:
+            dir_key = stat_key(os.stat(path))
+        except OSError:
+            logging.exception('Failed to scan "%s"!', path)
+            return
+
+        entry = None if self.deep else cache.get(path)
+        if entry is None or entry[0] != dir_key:
+            subs = []
+            mod_file = None
 
-        for base in os.listdir(path):
-            sub = os.path.join(path, base)
+            for name, is_dir in util.scan_dir(path):
+                if is_dir:
+                    subs.append(os.path.join(path, name))
+                elif name.lower() == 'mod.json' or (name.lower() == 'mod.ini' and not mod_file):
+                    mod_file = os.path.join(path, name)
 
-            if os.path.isdir(sub):
-                subs.append(sub)
-            elif base.lower() == 'mod.json' or (base.lower() == 'mod.ini' and not mod_file):
-                mod_file = sub
+            if entry is not None and entry[2] == mod_file:
+                # Keep the parsed mod, we'll check below whether the file changed.
+                entry = [dir_key, subs, mod_file, entry[3], entry[4]]
+            else:
+                entry = [dir_key, subs, mod_file, None, None]
+
+        cache[path] = entry
+        mod_file = entry[2]
 
         if mod_file:
             try:
-                mod = repo.InstalledMod.load(mod_file)
-                if base_mod:
-                    mod.set_base(base_mod)
-                else:
-                    base_mod = mod
+                mod_key = stat_key(os.stat(mod_file))
+                if entry[4] is None or entry[3] != mod_key:
+                    entry[4] = repo.InstalledMod.load(mod_file)
+                    entry[3] = mod_key
 
-                mods.add_mod(mod)
+                self.post(entry[4])
             except:
-                logging.exception('Failed to parse "%s"!', sub)
-
-        self.add_work([(p, base_mod) for p in subs])
+                logging.exception('Failed to parse "%s"!', mod_file)
+                entry[4] = None
+        else:
+            self.add_work(entry[1])
 
     def init2(self):
+        known = set()
+        for mvs in center.installed.mods.values():
+            known.update(id(mod) for mod in mvs)
+
+        # Apply the changes we found to the installed mods.
+        found = repo.InstalledRepo()
+        for mod in self.get_results():
+            found.add_mod(mod)
+
+        added, changed, removed = center.installed.update(found)
+        logging.info('Installed mods: %d added, %d changed, %d removed.', added, changed, removed)
+
+        cache = center.installed.scan_cache
+        for path in list(cache.keys()):
+            if path not in self._visited:
+                del cache[path]
+
+        watcher = center.file_watcher
+        if watcher is not None and (self._changes is None or added or changed or removed):
+            # Tell the watcher which files it should care about.
+            files = []
+            for mid, mvs in center.installed.mods.items():
+                for mod in mvs:
+                    if not mod.folder:
+                        continue
+
+                    for pkg in mod.packages:
+                        files.extend(os.path.join(mod.folder, info['filename']) for info in pkg.filelist)
+
+            watcher.set_files(files)
+
+            if self._changes is None and watcher.wait_ready(0):
+                # We're about to check everything so the next check only has to look at the changes from now on.
+                watcher.pop_changes()
+
         pkgs = []
-        for mid, mvs in center.installed.mods.items():
-            for mod in mvs:
-                pkgs.extend(mod.packages)
+        if self._changes is None:
+            for mid, mvs in center.installed.mods.items():
+                for mod in mvs:
+                    pkgs.extend(mod.packages)
+        else:
+            touched = self._get_touched_pkgs(self._changes)
+
+            for mid, mvs in center.installed.mods.items():
+                for mod in mvs:
+                    if id(mod) not in known:
+                        # New or reloaded mods haven't been checked, yet.
+                        pkgs.extend(mod.packages)
+                    else:
+                        pkgs.extend([pkg for pkg in mod.packages if id(pkg) in touched])
+
+            logging.debug('%d changed files, checking %d packages.', len(self._changes), len(pkgs))
 
         # Reset them
         for pkg in pkgs:
@@ -177,13 +369,19 @@ class CheckTask(progress.MultistepTask):
         archives = set()
         msgs = []
 
+        paths = []
         for info in pkg_files:
             mypath = util.ipath(os.path.join(mod.folder, info['filename']))
+            paths.append(mypath if os.path.isfile(mypath) else None)
+
+        hashes = util.gen_hashes([p for p in paths if p is not None], use_cache=not self.deep)
+
+        for info, mypath in zip(pkg_files, paths):
             fix = False
-            if os.path.isfile(mypath):
+            if mypath is not None:
                 progress.update(checked / count, 'Checking "%s"...' % (info['filename']))
 
-                if util.gen_hash(mypath) == info['md5sum']:
+                if next(hashes)[1] == info['md5sum']:
                     success += 1
                 else:
                     msgs.append('File "%s" is corrupted. (checksum mismatch)' % (info['filename']))
@@ -200,6 +398,33 @@ class CheckTask(progress.MultistepTask):
 
         self.post((pkg, archives, success, missing, checked, msgs))
 
+    # Returns the IDs of all packages which contain one of the given paths. A path can also be a removed folder.
+    def _get_touched_pkgs(self, paths):
+        paths = [os.path.normcase(p) for p in paths]
+        result = set()
+
+        for mvs in center.installed.mods.values():
+            for mod in mvs:
+                if not mod.folder:
+                    continue
+
+                prefix = os.path.join(os.path.normcase(os.path.abspath(mod.folder)), '')
+                changed = set(p[len(prefix):].replace(os.sep, '/').lower() for p in paths if p.startswith(prefix))
+                if not changed:
+                    continue
+
+                for pkg in mod.packages:
+                    for info in pkg.filelist:
+                        name = info['filename'].lower()
+                        while name and name not in changed:
+                            name = name.rpartition('/')[0]
+
+                        if name:
+                            result.add(id(pkg))
+                            break
+
+        return result
+
     def finish(self):
         results = self.get_results()
 
@@ -225,20 +450,29 @@ class CheckTask(progress.MultistepTask):
                 pkg.files_ok = s
                 pkg.files_checked = c
 
+        try:
+            center.installed.save_snapshot(os.path.join(center.settings_path, 'installed.snap'))
+        except:
+            logging.exception('Failed to save the snapshot of the installed mods!')
+
         center.signals.repo_updated.emit()
 
 
+# See CheckTask for the difference between quick and deep checks.
 class CheckFilesTask(progress.MultistepTask):
     can_abort = False
+    deep = False
+    resource = progress.RESOURCE_CPU
     _mod = None
     _check_results = None
     _steps = 2
 
-    def __init__(self, mod):
+    def __init__(self, mod, deep=False):
         super(CheckFilesTask, self).__init__(threads=3)
 
         self.title = 'Checking "%s"...' % mod.title
         self.mods = [mod]
+        self.deep = deep
         self._mod = mod
 
     def init1(self):
@@ -263,12 +497,18 @@ class CheckFilesTask(progress.MultistepTask):
             'missing': []
         }
 
+        paths = []
         for info in pkg_files:
             mypath = util.ipath(os.path.join(modpath, info['filename']))
-            if os.path.isfile(mypath):
+            paths.append(mypath if os.path.isfile(mypath) else None)
+
+        hashes = util.gen_hashes([p for p in paths if p is not None], use_cache=not self.deep)
+
+        for info, mypath in zip(pkg_files, paths):
+            if mypath is not None:
                 progress.update(checked / count, 'Checking "%s"...' % (info['filename']))
 
-                if util.gen_hash(mypath) == info['md5sum']:
+                if next(hashes)[1] == info['md5sum']:
                     success += 1
                     summary['ok'].append(info['filename'])
                 else:
@@ -315,6 +555,48 @@ class CheckFilesTask(progress.MultistepTask):
         self._results = self._check_results
 
 
+# One stage of InstallTask's pipeline. At most "limit" items are processed at the same time. The rest waits here
+# instead of in the task's work queue until a slot is released. Items are passed on to the task as
+# (stage name, arg, ...).
+class _PipelineStage(object):
+    name = None
+    limit = 1
+    _task = None
+    _queue = None
+    _active = 0
+    _lock = None
+
+    def __init__(self, task, name, limit):
+        self._task = task
+        self.name = name
+        self.limit = limit
+        self._queue = deque()
+        self._lock = threading.Lock()
+
+    def submit(self, *args):
+        with self._lock:
+            if self._active >= self.limit:
+                self._queue.append(args)
+                return
+
+            self._active += 1
+
+        self._task.add_work([(self.name,) + args])
+
+    # Has to be called by the work method which processed an item of this stage (before it returns).
+    # Otherwise the task might finish while items are still waiting here.
+    def release(self):
+        with self._lock:
+            if len(self._queue) > 0 and not self._task.aborted:
+                # The next item takes over the slot.
+                args = self._queue.popleft()
+            else:
+                self._active -= 1
+                return
+
+        self._task.add_work([(self.name,) + args])
+
+
 # TODO: Optimize, make sure all paths are relative (no mod should be able to install to C:\evil)
 # TODO: Add error messages.
 class InstallTask(progress.MultistepTask):
@@ -324,8 +606,24 @@ class InstallTask(progress.MultistepTask):
     _dls = None
     _steps = 2
     _error = False
-    _7z_lock = None
+    _stages = None
+    _tmp_dirs = None
+    _dl_dirs = None
     check_after = True
+    # The user is waiting for these.
+    priority = progress.PRIORITY_HIGH
+    # The number of archives which can be in the pipeline (downloading, waiting or being extracted) at the same time.
+    # This also limits the disk space used by downloaded archives.
+    max_in_flight = 4
+    max_verify = 2
+    if sys.platform == 'win32':
+        # Apparently I can't run multiple 7z instances on Windows. If I do, I always get the error
+        # "The archive can't be opened because it is still in use by another process."
+        # I have no idea why. It works fine on Linux and Mac OS.
+        # TODO: Is there a better solution?
+        max_extract = 1
+    else:
+        max_extract = 2
 
     def __init__(self, pkgs, mod=None, check_after=True):
         super(InstallTask, self).__init__()
@@ -334,9 +632,8 @@ class InstallTask(progress.MultistepTask):
         self._pkgs = []
         self._pkg_names = []
         self.check_after = check_after
-
-        if sys.platform == 'win32':
-            self._7z_lock = threading.Lock()
+        self._tmp_dirs = set()
+        self._dl_dirs = set()
 
         if mod is not None:
             self.mods = [mod]
@@ -358,13 +655,16 @@ class InstallTask(progress.MultistepTask):
 
     def finish(self):
         if self.aborted:
-            if self._cur_step == 1:
-                # Need to remove all those temporary directories.
-                for ar in self.get_results():
-                    try:
-                        shutil.rmtree(ar['tpath'])
-                    except:
-                        logging.exception('Failed to remove "%s"!' % ar['tpath'])
+            # Need to remove all those temporary directories.
+            for tpath in list(self._tmp_dirs):
+                try:
+                    shutil.rmtree(tpath)
+                except:
+                    logging.exception('Failed to remove "%s"!' % tpath)
+
+            # Archives which were still waiting for the verify or extract stage. Their downloads can be resumed later.
+            for tpath in list(self._dl_dirs):
+                util.PARTIAL_DOWNLOADS.release(tpath)
         elif self._error:
             msg = self.tr(
                 'An error occured during the installation of a mod. It might be partially installed.\n' +
@@ -387,12 +687,14 @@ class InstallTask(progress.MultistepTask):
         self._threads = 3
         self.add_work(self._mods)
 
+    # Posts a dict which maps (mod ID, package name, archive name) to the set of files (their orig_name) we need
+    # from that archive.
     def work1(self, mod):
         modpath = mod.folder
         mfiles = mod.get_files()
         mnames = [f['filename'] for f in mfiles] + ['knossos.bmp', 'mod.json']
 
-        archives = set()
+        archives = {}
         progress.update(0, 'Checking %s...' % mod.title)
 
         kpath = os.path.join(modpath, 'mod.json')
@@ -427,25 +729,34 @@ class InstallTask(progress.MultistepTask):
 
             itempath = util.ipath(os.path.join(modpath, info['filename']))
             if not os.path.isfile(itempath) or util.gen_hash(itempath) != info['md5sum']:
-                archives.add((mod.mid, info['package'], info['archive']))
+                key = (mod.mid, info['package'], info['archive'])
+                archives.setdefault(key, set()).add(info['orig_name'])
                 logging.debug('%s is missing for %s.', itempath, mod)
 
         self.post(archives)
 
+    # Returns the needed files per archive (see work1).
+    def _get_archives(self):
+        archives = {}
+        for a in self.get_results():
+            for key, names in a.items():
+                archives.setdefault(key, set()).update(names)
+
+        return archives
+
     def init2(self):
-        archives = set()
+        archives = self._get_archives()
         downloads = []
 
-        for a in self.get_results():
-            archives |= a
-
         for pkg in self._pkgs:
             mod = pkg.get_mod()
             for item in pkg.files.values():
-                if (mod.mid, pkg.name, item['filename']) in archives:
+                key = (mod.mid, pkg.name, item['filename'])
+                if key in archives:
                     item = item.copy()
                     item['mod'] = mod
                     item['pkg'] = pkg
+                    item['needed'] = archives[key]
                     downloads.append(item)
 
         if len(archives) == 0:
@@ -455,179 +766,447 @@ class InstallTask(progress.MultistepTask):
             self._error = True
 
         self._threads = 0
-        self.add_work(downloads)
+        self._stages = {
+            'download': _PipelineStage(self, 'download', self.max_in_flight),
+            'verify': _PipelineStage(self, 'verify', self.max_verify),
+            'extract': _PipelineStage(self, 'extract', self.max_extract)
+        }
 
-    def work2(self, archive):
-        with tempfile.TemporaryDirectory() as tpath:
-            arpath = os.path.join(tpath, archive['filename'])
-            modpath = archive['mod'].folder
+        # The download stage's slots are only released once an archive is extracted.
+        for item in downloads:
+            self._stages['download'].submit(item)
 
-            # TODO: Maybe this should be an option?
-            retries = 3
-            done = False
-            urls = list(archive['urls'])
-            random.shuffle(urls)
+    # Every archive passes through a pipeline: download -> verify (only needed for segmented downloads) -> extract.
+    # The stages run in parallel for different archives and each has its own limit (see _PipelineStage).
+    def work2(self, item):
+        stage = item[0]
 
-            while retries > 0:
-                retries -= 1
+        if stage == 'download':
+            self._download(*item[1:])
+        elif stage == 'verify':
+            self._verify(*item[1:])
+        else:
+            self._extract(*item[1:])
+
+    # Removes the archive's temporary folder and lets the next archive into the pipeline.
+    # Folders from util.PARTIAL_DOWNLOADS are kept unless installed is True so the download can be resumed later.
+    def _leave_pipeline(self, tpath, installed=False):
+        if tpath in self._dl_dirs:
+            self._dl_dirs.discard(tpath)
+            util.PARTIAL_DOWNLOADS.release(tpath, remove=installed)
+        else:
+            shutil.rmtree(tpath, ignore_errors=True)
+            self._tmp_dirs.discard(tpath)
 
-                for url in urls:
-                    progress.start_task(0, 0.97, '%s')
-                    progress.update(0, 'Ready')
+        self._stages['download'].release()
 
-                    with open(arpath, 'wb') as stream:
-                        if not util.download(url, stream):
-                            if self.aborted:
-                                return
+    def _download(self, archive, tpath=None, segmented=True):
+        if tpath is None:
+            tpath = util.PARTIAL_DOWNLOADS.acquire(archive['md5sum'])
 
-                            logging.error('Download of "%s" failed!', url)
-                            continue
+            if tpath is None:
+                tpath = tempfile.mkdtemp()
+                self._tmp_dirs.add(tpath)
+            else:
+                self._dl_dirs.add(tpath)
 
-                    progress.finish_task()
-                    progress.update(0.97, 'Checking "%s"...' % archive['filename'])
+        try:
+            self._fetch_archive(archive, tpath, segmented)
+        except:
+            # i.e. the disk is full. The archive has to leave the pipeline or the queued archives would never start.
+            logging.exception('Failed to download "%s"!', archive['filename'])
+            self._error = True
+            self._leave_pipeline(tpath)
+
+    # Hands the archive to the next stage once it's downloaded.
+    def _fetch_archive(self, archive, tpath, segmented):
+        arpath = os.path.join(tpath, archive['filename'])
+
+        # TODO: Maybe this should be an option?
+        retries = 3
+        done = False
+        urls = util.MIRROR_STATS.sort(archive['urls'])
+
+        # The state of every segment of a segmented download.
+        parts = []
+        # The number of bytes at the start of the file which we already have
+        offset = 0
+
+        if tpath in self._dl_dirs:
+            # Continue where an earlier task stopped.
+            name, parts = util.PARTIAL_DOWNLOADS.load_state(tpath)
+
+            if name is not None and name != archive['filename'] and os.path.isfile(os.path.join(tpath, name)):
+                # Another package uses the same archive under a different name.
+                os.rename(os.path.join(tpath, name), arpath)
+                name = archive['filename']
+
+            if name != archive['filename'] or not os.path.isfile(arpath):
+                parts = []
+            elif len(parts) == 0:
+                # The last attempt didn't use segments so everything we have is one finished part.
+                offset = os.path.getsize(arpath)
+                segmented = False
+
+        if segmented:
+            # Big archives are fetched in several parallel segments first. Failed segments are resumed as long as
+            # they make progress.
+            res = None
+            last_done = -1
+            for i in range(retries):
+                progress.start_task(0, 0.97, '%s')
+                res = util.download_segmented(urls, arpath, parts=parts)
+                progress.finish_task()
+
+                if parts:
+                    self._save_download_state(tpath, archive, parts)
+
+                fetched = sum(p[1] - p[0] for p in parts)
+                if res is not False or self.aborted or fetched <= last_done:
+                    break
+
+                last_done = fetched
+
+            if res:
+                self._stages['verify'].submit(archive, tpath, arpath)
+                return
+            elif res is False and self.aborted:
+                self._leave_pipeline(tpath)
+                return
+
+        # Hash the archive while it's downloaded so we don't have to read it again.
+        # The partial file and the hasher are kept between attempts so an interrupted download is resumed
+        # (using another mirror if necessary) instead of starting over.
+        hasher = hashlib.md5()
+        if parts:
+            # Keep the part of the failed segmented download which is complete.
+            offset = util.get_segmented_prefix(parts)
+
+        if offset > 0:
+            logging.info('Continuing "%s" at %s.', archive['filename'], util.format_bytes(offset))
+
+            with open(arpath, 'r+b') as stream:
+                stream.truncate(offset)
 
-                    if util.gen_hash(arpath) == archive['md5sum']:
-                        done = True
-                        retries = 0
+                while True:
+                    chunk = stream.read(256 * 1024)
+                    if not chunk:
+                        break
+
+                    hasher.update(chunk)
+
+            if hasher.hexdigest() == archive['md5sum']:
+                # The download finished but the archive wasn't installed.
+                done = True
+                retries = 0
+        else:
+            open(arpath, 'wb').close()
+
+        self._save_download_state(tpath, archive, [])
+
+        while retries > 0:
+            retries -= 1
+
+            for url in urls:
+                progress.start_task(0, 0.97, '%s')
+                progress.update(0, 'Ready')
+
+                with open(arpath, 'ab') as stream:
+                    stream.seek(0, os.SEEK_END)
+                    res = util.download(url, stream, hasher=hasher)
+
+                progress.finish_task()
+
+                if not res:
+                    if self.aborted:
+                        self._leave_pipeline(tpath)
+                        return
+
+                    logging.error('Download of "%s" failed!', url)
+                    continue
+
+                if hasher.hexdigest() == archive['md5sum']:
+                    done = True
+                    retries = 0
+                    break
+                else:
+                    logging.error('File "%s" is corrupted!', url)
+
+                    # Start over.
+                    open(arpath, 'wb').close()
+                    hasher = hashlib.md5()
+
+        if not done:
+            logging.error('Missing file "%s"!', archive['filename'])
+            self._error = True
+            self._leave_pipeline(tpath)
+            return
+
+        if self.aborted:
+            self._leave_pipeline(tpath)
+            return
+
+        # We already checked the hash so we can skip the verify stage.
+        self._stages['extract'].submit(archive, tpath, arpath)
+
+    def _save_download_state(self, tpath, archive, parts):
+        if tpath in self._dl_dirs:
+            util.PARTIAL_DOWNLOADS.save_state(tpath, archive['filename'], parts)
+
+    def _verify(self, archive, tpath, arpath):
+        try:
+            progress.update(0, 'Checking "%s"...' % archive['filename'])
+
+            if util.gen_hash(arpath, use_cache=False) == archive['md5sum']:
+                self._stages['extract'].submit(archive, tpath, arpath)
+            else:
+                logging.error('File "%s" is corrupted!', archive['filename'])
+
+                # Download it again without segments. The archive keeps its place in the pipeline.
+                open(arpath, 'wb').close()
+                self._save_download_state(tpath, archive, [])
+                self.add_work([('download', archive, tpath, False)])
+        except:
+            logging.exception('Failed to check "%s"!', archive['filename'])
+            self._error = True
+            self._leave_pipeline(tpath)
+        finally:
+            self._stages['verify'].release()
+
+    def _extract(self, archive, tpath, arpath):
+        try:
+            if not self.aborted:
+                self._install_archive(archive, tpath, arpath)
+        finally:
+            self._stages['extract'].release()
+            self._leave_pipeline(tpath, installed=True)
+
+    def _install_archive(self, archive, tpath, arpath):
+        modpath = archive['mod'].folder
+
+        if archive['is_archive']:
+            res = self._extract_in_process(archive, arpath, modpath)
+            if res is not None:
+                if not res:
+                    self._error = True
+
+                return
+
+            # We can't handle this archive ourselves, let 7z extract it into a temporary folder.
+            cpath = os.path.join(tpath, 'content')
+            os.mkdir(cpath)
+
+            needed_files, partial = self._get_needed_files(archive)
+            done = False
+
+            progress.update(0.98, 'Extracting %s...' % archive['filename'])
+            logging.debug('Extracting %s into %s', archive['filename'], modpath)
+
+            if partial:
+                # Only extract the files we're missing.
+                res = util.extract_archive(arpath, cpath, files=[item['orig_name'] for item in needed_files])
+                if not res:
+                    # The names might not match the archive exactly (i.e. "./" prefixes in tar files).
+                    logging.warning('Partial extraction of "%s" failed, extracting everything.',
+                                    archive['filename'])
+                    res = util.extract_archive(arpath, cpath, overwrite=True)
+            else:
+                res = util.extract_archive(arpath, cpath)
+
+            if res:
+                done = True
+                # Look for missing files
+                for item in needed_files:
+                    src_path = os.path.join(cpath, item['orig_name'])
+
+                    if not os.path.isfile(src_path):
+                        logging.warning('Missing file "%s" from archive "%s" for package "%s" (%s)!',
+                                        item['orig_name'], archive['filename'], archive['pkg'].name, archive['mod'].title)
+
+                        done = False
                         break
-                    else:
-                        logging.error('File "%s" is corrupted!', url)
 
             if not done:
-                logging.error('Missing file "%s"!', archive['filename'])
+                logging.error('Failed to unpack archive "%s" for package "%s" (%s)!',
+                              archive['filename'], archive['pkg'].name, archive['mod'].title)
+                shutil.rmtree(cpath, ignore_errors=True)
                 self._error = True
                 return
 
-            if self.aborted:
-                return
+            for item in needed_files:
+                src_path = os.path.join(cpath, item['orig_name'])
+                dest_path = util.ipath(os.path.join(modpath, item['filename']))
+
+                try:
+                    dparent = os.path.dirname(dest_path)
+                    if not os.path.isdir(dparent):
+                        os.makedirs(dparent)
+
+                    # This move might fail on Windows with Permission Denied errors.
+                    # "[WinError 32] The process cannot access the file because it is being used by another process"
+                    # Just try it again several times to account of AV scanning and similar problems.
+                    tries = 5
+                    while tries > 0:
+                        try:
+                            shutil.move(src_path, dest_path)
+                            break
+                        except Exception as e:
+                            logging.warning('Initial move for "%s" failed (%s)!' % (src_path, str(e)))
+                            tries -= 1
 
-            if archive['is_archive']:
-                cpath = os.path.join(tpath, 'content')
-                os.mkdir(cpath)
+                            if tries == 0:
+                                raise
+                            else:
+                                time.sleep(1)
 
-                needed_files = filter(lambda item: item['archive'] == archive['filename'], archive['pkg'].filelist)
-                done = False
+                    # The archive's checksum matched so this file should be fine.
+                    util.HASH_CACHE.remember(dest_path, item['md5sum'])
+                except:
+                    logging.exception('Failed to move file "%s" from archive "%s" for package "%s" (%s) to its destination %s!',
+                                      src_path, archive['filename'], archive['pkg'].name, archive['mod'].title, dest_path)
+                    self._error = True
 
-                if sys.platform == 'win32':
-                    # Apparently I can't run multiple 7z instances on Windows. If I do, I always get the error
-                    # "The archive can't be opened because it is still in use by another process."
-                    # I have no idea why. It works fine on Linux and Mac OS.
-                    # TODO: Is there a better solution?
+            # Copy the remaining empty dirs and symlinks.
+            for path, dirs, files in os.walk(cpath):
+                path = os.path.relpath(path, cpath)
 
-                    progress.update(0.98, 'Waiting...')
-                    self._7z_lock.acquire()
+                for name in dirs:
+                    src_path = os.path.join(cpath, path, name)
+                    dest_path = util.ipath(os.path.join(modpath, path, name))
 
-                progress.update(0.98, 'Extracting %s...' % archive['filename'])
-                logging.debug('Extracting %s into %s', archive['filename'], modpath)
+                    if os.path.islink(src_path):
+                        if not os.path.lexists(dest_path):
+                            linkto = os.readlink(src_path)
+                            os.symlink(linkto, dest_path)
+                    elif not os.path.exists(dest_path):
+                        os.makedirs(dest_path)
 
-                if util.extract_archive(arpath, cpath):
-                    done = True
-                    # Look for missing files
-                    for item in needed_files:
-                        src_path = os.path.join(cpath, item['orig_name'])
+                for name in files:
+                    src_path = os.path.join(cpath, path, name)
 
-                        if not os.path.isfile(src_path):
-                            logging.warning('Missing file "%s" from archive "%s" for package "%s" (%s)!',
-                                            item['orig_name'], archive['filename'], archive['pkg'].name, archive['mod'].title)
+                    if os.path.islink(src_path):
+                        dest_path = util.ipath(os.path.join(modpath, path, name))
+                        if not os.path.lexists(dest_path):
+                            linkto = os.readlink(src_path)
+                            os.symlink(linkto, dest_path)
+        else:
+            for item in archive['pkg'].filelist:
+                if item['archive'] != archive['filename']:
+                    continue
+
+                dest_path = util.ipath(os.path.join(modpath, archive['filename']))
 
-                            done = False
+                try:
+                    dparent = os.path.dirname(dest_path)
+                    if not os.path.isdir(dparent):
+                        os.makedirs(dparent)
+
+                    tries = 3
+                    while tries > 0:
+                        try:
+                            shutil.move(arpath, dest_path)
                             break
+                        except Exception as e:
+                            logging.warning('Initial move for "%s" failed (%s)!' % (src_path, str(e)))
+                            tries -= 1
 
-                if sys.platform == 'win32':
-                    self._7z_lock.release()
+                            if tries == 0:
+                                raise
+                            else:
+                                time.sleep(1)
 
-                if not done:
-                    logging.error('Failed to unpack archive "%s" for package "%s" (%s)!',
-                                  archive['filename'], archive['pkg'].name, archive['mod'].title)
-                    shutil.rmtree(cpath, ignore_errors=True)
+                    util.HASH_CACHE.remember(dest_path, archive['md5sum'])
+                except:
+                    logging.exception('Failed to move file "%s" from archive "%s" for package "%s" (%s) to its destination %s!',
+                                      arpath, archive['filename'], archive['pkg'].name, archive['mod'].title, dest_path)
                     self._error = True
-                    return
 
-                for item in archive['pkg'].filelist:
-                    if item['archive'] != archive['filename']:
-                        continue
 
-                    src_path = os.path.join(cpath, item['orig_name'])
-                    dest_path = util.ipath(os.path.join(modpath, item['filename']))
+    # Returns the file list entries we need from archive and whether that's only a part of the archive's files.
+    def _get_needed_files(self, archive):
+        items = [item for item in archive['pkg'].filelist if item['archive'] == archive['filename']]
+        needed = [item for item in items if item['orig_name'] in archive['needed']]
 
-                    try:
-                        dparent = os.path.dirname(dest_path)
-                        if not os.path.isdir(dparent):
-                            os.makedirs(dparent)
-
-                        # This move might fail on Windows with Permission Denied errors.
-                        # "[WinError 32] The process cannot access the file because it is being used by another process"
-                        # Just try it again several times to account of AV scanning and similar problems.
-                        tries = 5
-                        while tries > 0:
-                            try:
-                                shutil.move(src_path, dest_path)
-                                break
-                            except Exception as e:
-                                logging.warning('Initial move for "%s" failed (%s)!' % (src_path, str(e)))
-                                tries -= 1
-
-                                if tries == 0:
-                                    raise
-                                else:
-                                    time.sleep(1)
-                    except:
-                        logging.exception('Failed to move file "%s" from archive "%s" for package "%s" (%s) to its destination %s!',
-                                          src_path, archive['filename'], archive['pkg'].name, archive['mod'].title, dest_path)
-                        self._error = True
+        return needed, len(needed) < len(items)
 
-                # Copy the remaining empty dirs and symlinks.
-                for path, dirs, files in os.walk(cpath):
-                    path = os.path.relpath(path, cpath)
+    # Extracts the files we need from the archive straight into the mod folder. Returns None if the archive has to be
+    # extracted with 7z instead.
+    def _extract_in_process(self, archive, arpath, modpath):
+        needed, partial = self._get_needed_files(archive)
+        members = {}
+        for item in needed:
+            members[item['orig_name']] = util.ipath(os.path.join(modpath, item['filename']))
 
-                    for name in dirs:
-                        src_path = os.path.join(cpath, path, name)
-                        dest_path = util.ipath(os.path.join(modpath, path, name))
+        progress.update(0.98, 'Extracting %s...' % archive['filename'])
+        logging.debug('Extracting %d files from %s into %s', len(members), archive['filename'], modpath)
 
-                        if os.path.islink(src_path):
-                            if not os.path.lexists(dest_path):
-                                linkto = os.readlink(src_path)
-                                os.symlink(linkto, dest_path)
-                        elif not os.path.exists(dest_path):
-                            os.makedirs(dest_path)
-
-                    for name in files:
-                        src_path = os.path.join(cpath, path, name)
-
-                        if os.path.islink(src_path):
-                            dest_path = util.ipath(os.path.join(modpath, path, name))
-                            if not os.path.lexists(dest_path):
-                                linkto = os.readlink(src_path)
-                                os.symlink(linkto, dest_path)
-            else:
-                for item in archive['pkg'].filelist:
-                    if item['archive'] != archive['filename']:
-                        continue
+        progress.start_task(0.98, 0.02)
+        try:
+            # The folder structure only matters for full installs and leaving it out lets us stop reading the archive
+            # as soon as we have the files we need.
+            hashes = util.extract_files(arpath, members, None if partial else modpath, modpath)
+        except:
+            logging.exception('Failed to unpack archive "%s" for package "%s" (%s)!',
+                              archive['filename'], archive['pkg'].name, archive['mod'].title)
+            return False
+        finally:
+            progress.finish_task()
 
-                    dest_path = util.ipath(os.path.join(modpath, archive['filename']))
+        if hashes is None:
+            return None
 
-                    try:
-                        dparent = os.path.dirname(dest_path)
-                        if not os.path.isdir(dparent):
-                            os.makedirs(dparent)
-
-                        tries = 3
-                        while tries > 0:
-                            try:
-                                shutil.move(arpath, dest_path)
-                                break
-                            except Exception as e:
-                                logging.warning('Initial move for "%s" failed (%s)!' % (src_path, str(e)))
-                                tries -= 1
-
-                                if tries == 0:
-                                    raise
-                                else:
-                                    time.sleep(1)
-                    except:
-                        logging.exception('Failed to move file "%s" from archive "%s" for package "%s" (%s) to its destination %s!',
-                                          arpath, archive['filename'], archive['pkg'].name, archive['mod'].title, dest_path)
-                        self._error = True
+        done = True
+        for item in needed:
+            chksum = hashes.get(item['orig_name'])
+
+            if chksum is None:
+                logging.warning('Missing file "%s" from archive "%s" for package "%s" (%s)!',
+                                item['orig_name'], archive['filename'], archive['pkg'].name, archive['mod'].title)
+                done = False
+            elif chksum != item['md5sum']:
+                # CheckTask will report this file as corrupted.
+                logging.warning('File "%s" from archive "%s" for package "%s" (%s) has the wrong checksum!',
+                                item['orig_name'], archive['filename'], archive['pkg'].name, archive['mod'].title)
+
+        return done
+
+
+# Restores the files which a CheckFilesTask reported as corrupted or missing. The check's results replace the first
+# step of the InstallTask so nothing is hashed again. Only the archives containing damaged files are downloaded and
+# only those files are extracted from them.
+class RepairTask(InstallTask):
+    _check_results = None
+
+    def __init__(self, mod, check_results, check_after=True):
+        self._check_results = check_results
+
+        pkgs = []
+        for pkg, s, c, info in check_results:
+            if pkg is not None and (info['corrupt'] or info['missing']):
+                pkgs.append(pkg)
+
+        super(RepairTask, self).__init__(pkgs, mod, check_after)
+        self.title = 'Repairing %s...' % mod.title
+
+    def init1(self):
+        # We already know which files are damaged so there's nothing to do here.
+        pass
+
+    def _get_archives(self):
+        archives = {}
+
+        for pkg, s, c, info in self._check_results:
+            if pkg is None:
+                continue
+
+            mid = pkg.get_mod().mid
+            damaged = set(info['corrupt']) | set(info['missing'])
+
+            for item in pkg.filelist:
+                if item['filename'] in damaged:
+                    archives.setdefault((mid, pkg.name, item['archive']), set()).add(item['orig_name'])
+
+        return archives
 
 
 # TODO: make sure all paths are relative (no mod should be able to install to C:\evil)
@@ -635,6 +1214,7 @@ class UninstallTask(progress.MultistepTask):
     _pkgs = None
     _steps = 2
     check_after = True
+    priority = progress.PRIORITY_HIGH
 
     def __init__(self, pkgs, check_after=True):
         self._pkgs = []
@@ -664,6 +1244,7 @@ class UninstallTask(progress.MultistepTask):
                 logging.warning('File "%s" for mod "%s" (%s) is missing during uninstall!', item['filename'], mod.title, mod.mid)
             else:
                 os.unlink(path)
+                util.HASH_CACHE.forget(path)
 
     def init2(self):
         mods = set()
@@ -781,6 +1362,7 @@ class UpdateTask(InstallTask):
 
 class GOGExtractTask(progress.Task):
     can_abort = False
+    resource = progress.RESOURCE_CPU
 
     def __init__(self, gog_path, dest_path):
         super(GOGExtractTask, self).__init__()
@@ -27,13 +27,18 @@ import json
 import random
 import functools
 import glob
+import shutil
+import sqlite3
+import zipfile
+import tarfile
 import semantic_version
 import requests
 from collections import OrderedDict
-from threading import Condition, Event
+from threading import Condition, Event, Lock, RLock, Thread, local
 from collections import deque
 
-from . import center, progress
+from . import center, progress, parallel
+from .parallel import stat_key
 from .qt import QtCore
 
 try:
@@ -41,6 +46,13 @@ try:
 except ImportError:
     Image = None
 
+try:
+    import py7zr
+    import py7zr.io
+    import py7zr.exceptions
+except ImportError:
+    py7zr = None
+
 SEVEN_PATH = '7z'
 # Copied from http://sourceforge.net/p/sevenzipjbind/code/ci/master/tree/jbinding-java/src/net/sf/sevenzipjbinding/ArchiveFormat.java
 # to conform to the FSO Installer.
@@ -99,14 +111,22 @@ USER_AGENTS = (
     'Opera/9.80 (Windows NT 6.1; U; en) Presto/2.8.131 Version/11.10',
     'Opera/9.80 (Windows NT 6.1; WOW64) Presto/2.12.388 Version/12.17'
 )
-HTTP_SESSION = requests.Session()
-HTTP_SESSION.verify = True
+# Files smaller than this are never split up by download_segmented().
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024
 QUIET = not center.DEBUG
 QUIET_EXC = False
-HASH_CACHE = dict()
+HASH_CACHE = None
+HTTP_CACHE = None
+PARTIAL_DOWNLOADS = None
+SPEC_CACHE = None
 _HAS_CONVERT = None
 _HAS_TAR = None
 DL_POOL = None
+MIRROR_STATS = None
+_HTTP_ADAPTER = None
+_HTTP_LOCAL = local()
+_HOST_SLOTS = {}
+_HOST_LOCK = Lock()
 _DL_CANCEL = Event()
 _DL_CANCEL.clear()
 translate = QtCore.QCoreApplication.translate
@@ -280,6 +300,406 @@ class SpeedCalc(object):
         return max(sum(self.speeds) / len(self.speeds), 0.1)
 
 
+# Persistent checksum cache. Entries are keyed by path and are only valid as long as the file's
+# size, mtime and inode (see stat_key()) stay the same. Outdated entries are replaced or dropped when they're
+# looked up and prune() sweeps a few of the remaining ones at a time.
+class HashCache(object):
+    commit_interval = 500
+    _path = None
+    _conn = None
+    _lock = None
+    _pending = 0
+    _prune_pos = 0
+
+    def __init__(self, path=None):
+        self._lock = RLock()
+        self._path = path
+
+    def open(self, path):
+        with self._lock:
+            self.close()
+            self._path = path
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+                self._pending = 0
+
+    def _get_conn(self):
+        if self._conn is None:
+            path = self._path or ':memory:'
+
+            try:
+                self._conn = self._connect(path)
+            except sqlite3.Error:
+                logging.exception('Failed to open the hash cache "%s"! Using a temporary one instead.', path)
+                self._conn = self._connect(':memory:')
+
+        return self._conn
+
+    def _connect(self, path):
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, ' +
+                     'inode INTEGER, md5 TEXT)')
+        conn.commit()
+        return conn
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self._conn.commit()
+            self._pending = 0
+
+    def get(self, path, key):
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute('SELECT size, mtime, inode, md5 FROM hashes WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return None
+
+            if tuple(row[:3]) != tuple(key):
+                conn.execute('DELETE FROM hashes WHERE path = ?', (path,))
+                self._changed()
+                return None
+
+            return row[3]
+
+    def set(self, path, key, chksum):
+        with self._lock:
+            self._get_conn().execute('INSERT OR REPLACE INTO hashes (path, size, mtime, inode, md5) VALUES (?, ?, ?, ?, ?)',
+                                     (path, key[0], key[1], key[2], chksum))
+            self._changed()
+
+    # Stores a checksum we already know (i.e. because it's listed for a verified archive) so the file
+    # doesn't have to be read again during the next check.
+    def remember(self, path, chksum):
+        path = os.path.abspath(path)
+        self.set(path, stat_key(os.stat(path)), chksum)
+
+    def forget(self, path):
+        with self._lock:
+            self._get_conn().execute('DELETE FROM hashes WHERE path = ?', (os.path.abspath(path),))
+            self._changed()
+
+    def clear(self):
+        with self._lock:
+            self._get_conn().execute('DELETE FROM hashes')
+            self._conn.commit()
+            self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            if self._conn is not None and self._pending > 0:
+                self._conn.commit()
+                self._pending = 0
+
+    # Checks up to "limit" entries (continuing where the last call stopped) and removes those whose files
+    # were changed or deleted.
+    def prune(self, limit=500):
+        with self._lock:
+            conn = self._get_conn()
+            rows = conn.execute('SELECT rowid, path, size, mtime, inode FROM hashes WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                (self._prune_pos, limit)).fetchall()
+
+            if len(rows) < limit:
+                # Start from the beginning next time.
+                self._prune_pos = 0
+            else:
+                self._prune_pos = rows[-1][0]
+
+            stale = []
+            for row in rows:
+                try:
+                    key = stat_key(os.stat(row[1]))
+                except OSError:
+                    key = None
+
+                if key is None or key != tuple(row[2:]):
+                    stale.append((row[0],))
+
+            if len(stale) > 0:
+                conn.executemany('DELETE FROM hashes WHERE rowid = ?', stale)
+                conn.commit()
+                self._pending = 0
+
+            return len(stale)
+
+
+# Keeps track of the throughput and reliability of every download host so that we can try the best mirror first.
+class MirrorStats(object):
+    # How often sort() puts a random mirror first to keep the scores of the others fresh.
+    explore_chance = 0.1
+    # Transfers smaller than this mostly measure latency and are ignored.
+    min_sample = 256 * 1024
+    # We only remember this many hosts. The ones we haven't used for the longest time are dropped first.
+    max_hosts = 100
+    # Hosts we haven't used for this long (in seconds) aren't saved.
+    max_age = 90 * 24 * 60 * 60
+    _hosts = None
+    _lock = None
+
+    def __init__(self):
+        self._hosts = {}
+        self._lock = RLock()
+
+    def load(self, data):
+        now = time.time()
+
+        with self._lock:
+            self._hosts = {}
+            for host, info in data.items():
+                if isinstance(info, list) and len(info) == 3:
+                    # Saved by an older version without the last use
+                    self._hosts[host] = info + [now]
+                elif isinstance(info, list) and len(info) == 4:
+                    self._hosts[host] = info
+
+            self._prune()
+
+    def dump(self):
+        now = time.time()
+
+        with self._lock:
+            return dict((host, info[:]) for host, info in self._hosts.items() if now - info[3] < self.max_age)
+
+    def _prune(self):
+        if len(self._hosts) > self.max_hosts:
+            hosts = sorted(self._hosts.items(), key=lambda item: item[1][3], reverse=True)
+            self._hosts = dict(hosts[:self.max_hosts])
+
+    # Call this once per download (and failed request). size and duration should cover the whole transfer, otherwise
+    # the host's speed is underestimated.
+    def record(self, link, size=0, duration=0, failed=False):
+        host = get_host(link)
+
+        with self._lock:
+            # [average speed in bytes/s, successes, failures, last use]. Old results decay so hosts can recover.
+            info = self._hosts.get(host)
+            if info is None:
+                info = self._hosts[host] = [0, 0, 0, time.time()]
+                self._prune()
+
+            info[1] *= 0.9
+            info[2] *= 0.9
+            info[3] = time.time()
+
+            if failed:
+                info[2] += 1
+            else:
+                info[1] += 1
+
+                if size >= self.min_sample and duration > 0:
+                    speed = size / duration
+                    if info[0] == 0:
+                        info[0] = speed
+                    else:
+                        info[0] = 0.7 * info[0] + 0.3 * speed
+
+    def get_score(self, link):
+        with self._lock:
+            info = self._hosts.get(get_host(link))
+            if info is None:
+                return None
+            elif info[0] == 0:
+                # We don't know the speed yet. Only give the host the benefit of the doubt if it hasn't failed us.
+                return None if info[2] < 0.5 else 0
+
+            fail_rate = info[2] / (info[1] + info[2])
+            return info[0] * (1 - fail_rate) ** 2
+
+    # Returns the passed links ordered from the best to the worst mirror.
+    def sort(self, links):
+        scores = [self.get_score(link) for link in links]
+        known = [s for s in scores if s is not None]
+
+        # Unknown mirrors are treated like the best known mirror so that they get a chance.
+        best = max(known) if known else 0
+        ranked = sorted(zip(scores, range(len(links))), key=lambda s: best if s[0] is None else s[0], reverse=True)
+        links = [links[i] for s, i in ranked]
+
+        if len(links) > 1 and random.random() < self.explore_chance:
+            links.insert(0, links.pop(random.randrange(1, len(links))))
+
+        return links
+
+
+# Stores the responses of metadata requests (repositories) together with their ETag and Last-Modified headers
+# so get_cached() can ask the server whether they changed instead of downloading them again.
+# Every entry is kept in a separate JSON file in the cache directory.
+class HttpCache(object):
+    _path = None
+    _entries = None
+    _lock = None
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = RLock()
+
+    def open(self, path):
+        with self._lock:
+            self._path = path
+            self._entries = {}
+
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    logging.exception('Failed to create the HTTP cache "%s"!', path)
+                    self._path = None
+
+    def _get_file(self, link):
+        return os.path.join(self._path, hashlib.md5(link.encode('utf8')).hexdigest() + '.json')
+
+    def get(self, link):
+        with self._lock:
+            if link not in self._entries and self._path is not None:
+                path = self._get_file(link)
+                if os.path.isfile(path):
+                    try:
+                        with open(path, 'r') as stream:
+                            entry = json.load(stream)
+
+                        if entry.get('link') == link:
+                            self._entries[link] = entry
+                    except:
+                        logging.exception('Failed to read the cached response for "%s"!', link)
+
+            return self._entries.get(link)
+
+    def set(self, link, entry):
+        with self._lock:
+            entry['link'] = link
+            self._entries[link] = entry
+
+            if self._path is not None:
+                path = self._get_file(link)
+                try:
+                    with open(path + '.tmp', 'w') as stream:
+                        json.dump(entry, stream)
+
+                    if os.path.isfile(path):
+                        os.unlink(path)
+
+                    os.rename(path + '.tmp', path)
+                except:
+                    logging.exception('Failed to save the response for "%s"!', link)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+            if self._path is not None:
+                for path in glob.glob(os.path.join(self._path, '*.json')):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        logging.exception('Failed to remove "%s"!', path)
+
+
+# Keeps the partial files of interrupted downloads so they can be resumed by later tasks (or after a restart).
+# Every archive gets a folder named after its checksum. The folder contains the partial file and a state.json
+# which stores the file's name and the state of its segments (see download_segmented()).
+class PartialDownloads(object):
+    # Folders which weren't touched for this long (in seconds) are removed by open().
+    max_age = 14 * 24 * 60 * 60
+    _path = None
+    _used = None
+    _lock = None
+
+    def __init__(self):
+        self._used = set()
+        self._lock = Lock()
+
+    def open(self, path):
+        with self._lock:
+            self._path = path
+
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    logging.exception('Failed to create the download folder "%s"!', path)
+                    self._path = None
+                    return
+
+        self.prune()
+
+    # Returns the folder for the archive with the given checksum or None if we can't keep partial files (or another
+    # task is using the folder right now). Call release() once you're done with it.
+    def acquire(self, chksum):
+        with self._lock:
+            if self._path is None or not re.match(r'^[0-9a-fA-F]+$', chksum or ''):
+                return None
+
+            path = os.path.join(self._path, chksum.lower())
+            if path in self._used:
+                return None
+
+            try:
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                else:
+                    # Keeps prune() from removing folders which are in use.
+                    os.utime(path, None)
+            except OSError:
+                logging.exception('Failed to create the download folder "%s"!', path)
+                return None
+
+            self._used.add(path)
+            return path
+
+    # Returns (name, parts) or (None, []) if nothing was saved for this folder.
+    def load_state(self, path):
+        try:
+            with open(os.path.join(path, 'state.json'), 'r') as stream:
+                state = json.load(stream)
+
+            return state['filename'], [list(p) for p in state['parts']]
+        except (IOError, OSError):
+            pass
+        except:
+            logging.exception('Failed to read the download state in "%s"!', path)
+
+        return None, []
+
+    # parts is the list from download_segmented(). An empty list means that the file was downloaded
+    # sequentially (the whole file is the finished part).
+    def save_state(self, path, name, parts):
+        try:
+            with open(os.path.join(path, 'state.json'), 'w') as stream:
+                json.dump({'filename': name, 'parts': parts}, stream)
+        except:
+            logging.exception('Failed to save the download state in "%s"!', path)
+
+    # Removes the folder if remove is True (i.e. because its archive was installed).
+    def release(self, path, remove=False):
+        with self._lock:
+            self._used.discard(path)
+
+        if remove:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def prune(self):
+        with self._lock:
+            if self._path is None:
+                return
+
+            limit = time.time() - self.max_age
+            for name in os.listdir(self._path):
+                path = os.path.join(self._path, name)
+
+                try:
+                    if path not in self._used and os.path.isdir(path) and os.stat(path).st_mtime < limit:
+                        logging.debug('Removing the old partial download "%s".', path)
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError:
+                    logging.exception('Failed to check "%s"!', path)
+
+
 def call(*args, **kwargs):
     if sys.platform.startswith('win') and not center.DEBUG:
         # Provide the called program with proper I/O on Windows.
@@ -342,9 +762,55 @@ def format_bytes(value):
     return str(round(value)) + ' ' + unit
 
 
-def get(link, headers=None, random_ua=False, raw=False):
-    global HTTP_SESSION
+def get_host(link):
+    info = re.match(r'[a-zA-Z]+://([^/]+)', link)
+    return info.group(1).lower() if info else link
+
+
+# (Re)creates the connection pools. Has to be called whenever max_downloads or download_segments change.
+def init_http():
+    global _HTTP_ADAPTER
+
+    # Every segment of every download needs its own connection and we want a few spare ones
+    # for metadata requests (repos, logos, ...) to avoid reconnecting all the time.
+    size = max(center.settings['max_downloads'] * max(center.settings['download_segments'], 1), 10)
+
+    _HTTP_ADAPTER = requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=size)
+    with _HOST_LOCK:
+        for slots in _HOST_SLOTS.values():
+            slots.set_capacity(center.settings['max_host_downloads'])
+
+
+# requests.Session isn't thread-safe so every thread gets its own session. The connection pools are kept in
+# the adapter which is shared by all sessions which means that connections are reused across threads.
+def get_session():
+    session = getattr(_HTTP_LOCAL, 'session', None)
+    if session is None:
+        session = _HTTP_LOCAL.session = requests.Session()
+        session.verify = True
+        session.headers['User-Agent'] = get_user_agent()
 
+    if getattr(_HTTP_LOCAL, 'adapter', None) is not _HTTP_ADAPTER:
+        session.mount('http://', _HTTP_ADAPTER)
+        session.mount('https://', _HTTP_ADAPTER)
+        _HTTP_LOCAL.adapter = _HTTP_ADAPTER
+
+    return session
+
+
+# Limits the number of concurrent downloads from the host behind link.
+def get_host_slots(link):
+    host = get_host(link)
+
+    with _HOST_LOCK:
+        slots = _HOST_SLOTS.get(host)
+        if slots is None:
+            slots = _HOST_SLOTS[host] = ResizableSemaphore(center.settings['max_host_downloads'])
+
+        return slots
+
+
+def get(link, headers=None, random_ua=False, raw=False):
     if random_ua:
         if headers is None:
             headers = {}
@@ -353,7 +819,7 @@ def get(link, headers=None, random_ua=False, raw=False):
 
     result = None
     try:
-        result = HTTP_SESSION.get(link, headers=headers)
+        result = get_session().get(link, headers=headers)
         if result.status_code == 304:
             return 304
         elif result.status_code != 200:
@@ -371,9 +837,38 @@ def get(link, headers=None, random_ua=False, raw=False):
         return result.text
 
 
-def post(link, data, headers=None, random_ua=False):
-    global HTTP_SESSION
+# Like get() but the response is cached in HTTP_CACHE and revalidated with a conditional request.
+# Returns (final URL, text, changed) or None if the request failed. changed is False if the server
+# responded with "304 Not Modified" or sent the same content again.
+def get_cached(link):
+    entry = HTTP_CACHE.get(link)
+    headers = {}
 
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    result = get(link, headers=headers, raw=True)
+    if result == 304 and entry is not None:
+        return entry['url'], entry['text'], False
+    elif result is None or result == 304:
+        return None
+
+    changed = entry is None or entry['text'] != result.text
+    HTTP_CACHE.set(link, {
+        'url': result.url,
+        'etag': result.headers.get('etag'),
+        'last_modified': result.headers.get('last-modified'),
+        'text': result.text
+    })
+
+    return result.url, result.text, changed
+
+
+def post(link, data, headers=None, random_ua=False):
     if random_ua:
         if headers is None:
             headers = {}
@@ -382,7 +877,7 @@ def post(link, data, headers=None, random_ua=False):
 
     result = None
     try:
-        result = HTTP_SESSION.post(link, data=data, headers=headers)
+        result = get_session().post(link, data=data, headers=headers)
         if result.status_code != 200:
             result.raise_for_status()
     except:
@@ -395,8 +890,11 @@ def post(link, data, headers=None, random_ua=False):
     return result.text
 
 
-def download(link, dest, headers=None, random_ua=False):
-    global HTTP_SESSION, DL_POOL, _DL_CANCEL
+# If you pass a hashlib object as hasher, it's fed every chunk that's written to dest.
+# If dest already contains data (dest.tell() > 0), the download resumes at that offset. In that case, hasher has
+# to contain the data which is already in dest.
+def download(link, dest, headers=None, random_ua=False, hasher=None):
+    global DL_POOL, _DL_CANCEL
 
     if random_ua:
         if headers is None:
@@ -404,58 +902,280 @@ def download(link, dest, headers=None, random_ua=False):
 
         headers['User-Agent'] = get_user_agent(True)
 
-    with DL_POOL:
+    offset = dest.tell()
+    if offset > 0:
+        headers = headers.copy() if headers else {}
+        headers['Range'] = 'bytes=%d-' % offset
+
+    # Always acquire DL_POOL before the host slot (like _download_segment()). The other order could deadlock.
+    with DL_POOL, get_host_slots(link):
         if _DL_CANCEL.is_set():
             return False
 
-        logging.info('Downloading "%s"...', link)
+        if offset > 0:
+            logging.info('Resuming "%s" at %s...', link, format_bytes(offset))
+        else:
+            logging.info('Downloading "%s"...', link)
 
         try:
-            result = HTTP_SESSION.get(link, headers=headers, stream=True)
+            result = get_session().get(link, headers=headers, stream=True)
         except requests.exceptions.ConnectionError:
             logging.exception('Failed to load "%s"!', link)
-            return False
-
-        if result.status_code == 304:
-            return 304
-        elif result.status_code == 206:
-            # sectorgame.com/fsfiles/ always returns code 206 which makes this necessary.
-            logging.warning('"%s" returned "206 Partial Content", the downloaded file might be incomplete.', link)
-        elif result.status_code != 200:
-            logging.error('Failed to load "%s"! (%d %s)', link, result.status_code, result.reason)
+            MIRROR_STATS.record(link, failed=True)
             return False
 
         try:
-            size = float(result.headers.get('content-length', 0))
-        except:
-            logging.exception('Failed to parse Content-Length header!')
-            size = 1024 ** 4  # = 1 TB
+            # The number of bytes at the start of the response which we already have.
+            skip = 0
+
+            if result.status_code == 304:
+                return 304
+            elif result.status_code == 206:
+                if offset > 0:
+                    info = re.match(r'bytes (\d+)-', result.headers.get('content-range', ''))
+                    if not info or int(info.group(1)) > offset:
+                        logging.error('"%s" returned the wrong range! (%s)', link, result.headers.get('content-range'))
+                        return False
+
+                    skip = offset - int(info.group(1))
+                else:
+                    # sectorgame.com/fsfiles/ always returns code 206 which makes this necessary.
+                    logging.warning('"%s" returned "206 Partial Content", the downloaded file might be incomplete.', link)
+            elif result.status_code == 416 and offset > 0:
+                # We already have the whole file.
+                return True
+            elif result.status_code != 200:
+                logging.error('Failed to load "%s"! (%d %s)', link, result.status_code, result.reason)
+                MIRROR_STATS.record(link, failed=True)
+                return False
+            elif offset > 0:
+                logging.info('"%s" doesn\'t support resuming. Skipping the first %s.', link, format_bytes(offset))
+                skip = offset
 
-        try:
-            start = dest.tell()
-            sc = SpeedCalc()
-            for chunk in result.iter_content(512 * 1024):
-                dest.write(chunk)
-
-                if sc.push(dest.tell()) != -1:
-                    if size > 0:
-                        by_done = dest.tell() - start
-                        speed = sc.get_speed()
-                        p = by_done / size
-                        text = ', ' + format_bytes(speed) + '/s, '
-                        text += time.strftime('%M:%S', time.gmtime((size - by_done) / speed)) + ' left'
-                    else:
-                        p = 0
-                        text = ''
-                    progress.update(p, os.path.basename(link) + text)
+            try:
+                size = float(result.headers.get('content-length', 0)) - skip
+            except:
+                logging.exception('Failed to parse Content-Length header!')
+                size = 1024 ** 4  # = 1 TB
+
+            start = good = dest.tell()
+            start_time = time.time()
+            try:
+                sc = SpeedCalc()
+                for chunk in result.iter_content(512 * 1024):
+                    if skip > 0:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+
+                        chunk = chunk[skip:]
+                        skip = 0
+
+                    dest.write(chunk)
+
+                    if hasher is not None:
+                        hasher.update(chunk)
+
+                    good = dest.tell()
+                    if sc.push(good) != -1:
+                        if size > 0:
+                            by_done = good - start
+                            speed = sc.get_speed()
+                            p = by_done / size
+                            text = ', ' + format_bytes(speed) + '/s, '
+                            text += time.strftime('%M:%S', time.gmtime((size - by_done) / speed)) + ' left'
+                        else:
+                            p = 0
+                            text = ''
+                        progress.update(p, os.path.basename(link) + text)
+
+                    if _DL_CANCEL.is_set():
+                        return False
+            except:
+                logging.exception('Download of "%s" was interrupted!', link)
+                MIRROR_STATS.record(link, failed=True)
+
+                # Make sure dest only contains complete chunks so the download can be resumed later.
+                try:
+                    dest.seek(good)
+                    dest.truncate()
+                except:
+                    logging.exception('Failed to truncate the partial download of "%s"!', link)
+
+                return False
+        finally:
+            # Return the connection to the pool.
+            result.close()
+
+    MIRROR_STATS.record(link, good - start, time.time() - start_time)
+    return True
+
+
+# Returns the size of the file behind link if the server supports range requests, None otherwise.
+def get_range_size(link):
+    try:
+        result = get_session().head(link, allow_redirects=True)
+    except requests.exceptions.RequestException:
+        logging.exception('HEAD request for "%s" failed!', link)
+        return None
+
+    if result.status_code != 200 or result.headers.get('accept-ranges', '').lower() != 'bytes':
+        return None
+
+    try:
+        return int(result.headers.get('content-length'))
+    except (TypeError, ValueError):
+        return None
+
+
+# received maps the links to the number of bytes this segment got from them.
+def _download_segment(links, path, part, received):
+    start, end = part[0], part[2]
+    tries = 3
+
+    with open(path, 'r+b') as stream:
+        while tries > 0:
+            tries -= 1
+
+            for link in links:
+                if part[1] >= end:
+                    return
+
+                # Every segment is a connection of its own so it needs its own slots. Otherwise a segmented download
+                # would ignore max_downloads and max_host_downloads.
+                with DL_POOL, get_host_slots(link):
+                    if _DL_CANCEL.is_set():
+                        return
+
+                    headers = {'Range': 'bytes=%d-%d' % (part[1], end - 1)}
+                    seg_start = part[1]
+                    result = None
+                    try:
+                        result = get_session().get(link, headers=headers, stream=True)
+                        if result.status_code != 206 or \
+                                not result.headers.get('content-range', '').startswith('bytes %d-' % part[1]):
+                            logging.warning('"%s" didn\'t honor my range request! (%d)', link, result.status_code)
+                            MIRROR_STATS.record(link, failed=True)
+                            continue
+
+                        stream.seek(part[1])
+                        for chunk in result.iter_content(256 * 1024):
+                            chunk = chunk[:end - part[1]]
+                            stream.write(chunk)
+                            part[1] += len(chunk)
+
+                            if part[1] >= end or _DL_CANCEL.is_set():
+                                break
+                    except:
+                        logging.exception('Segment %d-%d of "%s" was interrupted!', start, end, link)
+                        MIRROR_STATS.record(link, failed=True)
+                    finally:
+                        received[link] = received.get(link, 0) + part[1] - seg_start
+
+                        if result is not None:
+                            result.close()
 
                 if _DL_CANCEL.is_set():
-                    return False
-        except:
-            logging.exception('Download of "%s" was interrupted!', link)
+                    return
+
+
+# Downloads the file behind links into path. The file is split into several byte ranges which are
+# fetched in parallel from all mirrors in links. Every segment continues where it stopped if its connection drops.
+# Each segment is a separate connection and waits for its own slots in DL_POOL and in the host's limit.
+# If you pass a list as parts, it's filled with the state of every segment ([start, current position, end]). Pass the
+# same list again to resume a failed download without fetching the finished ranges again. get_segmented_prefix()
+# returns how much of the file can be kept if you'd rather continue with download().
+# Returns None if the file is too small or the first mirror doesn't support range requests. Use download() in that case.
+def download_segmented(links, path, segments=None, parts=None):
+    global DL_POOL, _DL_CANCEL
+
+    if parts is None:
+        parts = []
+
+    if len(links) == 0:
+        return None
+
+    if parts and os.path.isfile(path) and os.path.getsize(path) == parts[-1][2]:
+        size = parts[-1][2]
+        logging.info('Resuming "%s" (%s of %s)...', links[0], format_bytes(sum(p[1] - p[0] for p in parts)),
+                     format_bytes(size))
+    else:
+        if segments is None:
+            segments = center.settings['download_segments']
+
+        if segments < 2:
+            return None
+
+        size = get_range_size(links[0])
+        if size is None or size < SEGMENT_MIN_SIZE:
+            return None
+
+        if _DL_CANCEL.is_set():
             return False
 
-    return True
+        logging.info('Downloading "%s" in %d segments...', links[0], segments)
+        with open(path, 'wb') as stream:
+            stream.truncate(size)
+
+        step = size // segments
+        del parts[:]
+        for i in range(segments):
+            end = size if i == segments - 1 else (i + 1) * step
+            parts.append([i * step, i * step, end])
+
+    threads = []
+    received = []
+    start_time = time.time()
+    for i, part in enumerate(parts):
+        if part[1] >= part[2]:
+            continue
+
+        # Rotate the mirrors to spread the segments across them.
+        mirrors = links[i % len(links):] + links[:i % len(links)]
+        received.append({})
+        t = Thread(target=_download_segment, args=(mirrors, path, part, received[-1]))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    sc = SpeedCalc()
+    name = os.path.basename(links[0])
+    while any(t.is_alive() for t in threads):
+        time.sleep(0.3)
+
+        by_done = sum(p[1] - p[0] for p in parts)
+        if sc.push(by_done) != -1:
+            speed = sc.get_speed()
+            text = ', ' + format_bytes(speed) + '/s, '
+            text += time.strftime('%M:%S', time.gmtime((size - by_done) / speed)) + ' left'
+            progress.update(by_done / float(size), name + text)
+
+    # The segments ran in parallel so every mirror is credited with everything it sent us during the whole download.
+    duration = time.time() - start_time
+    totals = {}
+    for stats in received:
+        for link, count in stats.items():
+            totals[link] = totals.get(link, 0) + count
+
+    for link, count in totals.items():
+        if count > 0:
+            MIRROR_STATS.record(link, count, duration)
+
+    if _DL_CANCEL.is_set():
+        return False
+
+    return all(p[1] >= p[2] for p in parts)
+
+
+# Returns the number of bytes at the start of a segmented download (see download_segmented()) which are complete.
+def get_segmented_prefix(parts):
+    done = 0
+    for start, pos, end in parts:
+        done = pos
+        if pos < end:
+            break
+
+    return done
 
 
 def cancel_downloads():
@@ -483,6 +1203,22 @@ def normpath(path):
     return os.path.normcase(path.replace('\\', '/'))
 
 
+# Yields (name, is_dir) for every entry in path. os.scandir() can usually tell whether an entry is a directory
+# without calling stat() on it.
+def scan_dir(path):
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            yield entry.name, is_dir
+    else:
+        for name in os.listdir(path):
+            yield name, os.path.isdir(os.path.join(path, name))
+
+
 # Try to map a case insensitive path to an existing one.
 def ipath(path):
     if os.path.exists(path) or path == '':
@@ -542,16 +1278,15 @@ def url_join(a, b):
     return pjoin(a, b)
 
 
-def gen_hash(path, algo='md5'):
+def gen_hash(path, algo='md5', use_cache=True):
     global HASH_CACHE
 
     path = os.path.abspath(path)
-    info = os.stat(path)
+    key = stat_key(os.stat(path))
 
-    if algo == 'md5' and path in HASH_CACHE:
-        chksum, mtime = HASH_CACHE[path]
-        if mtime == info.st_mtime:
-            # logging.debug('Found checksum for %s in cache.', path)
+    if algo == 'md5' and use_cache:
+        chksum = HASH_CACHE.get(path, key)
+        if chksum is not None:
             return chksum
 
     logging.debug('Calculating checksum for %s...', path)
@@ -567,11 +1302,44 @@ def gen_hash(path, algo='md5'):
 
     chksum = h.hexdigest()
     if algo == 'md5':
-        HASH_CACHE[path] = (chksum, info.st_mtime)
+        HASH_CACHE.set(path, key, chksum)
 
     return chksum
 
 
+# Works like gen_hash() but hashes all files which aren't cached in the process pool.
+# Yields (path, checksum) tuples in the same order as the passed paths. The checksum is None if the file couldn't be read.
+# Pass use_cache=False to read every file again (the results are still cached).
+def gen_hashes(paths, algo='md5', use_cache=True):
+    global HASH_CACHE
+
+    items = []
+    jobs = []
+    for path in paths:
+        path = os.path.abspath(path)
+        chksum = None
+
+        if algo == 'md5' and use_cache:
+            try:
+                chksum = HASH_CACHE.get(path, stat_key(os.stat(path)))
+            except OSError:
+                pass
+
+        items.append((path, chksum))
+        if chksum is None:
+            jobs.append((path, algo))
+
+    results = parallel.imap(parallel.hash_file, jobs, 4)
+    for path, chksum in items:
+        if chksum is None:
+            path, chksum, key = next(results)
+
+            if chksum is not None and algo == 'md5':
+                HASH_CACHE.set(path, key, chksum)
+
+        yield path, chksum
+
+
 def test_7z():
     global SEVEN_PATH
 
@@ -685,6 +1453,377 @@ def extract_archive(archive, outpath, overwrite=False, files=None, _rec=False):
         return call(cmd) == 0
 
 
+# Zip files using other compression methods (i.e. Deflate64) have to be handled by 7z.
+_ZIP_METHODS = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, getattr(zipfile, 'ZIP_BZIP2', -1),
+                getattr(zipfile, 'ZIP_LZMA', -1))
+EXTRACT_CHUNK = 256 * 1024
+
+
+def _norm_member(name):
+    name = name.replace('\\', '/')
+    while name.startswith('./'):
+        name = name[2:]
+
+    return name.lstrip('/')
+
+
+# Opens a destination file for writing. This might fail on Windows with Permission Denied errors
+# ("[WinError 32] The process cannot access the file because it is being used by another process") because of
+# AV scanners and similar programs. Just try it again several times.
+def _open_dest(path):
+    dparent = os.path.dirname(path)
+    if not os.path.isdir(dparent):
+        os.makedirs(dparent)
+
+    tries = 5
+    while True:
+        try:
+            return open(path, 'wb')
+        except (IOError, OSError) as e:
+            tries -= 1
+            if tries == 0:
+                raise
+
+            logging.warning('Failed to open "%s" (%s)! Trying again...', path, str(e))
+            time.sleep(1)
+
+
+# Writes an archive member to its destination and hashes it on the way.
+class _MemberWriter(object):
+    path = None
+    _stream = None
+    _hasher = None
+
+    def __init__(self, path):
+        self.path = path
+        self._stream = _open_dest(path)
+        self._hasher = hashlib.md5()
+
+    def write(self, data):
+        self._hasher.update(data)
+        self._stream.write(data)
+        return len(data)
+
+    def copy_from(self, src):
+        while True:
+            chunk = src.read(EXTRACT_CHUNK)
+            if not chunk:
+                break
+
+            self.write(chunk)
+
+    def close(self):
+        if not self._stream.closed:
+            self._stream.close()
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+
+# Returns False if a symlink in an archive points to an absolute path or outside of its folder.
+def _is_safe_link(target):
+    target = target.replace('\\', '/')
+    return target != '' and not target.startswith('/') and not os.path.isabs(target) and \
+        '..' not in target.split('/')
+
+
+class _Extractor(object):
+    members = None
+    base_path = None
+    root = None
+    hashes = None
+    _links = None
+    _total = 0
+    _done = 0
+
+    def __init__(self, members, base_path, root=None):
+        self.base_path = base_path
+        self.hashes = {}
+        self._links = []
+
+        if root is None:
+            root = base_path
+
+        if root is not None:
+            self.root = os.path.realpath(root)
+
+        # normalized name -> (name passed by the caller, destination)
+        self.members = {}
+        for name, dest in members.items():
+            # Symlinks are only created once every file is written so nothing can redirect these paths while we're
+            # extracting. Existing links can, though.
+            if not self.is_inside(dest):
+                logging.warning('Skipping "%s" since its destination "%s" is outside of "%s"!', name, dest, root)
+                continue
+
+            self.members[_norm_member(name)] = (name, dest)
+
+    def is_inside(self, path):
+        if self.root is None:
+            return True
+
+        path = os.path.realpath(path)
+        return path == self.root or path.startswith(os.path.join(self.root, ''))
+
+    def add_total(self, size):
+        self._total += size
+
+    def wants(self, name):
+        return name in self.members
+
+    def open(self, name):
+        return _MemberWriter(self.members[name][1])
+
+    def is_finished(self, name):
+        return self.members[name][0] in self.hashes
+
+    # Returns True once we have every member and nothing else to do.
+    def is_complete(self):
+        return self.base_path is None and len(self.hashes) == len(self.members)
+
+    def finish(self, name, writer, size=0):
+        writer.close()
+        chksum = self.hashes[self.members[name][0]] = writer.hexdigest()
+
+        # We just read every byte of this file so there's no need to do it again during the next check.
+        HASH_CACHE.remember(writer.path, chksum)
+
+        self._done += size
+        if self._total > 0:
+            progress.update(self._done / self._total, 'Extracting "%s"...' % name)
+
+    # Returns the path for an unlisted member inside base_path (for folders and symlinks) or None.
+    def get_extra_path(self, name):
+        if self.base_path is None or name == '' or '..' in name.split('/'):
+            return None
+
+        path = ipath(os.path.join(self.base_path, name.rstrip('/')))
+        if not self.is_inside(os.path.dirname(path)):
+            return None
+
+        return path
+
+    def make_dir(self, name):
+        path = self.get_extra_path(name)
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+    # Symlinks are collected and only created by make_links() once every file member is written. Otherwise a link
+    # to a folder could redirect the following files.
+    def make_link(self, name, target):
+        if self.base_path is None:
+            return
+
+        if not _is_safe_link(target):
+            logging.warning('Skipping the symlink "%s" since its target "%s" is outside of the archive!', name, target)
+            return
+
+        self._links.append((name, target))
+
+    def make_links(self):
+        for name, target in self._links:
+            path = self.get_extra_path(name)
+            if path is not None and not os.path.lexists(path):
+                try:
+                    os.symlink(target, path)
+                except (OSError, NotImplementedError, AttributeError):
+                    logging.warning('Failed to create the symlink "%s"!', path)
+
+
+def _extract_zip(archive, ex):
+    with zipfile.ZipFile(archive) as zf:
+        infos = zf.infolist()
+
+        for info in infos:
+            if ex.wants(_norm_member(info.filename)):
+                if info.flag_bits & 0x1 or info.compress_type not in _ZIP_METHODS:
+                    # Encrypted or compressed with an unsupported method
+                    return False
+
+                ex.add_total(info.file_size)
+
+        for info in infos:
+            name = _norm_member(info.filename)
+
+            if info.filename.endswith(('/', '\\')):
+                ex.make_dir(name)
+            elif ex.wants(name):
+                writer = ex.open(name)
+                try:
+                    with zf.open(info) as src:
+                        writer.copy_from(src)
+                finally:
+                    writer.close()
+
+                ex.finish(name, writer, info.file_size)
+
+    return True
+
+
+def _extract_tar(archive, ex):
+    with open(archive, 'rb') as raw:
+        try:
+            tf = tarfile.open(fileobj=raw, mode='r:*')
+        except tarfile.CompressionError:
+            # i.e. Python 2 can't handle .tar.xz
+            return False
+
+        with tf:
+            # We can't get the uncompressed sizes without decompressing the whole archive first so the progress is
+            # based on how much of the archive file we've read.
+            ex.add_total(os.path.getsize(archive))
+            last_pos = 0
+
+            for info in tf:
+                if ex.is_complete():
+                    # Don't decompress the rest of the archive.
+                    break
+
+                name = _norm_member(info.name)
+
+                if info.isdir():
+                    ex.make_dir(name)
+                elif info.issym():
+                    ex.make_link(name, info.linkname)
+                elif (info.isfile() or info.islnk()) and ex.wants(name):
+                    writer = ex.open(name)
+                    try:
+                        writer.copy_from(tf.extractfile(info))
+                    finally:
+                        writer.close()
+
+                    # This includes the members we skipped since the last file.
+                    pos = raw.tell()
+                    ex.finish(name, writer, pos - last_pos)
+                    last_pos = pos
+
+    return True
+
+
+if py7zr is not None and hasattr(py7zr.io, 'WriterFactory'):
+    class _SevenZipWriter(py7zr.io.Py7zIO):
+        _writer = None
+        _ex = None
+        _name = None
+        _size = 0
+
+        def __init__(self, ex, name):
+            self._ex = ex
+            self._name = name
+            self._writer = ex.open(name)
+
+        def write(self, data):
+            self._size += len(data)
+            return self._writer.write(data)
+
+        def read(self, size=None):
+            return b''
+
+        def seek(self, offset, whence=0):
+            return 0
+
+        def seekable(self):
+            return False
+
+        def flush(self):
+            pass
+
+        def size(self):
+            return self._size
+
+        def close(self):
+            if self._ex.is_finished(self._name):
+                return
+
+            self._ex.finish(self._name, self._writer, self._size)
+
+    class _SevenZipFactory(py7zr.io.WriterFactory):
+        _ex = None
+        writers = None
+
+        def __init__(self, ex):
+            self._ex = ex
+            self.writers = []
+
+        def create(self, filename):
+            name = filename
+            if os.path.isabs(name):
+                # Older versions pass absolute paths below the working directory.
+                name = os.path.relpath(name, os.getcwd())
+
+            name = _norm_member(name)
+            if self._ex.wants(name):
+                writer = _SevenZipWriter(self._ex, name)
+                self.writers.append(writer)
+                return writer
+            else:
+                return py7zr.io.NullIO()
+
+    def _extract_7z(archive, ex):
+        with py7zr.SevenZipFile(archive, 'r') as zf:
+            if zf.needs_password():
+                return False
+
+            targets = []
+            for info in zf.list():
+                name = _norm_member(info.filename)
+
+                if info.is_directory:
+                    ex.make_dir(name)
+                elif ex.wants(name):
+                    targets.append(info.filename)
+                    ex.add_total(info.uncompressed)
+
+            factory = _SevenZipFactory(ex)
+            try:
+                if targets:
+                    zf.extract(targets=targets, factory=factory)
+
+                # Not every version calls close() once a file is complete.
+                for writer in factory.writers:
+                    writer.close()
+            except py7zr.exceptions.UnsupportedCompressionMethodError:
+                # 7z will overwrite anything we've written so far.
+                return False
+            finally:
+                for writer in factory.writers:
+                    writer._writer.close()
+
+        return True
+else:
+    _extract_7z = None
+
+
+# Extracts archive members straight to their destination without calling 7z or using a temporary folder.
+# members maps the names of the needed members (i.e. orig_name in a file list) to their destination paths. Everything
+# else is skipped except for folders and symlinks which are created relative to base_path (if it's set).
+# Every file is hashed while it's written and recorded in the HASH_CACHE. The result maps member names to
+# their checksums. Members which were missing in the archive don't show up in the result.
+# Nothing is written outside of root (defaults to base_path), members with a destination outside of it are skipped.
+# Symlinks with absolute targets or targets containing ".." are skipped as well.
+# Only the listed members are decompressed (as far as the format allows). Without base_path, we stop reading the
+# archive once we have all of them.
+# Returns None if we can't handle this archive (unsupported format or compression method). Use extract_archive()
+# in that case.
+def extract_files(archive, members, base_path=None, root=None):
+    lpath = archive.lower()
+    if lpath.endswith('.zip'):
+        func = _extract_zip
+    elif lpath.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+        func = _extract_tar
+    elif lpath.endswith('.7z') and _extract_7z is not None:
+        func = _extract_7z
+    else:
+        return None
+
+    ex = _Extractor(members, base_path, root)
+    if not func(archive, ex):
+        return None
+
+    ex.make_links()
+    return ex.hashes
+
+
 def convert_img(path, outfmt):
     global _HAS_CONVERT
 
@@ -799,6 +1938,53 @@ def connect(sig, cb, *args):
     sig.connect(cb)
 
 
+# A small, thread-safe least recently used cache.
+class LRUCache(object):
+    size = 0
+    _items = None
+    _lock = None
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    # Returns the cached value for key. If there is none, factory(key) is called and its result is cached.
+    def get(self, key, factory):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                pass
+            else:
+                # Move it to the end since it was used most recently.
+                self._items[key] = value
+                return value
+
+        value = factory(key)
+
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# The same version strings and specs are parsed over and over again (dependencies, queries from the web UI, ...).
+# These return shared instances which must not be modified.
+def get_spec(text):
+    return SPEC_CACHE.get(text, Spec)
+
+
+def get_version(text, partial=False):
+    return SPEC_CACHE.get((text, partial), lambda key: semantic_version.Version(key[0], partial=key[1]))
+
+
 class Spec(semantic_version.Spec):
 
     @classmethod
@@ -820,11 +2006,16 @@ class Spec(semantic_version.Spec):
 
     @staticmethod
     def from_version(version, op='=='):
-        return Spec('==' + str(version))
+        return get_spec('==' + str(version))
 
 
 DL_POOL = ResizableSemaphore(10)
-HTTP_SESSION.headers['User-Agent'] = get_user_agent()
+MIRROR_STATS = MirrorStats()
+HASH_CACHE = HashCache()
+HTTP_CACHE = HttpCache()
+PARTIAL_DOWNLOADS = PartialDownloads()
+SPEC_CACHE = LRUCache(2048)
+init_http()
 
 if not center.DEBUG:
     logging.getLogger('requests.packages.urllib3.connectionpool').propagate = False
@@ -0,0 +1,378 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+import ctypes
+import ctypes.util
+
+from . import center
+from .parallel import stat_key
+
+# The watcher remembers which files inside the mod folders changed. CheckTask uses this to only verify the packages
+# which were touched since the last check instead of going through the whole library again.
+#
+# On Linux we use inotify. Everywhere else (or if inotify fails, i.e. because we ran out of watches) the folders can
+# be scanned periodically and the stat() results are compared. Since that means reading the metadata of the whole
+# library every few seconds, polling has to be enabled explicitly (the watch_poll setting). Without a working watcher,
+# every CheckTask looks at every installed package.
+#
+# Only changes to files which belong to an installed package (see set_files()) and to mod.json / mod.ini files are
+# reported. Everything else the game writes into the mod folders (logs, pilot files, screenshots, ...) is ignored.
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# We don't listen for IN_MODIFY since that would give us an event for every single write() during an install.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+    IN_MOVE_SELF
+# wd, mask, cookie, name length
+EVENT = struct.Struct('iIII')
+
+_FS_ENC = sys.getfilesystemencoding() or 'utf8'
+
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        logging.warning('inotify is not available, the mod folders will be polled instead.')
+        return None
+
+    return libc
+
+
+_libc = _load_inotify()
+
+
+class Watcher(object):
+    # Seconds without a new event before we report a batch of changes
+    debounce = 1.0
+    # Seconds between two scans if we have to poll
+    interval = 30
+    poll = False
+    _paths = ()
+    _files = None
+    _dirs = None
+    _changes = None
+    _ready = False
+    _complete = False
+    _pending = False
+    _last_event = 0
+    _lock = None
+    _stop = None
+    _ready_event = None
+    _thread = None
+    _wds = None
+
+    def __init__(self, interval=30, poll=False):
+        self.interval = interval
+        self.poll = poll
+        self._changes = set()
+        self._lock = threading.Lock()
+        self._ready_event = threading.Event()
+
+    def is_active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Returns False if we can't watch anything on this system.
+    def is_supported(self):
+        return _libc is not None or self.poll
+
+    # Starts watching paths (and everything inside them). Nothing happens if we're already watching them.
+    def set_paths(self, paths):
+        paths = sorted(set(os.path.abspath(p) for p in paths if p and os.path.isdir(p)))
+        if paths == self._paths and self.is_active():
+            return
+
+        self.stop()
+        self._paths = paths
+
+        if paths and self.is_supported():
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(paths, self._stop), name='FileWatcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            self._ready = False
+            self._complete = False
+            self._changes = set()
+            self._ready_event.clear()
+
+    # Only changes to these files (or the folders containing them) are reported. Pass None to report everything.
+    def set_files(self, files):
+        if files is None:
+            file_set = dir_set = None
+        else:
+            file_set = set()
+            dir_set = set()
+
+            for path in files:
+                # ipath() resolves the names in file lists case-insensitively, so we have to compare them that way.
+                path = os.path.abspath(path).lower()
+                file_set.add(path)
+
+                parent = os.path.dirname(path)
+                while parent not in dir_set and parent != os.path.dirname(parent):
+                    dir_set.add(parent)
+                    parent = os.path.dirname(parent)
+
+        with self._lock:
+            self._files = file_set
+            self._dirs = dir_set
+
+    # Waits until the watches are in place (or we gave up). Returns True if the watcher is ready.
+    def wait_ready(self, timeout=None):
+        if not self.is_active():
+            return self._ready
+
+        self._ready_event.wait(timeout)
+        return self._ready
+
+    # Returns the paths which changed since the last call or None if we don't know. In that case the caller has to
+    # assume that everything changed.
+    # The first call after the watcher became ready always returns None since we don't know what happened before the
+    # watches were in place. Callers should check wait_ready() first. Otherwise (i.e. if the first call happens while
+    # the watches are still being added) the second call returns None as well and only the third one is trusted.
+    def pop_changes(self):
+        with self._lock:
+            result = self._changes if self._ready and self._complete else None
+            self._changes = set()
+            self._complete = self._ready
+
+        return result
+
+    def has_changes(self):
+        with self._lock:
+            return len(self._changes) > 0 or not self._complete
+
+    def _is_relevant(self, path):
+        if self._files is None:
+            return True
+
+        if os.path.basename(path).lower() in ('mod.json', 'mod.ini'):
+            return True
+
+        path = path.lower()
+        # A folder could have been removed or replaced.
+        return path in self._files or path in self._dirs
+
+    def _record(self, path):
+        with self._lock:
+            if not self._is_relevant(path):
+                return
+
+            self._changes.add(path)
+            self._pending = True
+            self._last_event = time.time()
+
+    def _lost_track(self):
+        with self._lock:
+            self._complete = False
+            self._pending = True
+            self._last_event = time.time()
+
+    def _set_ready(self):
+        with self._lock:
+            self._ready = True
+
+        self._ready_event.set()
+
+    # We can't tell what changed from now on.
+    def _give_up(self):
+        with self._lock:
+            self._ready = False
+            self._complete = False
+
+        self._ready_event.set()
+
+    def _notify(self, force=False):
+        with self._lock:
+            if not self._pending or (not force and time.time() - self._last_event < self.debounce):
+                return
+
+            self._pending = False
+
+        center.signals.files_changed.emit()
+
+    def _run(self, paths, stop):
+        try:
+            if _libc is not None and self._run_inotify(paths, stop):
+                return
+        except:
+            logging.exception('The inotify watcher failed!')
+
+        if not self.poll:
+            logging.info('Not watching the mod folders since polling is disabled.')
+            self._give_up()
+            return
+
+        self._lost_track()
+        self._run_polling(paths, stop)
+
+    def _run_inotify(self, paths, stop):
+        fd = _libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            logging.warning('inotify_init1() failed with error %d!', ctypes.get_errno())
+            return False
+
+        try:
+            self._wds = {}
+            for path in paths:
+                if not self._watch_tree(fd, path):
+                    return False
+
+            self._set_ready()
+            logging.debug('Watching %d folders with inotify.', len(self._wds))
+
+            while not stop.is_set():
+                if select.select([fd], [], [], 0.5)[0]:
+                    self._handle_events(fd, os.read(fd, 64 * 1024))
+
+                self._notify()
+        finally:
+            os.close(fd)
+            self._wds = None
+
+        return True
+
+    # Adds a watch for path and every folder inside it. Returns False if we ran out of watches.
+    def _watch_tree(self, fd, path, record=False):
+        for sub, dirs, files in os.walk(path):
+            if isinstance(sub, bytes):
+                bpath = sub
+            else:
+                bpath = sub.encode(_FS_ENC)
+
+            wd = _libc.inotify_add_watch(fd, bpath, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    logging.warning('There are too many folders to watch with inotify! Increase ' +
+                                    'fs.inotify.max_user_watches to fix this.')
+                    return False
+                elif err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    logging.warning('inotify_add_watch() failed for "%s" with error %d!', sub, err)
+
+                continue
+
+            self._wds[wd] = sub
+
+            if record:
+                # We might have missed events for files which were created before the watch was added.
+                for name in files:
+                    self._record(os.path.join(sub, name))
+
+        return True
+
+    def _handle_events(self, fd, data):
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('The inotify queue overflowed!')
+                self._lost_track()
+                continue
+
+            if mask & IN_IGNORED:
+                self._wds.pop(wd, None)
+                continue
+
+            parent = self._wds.get(wd)
+            if parent is None:
+                continue
+
+            if name:
+                path = os.path.join(parent, name.decode(_FS_ENC, 'replace'))
+            else:
+                path = parent
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._record(path)
+                if not self._watch_tree(fd, path, record=True):
+                    self._lost_track()
+            else:
+                # Removed folders are recorded as well, CheckTask treats them as "everything inside this folder".
+                self._record(path)
+
+    def _scan(self, paths, stop):
+        result = {}
+        for path in paths:
+            for sub, dirs, files in os.walk(path):
+                if stop.is_set():
+                    return result
+
+                for name in files:
+                    fpath = os.path.join(sub, name)
+                    try:
+                        result[fpath] = stat_key(os.stat(fpath))
+                    except OSError:
+                        pass
+
+        return result
+
+    def _run_polling(self, paths, stop):
+        known = self._scan(paths, stop)
+        self._set_ready()
+        logging.debug('Polling %d files every %d seconds.', len(known), self.interval)
+
+        while not stop.wait(self.interval):
+            current = self._scan(paths, stop)
+            if stop.is_set():
+                break
+
+            for path, key in current.items():
+                if known.get(path) != key:
+                    self._record(path)
+
+            for path in known:
+                if path not in current:
+                    self._record(path)
+
+            known = current
+            self._notify(force=True)
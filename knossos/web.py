@@ -155,7 +155,7 @@ class WebBridge(QtCore.QObject):
         if spec is None:
             return mid in center.installed.mods
         else:
-            spec = util.Spec(spec)
+            spec = util.get_spec(spec)
             mod = center.installed.mods.get(mid, None)
             if mod is None:
                 return False
@@ -172,7 +172,7 @@ class WebBridge(QtCore.QObject):
                     spec = '==' + spec
 
                 try:
-                    spec = util.Spec(spec)
+                    spec = util.get_spec(spec)
                 except:
                     logging.exception('Invalid spec "%s" passed to query()!', spec)
                     return -2
@@ -224,7 +224,7 @@ class WebBridge(QtCore.QObject):
                     spec = '==' + spec
 
                 try:
-                    spec = util.Spec(spec)
+                    spec = util.get_spec(spec)
                 except:
                     logging.exception('Invalid spec "%s" passed to a web API function!', spec)
                     return -2
@@ -364,8 +364,8 @@ class WebBridge(QtCore.QObject):
     @QtCore.Slot(str, str, result=int)
     def vercmp(self, a, b):
         try:
-            a = semantic_version.Version(a)
-            b = semantic_version.Version(b)
+            a = util.get_version(a)
+            b = util.get_version(b)
         except:
             # logging.exception('Someone passed an invalid version to vercmp()!')
             return 0
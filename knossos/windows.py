@@ -33,7 +33,7 @@ from .ui.install import Ui_InstallDialog
 from .ui.mod_settings import Ui_ModSettingsDialog
 from .ui.mod_versions import Ui_ModVersionsDialog
 from .ui.log_viewer import Ui_LogDialog
-from .tasks import run_task, GOGExtractTask, InstallTask, UninstallTask, WindowsUpdateTask, CheckFilesTask
+from .tasks import run_task, GOGExtractTask, InstallTask, UninstallTask, WindowsUpdateTask, CheckFilesTask, RepairTask
 
 # Keep references to all open windows to prevent the GC from deleting them.
 _open_wins = []
@@ -223,7 +223,8 @@ class HellWindow(Window):
         for mid, mvs in mods.items():
             if query in mvs[0].title.lower():
                 mod = mvs[0]
-                item = mod.get()
+                # The file lists aren't needed here and would have to be loaded for every mod.
+                item = mod.get(files=False)
                 item['progress'] = 0
 
                 try:
@@ -1038,7 +1039,7 @@ class ModSettingsWindow(Window):
     def check_files(self):
         self.win.setCursor(QtCore.Qt.BusyCursor)
 
-        task = CheckFilesTask(self._mod)
+        task = CheckFilesTask(self._mod, deep=True)
         task.done.connect(functools.partial(self.__check_files, task))
         run_task(task)
 
@@ -1103,8 +1104,29 @@ class ModSettingsWindow(Window):
         QtWidgets.QMessageBox.information(None, 'Knossos', self.tr('Done!'))
 
     def repair_files(self):
+        self.win.setCursor(QtCore.Qt.BusyCursor)
+
+        # A quick check only reads files which changed since they were hashed the last time.
+        task = CheckFilesTask(self._mod)
+        task.done.connect(functools.partial(self.__repair_files, task))
+        run_task(task)
+
+    def __repair_files(self, task):
+        self.win.unsetCursor()
+        results = task.get_results()
+
+        damaged = False
+        for pkg, s, c, info in results:
+            if pkg is not None and (info['corrupt'] or info['missing']):
+                damaged = True
+                break
+
+        if not damaged:
+            QtWidgets.QMessageBox.information(None, 'Knossos', self.tr('All files are fine, there\'s nothing to repair.'))
+            return
+
         try:
-            run_task(InstallTask(self._mod.packages))
+            run_task(RepairTask(self._mod, results))
         except repo.ModNotFound as exc:
             QtWidgets.QMessageBox.critical(None, 'Knossos', self.tr("I can't repair this mod: %s") % str(exc))
 
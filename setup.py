@@ -85,6 +85,9 @@ setup(
     # You can install these using the following syntax, for example:
     # $ pip install -e .[dev,test]
     extras_require={
+        # Lets Knossos extract .7z archives without calling 7z.
+        '7z': ['py7zr'],
+        'test': ['pytest'],
     },
 
     package_data=pkg_data,
@@ -0,0 +1,36 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+# Jobs for the process pool tests. The pool processes import this module so (just like knossos.parallel) it must not
+# import Qt.
+
+import sys
+
+from knossos import parallel
+
+
+def square(value):
+    return value * value
+
+
+def report_twice(value):
+    parallel.report(0.5, 'half')
+    parallel.report(1, 'done')
+    return value
+
+
+def get_loaded(names):
+    return [name for name in names if name in sys.modules]
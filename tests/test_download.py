@@ -0,0 +1,207 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import hashlib
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+from knossos import util
+
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Connections for the first "drops" requests are closed after half of the response.
+    drops = 0
+    requests = []
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        if 'norange' not in self.path:
+            self.send_header('Accept-Ranges', 'bytes')
+
+        self.send_header('Content-Length', str(len(DATA)))
+        self.end_headers()
+
+    def do_GET(self):
+        with self.lock:
+            drop = len(self.requests) < self.drops
+            self.requests.append((self.path, self.headers.get('Range')))
+
+        info = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if info and 'norange' not in self.path:
+            start = int(info.group(1))
+            end = int(info.group(2)) if info.group(2) else len(DATA) - 1
+            body = DATA[start:end + 1]
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(DATA)))
+        else:
+            body = DATA
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if drop:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+        else:
+            self.wfile.write(body)
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    _Handler.drops = 0
+    _Handler.requests = []
+
+    httpd = _Server(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield 'http://127.0.0.1:%d/' % httpd.server_address[1]
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_resumes(tmpdir, server):
+    path = str(tmpdir.join('file'))
+    hasher = hashlib.md5()
+
+    _Handler.drops = 1
+    with open(path, 'wb') as stream:
+        assert not util.download(server + 'file', stream, hasher=hasher)
+
+    offset = os.path.getsize(path)
+    assert 0 < offset < len(DATA)
+
+    with open(path, 'ab') as stream:
+        stream.seek(0, os.SEEK_END)
+        assert util.download(server + 'file', stream, hasher=hasher)
+
+    assert _Handler.requests[-1][1] == 'bytes=%d-' % offset
+    assert hasher.hexdigest() == hashlib.md5(DATA).hexdigest()
+    assert open(path, 'rb').read() == DATA
+
+
+def test_download_resume_without_range_support(tmpdir, server):
+    path = str(tmpdir.join('file'))
+    with open(path, 'wb') as stream:
+        stream.write(DATA[:5000])
+
+    hasher = hashlib.md5(DATA[:5000])
+    with open(path, 'ab') as stream:
+        stream.seek(0, os.SEEK_END)
+        assert util.download(server + 'norange', stream, hasher=hasher)
+
+    assert hasher.hexdigest() == hashlib.md5(DATA).hexdigest()
+    assert open(path, 'rb').read() == DATA
+
+
+def test_download_segmented(tmpdir, server, monkeypatch):
+    monkeypatch.setattr(util, 'SEGMENT_MIN_SIZE', 1024)
+    path = str(tmpdir.join('file'))
+    parts = []
+
+    assert util.download_segmented([server + 'a', server + 'b'], path, segments=4, parts=parts)
+    assert open(path, 'rb').read() == DATA
+    assert len(parts) == 4
+    assert parts[0][0] == 0 and parts[-1][2] == len(DATA)
+    assert all(start < end and pos == end for start, pos, end in parts)
+    assert all(parts[i][2] == parts[i + 1][0] for i in range(3))
+
+
+def test_download_segmented_resume(tmpdir, server, monkeypatch):
+    monkeypatch.setattr(util, 'SEGMENT_MIN_SIZE', 1024)
+    path = str(tmpdir.join('file'))
+    parts = []
+
+    # Every segment is tried 3 times and each attempt is dropped halfway through.
+    _Handler.drops = 12
+    assert util.download_segmented([server + 'a'], path, segments=4, parts=parts) is False
+    done = [pos for start, pos, end in parts]
+    assert all(start < pos < end for start, pos, end in parts)
+
+    _Handler.drops = 0
+    _Handler.requests = []
+    assert util.download_segmented([server + 'a'], path, parts=parts)
+    assert open(path, 'rb').read() == DATA
+
+    # Only the missing ranges were requested again.
+    assert sorted(int(rng[6:].split('-')[0]) for path, rng in _Handler.requests) == done
+
+
+def test_download_segmented_small_file(tmpdir, server):
+    # The file is below SEGMENT_MIN_SIZE so the caller has to use download().
+    assert util.download_segmented([server + 'a'], str(tmpdir.join('file')), segments=4) is None
+
+
+def test_segmented_prefix():
+    assert util.get_segmented_prefix([]) == 0
+    assert util.get_segmented_prefix([[0, 10, 10], [10, 15, 20], [20, 30, 30]]) == 15
+    assert util.get_segmented_prefix([[0, 10, 10], [10, 20, 20]]) == 20
+    assert util.get_segmented_prefix([[0, 0, 10], [10, 20, 20]]) == 0
+
+
+def test_partial_downloads(tmpdir):
+    store = util.PartialDownloads()
+    store.open(str(tmpdir.join('downloads')))
+
+    assert store.acquire('../evil') is None
+    path = store.acquire('ABCDEF')
+    assert os.path.isdir(path)
+    # Only one task can use a folder at a time.
+    assert store.acquire('abcdef') is None
+
+    assert store.load_state(path) == (None, [])
+    store.save_state(path, 'test.7z', [[0, 10, 20], [20, 20, 40]])
+    assert store.load_state(path) == ('test.7z', [[0, 10, 20], [20, 20, 40]])
+
+    store.release(path)
+    assert store.acquire('abcdef') == path
+    store.release(path, remove=True)
+    assert not os.path.exists(path)
+
+
+def test_partial_downloads_prune(tmpdir):
+    store = util.PartialDownloads()
+    store.open(str(tmpdir.join('downloads')))
+
+    old = store.acquire('aaaa')
+    new = store.acquire('bbbb')
+    store.release(old)
+    store.release(new)
+    os.utime(old, (0, 0))
+
+    store.open(str(tmpdir.join('downloads')))
+    assert not os.path.exists(old)
+    assert os.path.isdir(new)
@@ -0,0 +1,207 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import io
+import os
+import sys
+import hashlib
+import tarfile
+import zipfile
+
+import pytest
+
+# center has to be loaded before qt (qt -> clibs -> center -> qt).
+from knossos import center  # noqa
+from knossos import progress, util
+
+needs_symlinks = pytest.mark.skipif(sys.platform == 'win32', reason='needs symlinks')
+
+
+def _md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _add_file(tf, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tf.addfile(info, io.BytesIO(data))
+
+
+def _add_link(tf, name, target):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.SYMTYPE
+    info.linkname = target
+    tf.addfile(info)
+
+
+def _listdir(path):
+    result = []
+    for sub, dirs, files in os.walk(path):
+        for name in files:
+            result.append(os.path.relpath(os.path.join(sub, name), path).replace(os.sep, '/'))
+
+    return sorted(result)
+
+
+@pytest.fixture
+def mod_dir(tmpdir):
+    path = tmpdir.join('mod')
+    path.mkdir()
+    return str(path)
+
+
+@pytest.mark.parametrize('ext,mode', [('tar', 'w'), ('tar.gz', 'w:gz')])
+def test_extract_tar(tmpdir, mod_dir, ext, mode):
+    archive = str(tmpdir.join('test.' + ext))
+    with tarfile.open(archive, mode) as tf:
+        _add_file(tf, './data/a.vp', b'first')
+        _add_file(tf, 'data/b.vp', b'second')
+        _add_file(tf, 'unused.txt', b'nothing')
+
+    members = {
+        'data/a.vp': os.path.join(mod_dir, 'data', 'a.vp'),
+        'data/b.vp': os.path.join(mod_dir, 'b.vp'),
+        'missing.vp': os.path.join(mod_dir, 'missing.vp')
+    }
+    hashes = util.extract_files(archive, members)
+
+    assert hashes == {'data/a.vp': _md5(b'first'), 'data/b.vp': _md5(b'second')}
+    assert _listdir(mod_dir) == ['b.vp', 'data/a.vp']
+
+
+def test_extract_zip(tmpdir, mod_dir):
+    archive = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('data/', b'')
+        zf.writestr('data/empty/', b'')
+        zf.writestr('data/a.vp', b'first')
+
+    hashes = util.extract_files(archive, {'data/a.vp': os.path.join(mod_dir, 'data', 'a.vp')}, mod_dir)
+
+    assert hashes == {'data/a.vp': _md5(b'first')}
+    assert os.path.isdir(os.path.join(mod_dir, 'data', 'empty'))
+
+
+def test_unsupported_format(tmpdir, mod_dir):
+    archive = str(tmpdir.join('test.rar'))
+    with open(archive, 'wb') as stream:
+        stream.write(b'Rar!')
+
+    assert util.extract_files(archive, {'a': os.path.join(mod_dir, 'a')}) is None
+
+
+@needs_symlinks
+def test_links_are_created_after_files(tmpdir, mod_dir):
+    outside = tmpdir.join('outside')
+    outside.mkdir()
+
+    archive = str(tmpdir.join('test.tar'))
+    with tarfile.open(archive, 'w') as tf:
+        # This link comes first and would redirect the file below out of the mod folder.
+        _add_link(tf, 'data', str(outside))
+        _add_link(tf, 'up', '../outside')
+        _add_link(tf, 'sub/link.vp', 'real.vp')
+        _add_file(tf, 'data/a.vp', b'first')
+        _add_file(tf, 'sub/real.vp', b'second')
+
+    members = {
+        'data/a.vp': os.path.join(mod_dir, 'data', 'a.vp'),
+        'sub/real.vp': os.path.join(mod_dir, 'sub', 'real.vp')
+    }
+    hashes = util.extract_files(archive, members, mod_dir)
+
+    assert set(hashes.keys()) == {'data/a.vp', 'sub/real.vp'}
+    assert outside.listdir() == []
+    assert not os.path.islink(os.path.join(mod_dir, 'data'))
+    assert not os.path.lexists(os.path.join(mod_dir, 'up'))
+    assert os.readlink(os.path.join(mod_dir, 'sub', 'link.vp')) == 'real.vp'
+
+
+@needs_symlinks
+def test_existing_links_cant_redirect_files(tmpdir, mod_dir):
+    outside = tmpdir.join('outside')
+    outside.mkdir()
+    os.symlink(str(outside), os.path.join(mod_dir, 'data'))
+
+    archive = str(tmpdir.join('test.tar'))
+    with tarfile.open(archive, 'w') as tf:
+        _add_file(tf, 'data/a.vp', b'first')
+        _add_file(tf, 'b.vp', b'second')
+
+    members = {
+        'data/a.vp': os.path.join(mod_dir, 'data', 'a.vp'),
+        'b.vp': os.path.join(mod_dir, 'b.vp')
+    }
+    hashes = util.extract_files(archive, members, None, mod_dir)
+
+    assert hashes == {'b.vp': _md5(b'second')}
+    assert outside.listdir() == []
+
+
+
+def test_only_requested_members_are_written(tmpdir, mod_dir):
+    archive = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('data/a.vp', b'first')
+        zf.writestr('data/b.vp', b'second')
+        zf.writestr('data/c.vp', b'third')
+
+    # b.vp is already installed and must not be touched.
+    os.mkdir(os.path.join(mod_dir, 'data'))
+    with open(os.path.join(mod_dir, 'data', 'b.vp'), 'wb') as stream:
+        stream.write(b'modified')
+
+    hashes = util.extract_files(archive, {'data/c.vp': os.path.join(mod_dir, 'data', 'c.vp')}, mod_dir)
+
+    assert hashes == {'data/c.vp': _md5(b'third')}
+    assert _listdir(mod_dir) == ['data/b.vp', 'data/c.vp']
+    with open(os.path.join(mod_dir, 'data', 'b.vp'), 'rb') as stream:
+        assert stream.read() == b'modified'
+
+
+def test_unlisted_members_stay_inside(tmpdir, mod_dir):
+    archive = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('../escape/', b'')
+        zf.writestr('a.vp', b'first')
+
+    util.extract_files(archive, {'a.vp': os.path.join(mod_dir, 'a.vp')}, mod_dir)
+
+    assert not tmpdir.join('escape').check()
+    assert _listdir(str(tmpdir)) == ['mod/a.vp', 'test.zip']
+
+
+@pytest.mark.parametrize('ext,mode', [('tar', 'w'), ('tar.gz', 'w:gz'), ('tar.bz2', 'w:bz2')])
+def test_tar_progress(tmpdir, mod_dir, ext, mode):
+    archive = str(tmpdir.join('test.' + ext))
+    members = {}
+    with tarfile.open(archive, mode) as tf:
+        for i in range(4):
+            # Compresses very well so the uncompressed size is a lot bigger than the archive.
+            _add_file(tf, 'data/%d.vp' % i, b'\0' * 512 * 1024)
+            members['data/%d.vp' % i] = os.path.join(mod_dir, 'data', '%d.vp' % i)
+
+    updates = []
+    progress.reset()
+    progress.set_callback(lambda prog, text: updates.append(prog))
+    try:
+        util.extract_files(archive, members)
+    finally:
+        progress.reset()
+
+    assert len(updates) == 4
+    assert updates == sorted(updates)
+    assert 0.5 < updates[-1] <= 1
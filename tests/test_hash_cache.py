@@ -0,0 +1,78 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import hashlib
+
+from knossos import util
+from knossos.parallel import stat_key
+
+
+def test_hash_cache(tmpdir):
+    path = tmpdir.join('file')
+    path.write('content')
+    path = str(path)
+
+    cache = util.HashCache(str(tmpdir.join('hashes.db')))
+    key = stat_key(os.stat(path))
+    assert cache.get(path, key) is None
+
+    cache.set(path, key, 'abc')
+    assert cache.get(path, key) == 'abc'
+
+    # Entries survive a restart.
+    cache.close()
+    assert cache.get(path, key) == 'abc'
+
+    # and are dropped once the file changes.
+    other_key = (key[0] + 1,) + key[1:]
+    assert cache.get(path, other_key) is None
+    assert cache.get(path, key) is None
+    cache.close()
+
+
+def test_hash_cache_prune(tmpdir):
+    cache = util.HashCache()
+    paths = []
+    for i in range(5):
+        path = tmpdir.join(str(i))
+        path.write(str(i))
+        paths.append(str(path))
+        cache.remember(str(path), str(i))
+
+    os.unlink(paths[0])
+    with open(paths[1], 'a') as stream:
+        stream.write('changed')
+
+    assert cache.prune(limit=10) == 2
+    assert cache.get(paths[2], stat_key(os.stat(paths[2]))) == '2'
+    cache.close()
+
+
+def test_gen_hash_uses_cache(tmpdir):
+    path = tmpdir.join('file')
+    path.write('content')
+    path = str(path)
+
+    expected = hashlib.md5(b'content').hexdigest()
+    assert util.gen_hash(path) == expected
+
+    # A wrong cached value proves that the file isn't read again as long as it's unchanged.
+    util.HASH_CACHE.set(os.path.abspath(path), stat_key(os.stat(path)), 'cached')
+    assert util.gen_hash(path) == 'cached'
+    assert util.gen_hash(path, use_cache=False) == expected
+    util.HASH_CACHE.forget(path)
+
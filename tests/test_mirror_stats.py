@@ -0,0 +1,58 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import time
+
+from knossos import util
+
+
+def test_mirror_stats_ranking():
+    stats = util.MirrorStats()
+    stats.explore_chance = 0
+    links = ['http://slow.example/a.7z', 'http://fast.example/a.7z', 'http://broken.example/a.7z',
+             'http://new.example/a.7z']
+
+    stats.record(links[0], 10 * 1024 * 1024, 10)
+    stats.record(links[1], 10 * 1024 * 1024, 1)
+    stats.record(links[2], failed=True)
+
+    # Unknown mirrors are tried like the best known one.
+    assert stats.sort(links) in ([links[1], links[3], links[0], links[2]], [links[3], links[1], links[0], links[2]])
+
+    # Small transfers only measure latency.
+    stats.record(links[0], 1024, 0.001)
+    assert stats.get_score(links[0]) < stats.get_score(links[1])
+
+
+def test_mirror_stats_persistence():
+    stats = util.MirrorStats()
+    stats.max_hosts = 2
+    now = time.time()
+
+    stats.load({
+        'old-format.example': [1000, 1, 0],
+        'expired.example': [1000, 1, 0, now - stats.max_age - 60],
+        'broken': 'nonsense'
+    })
+    assert sorted(stats.dump().keys()) == ['old-format.example']
+
+    stats.record('http://a.example/x', 10 * 1024 * 1024, 1)
+    stats.record('http://b.example/x', 10 * 1024 * 1024, 1)
+    assert sorted(stats.dump().keys()) == ['a.example', 'b.example']
+
+    copy = util.MirrorStats()
+    copy.load(stats.dump())
+    assert copy.get_score('http://a.example/y') == stats.get_score('http://a.example/x')
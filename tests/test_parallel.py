@@ -0,0 +1,91 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import hashlib
+
+import pytest
+
+from knossos import parallel, util
+
+import jobs
+
+
+@pytest.fixture
+def pool():
+    parallel.set_workers(2)
+    yield
+    parallel.shutdown()
+    parallel.set_workers(0)
+
+
+def test_hash_file(tmpdir):
+    path = tmpdir.join('file')
+    path.write_binary(b'content')
+
+    path, chksum, key = parallel.hash_file((str(path), 'sha256'))
+    assert chksum == hashlib.sha256(b'content').hexdigest()
+    assert key == parallel.stat_key(os.stat(path))
+
+    assert parallel.hash_file((str(tmpdir.join('missing')), 'md5')) == (str(tmpdir.join('missing')), None, None)
+
+
+def test_imap_keeps_order(pool):
+    assert list(parallel.imap(jobs.square, range(50), 4)) == [i * i for i in range(50)]
+
+
+def test_gen_hashes(tmpdir, pool):
+    paths = []
+    for i in range(20):
+        path = tmpdir.join('file%d' % i)
+        path.write_binary(os.urandom(i * 1000))
+        paths.append(str(path))
+
+    paths.insert(5, str(tmpdir.join('missing')))
+    expected = []
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, 'rb') as stream:
+                expected.append((path, hashlib.md5(stream.read()).hexdigest()))
+        else:
+            expected.append((path, None))
+
+    assert list(util.gen_hashes(paths, use_cache=False)) == expected
+
+
+
+def test_run(pool):
+    updates = []
+    assert parallel.run(jobs.report_twice, (42,), lambda p, t: updates.append((p, t)),
+                        interval=0.01) == 42
+
+    # Updates are relayed asynchronously so some of them can be skipped.
+    assert set(updates) <= {(0.5, 'half'), (1, 'done')}
+
+
+def test_run_falls_back_to_the_current_thread(monkeypatch):
+    def fail():
+        raise OSError('no processes here')
+
+    monkeypatch.setattr(parallel, 'get_pool', fail)
+    updates = []
+    assert parallel.run(jobs.report_twice, (42,), lambda p, t: updates.append((p, t))) == 42
+    assert updates == [(0.5, 'half'), (1, 'done')]
+
+
+def test_pool_processes_start_fresh(pool):
+    # A forked process would inherit the modules (and the locks held by their threads) of the UI process.
+    assert parallel.run(jobs.get_loaded, (['knossos.util', 'knossos.parallel'],)) == ['knossos.parallel']
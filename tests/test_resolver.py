@@ -0,0 +1,103 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import json
+
+import pytest
+
+from knossos import repo, util
+from bench_resolver import generate, legacy_process_pkg_selection
+
+
+def _resolve(func, pkgs):
+    try:
+        return func(pkgs)
+    except repo.PackageNotFound:
+        return 'conflict'
+
+
+def _mod(mid, version, deps=(), pkg_names=('Core',)):
+    return {
+        'id': mid,
+        'title': mid,
+        'version': version,
+        'packages': [{
+            'name': name,
+            'status': 'required',
+            'dependencies': [{'id': dep, 'version': spec, 'packages': []} for dep, spec in deps],
+            'files': [],
+            'filelist': []
+        } for name in pkg_names]
+    }
+
+
+def _make_repo(mods):
+    r = repo.Repo()
+    r.parse(json.dumps({'mods': mods}))
+    return r
+
+
+# The resolver has to pick the same packages as the breadth-first implementation it replaced.
+@pytest.mark.parametrize('mod_count,version_count,dep_count', [(30, 3, 2), (50, 4, 3), (40, 3, 4)])
+def test_matches_legacy(mod_count, version_count, dep_count):
+    r = generate(mod_count, version_count, dep_count)
+
+    for mid in sorted(r.mods.keys())[:20]:
+        for mod in r.mods[mid]:
+            expected = _resolve(legacy_process_pkg_selection, mod.packages)
+            assert _resolve(r.process_pkg_selection, mod.packages) == expected
+
+
+def test_picks_latest_matching_version():
+    r = _make_repo([
+        _mod('base', '1.0.0'),
+        _mod('base', '1.2.0'),
+        _mod('base', '2.0.0'),
+        _mod('a', '1.0.0', [('base', '>=1.0.0')]),
+        _mod('b', '1.0.0', [('base', '<2.0.0')]),
+    ])
+    roots = r.query('a').packages + r.query('b').packages
+    result = r.process_pkg_selection(roots)
+
+    assert set(result) == set(roots) | set(r.query('base', util.get_spec('==1.2.0')).packages)
+
+
+def test_conflict():
+    r = _make_repo([
+        _mod('base', '1.0.0'),
+        _mod('base', '2.0.0'),
+        _mod('a', '1.0.0', [('base', '==1.0.0')]),
+        _mod('b', '1.0.0', [('base', '==2.0.0')]),
+    ])
+    roots = r.query('a').packages + r.query('b').packages
+
+    with pytest.raises(repo.PackageNotFound):
+        legacy_process_pkg_selection(roots)
+
+    with pytest.raises(repo.PackageNotFound):
+        r.process_pkg_selection(roots)
+
+
+def test_cache_is_invalidated_by_changes():
+    r = _make_repo([
+        _mod('base', '1.0.0'),
+        _mod('a', '1.0.0', [('base', '>=1.0.0')]),
+    ])
+    roots = r.query('a').packages
+    assert r.query('base', util.get_spec('==1.0.0')).packages[0] in r.process_pkg_selection(roots)
+
+    r.add_mod(repo.Mod(_mod('base', '1.1.0'), r))
+    assert r.query('base', util.get_spec('==1.1.0')).packages[0] in r.process_pkg_selection(roots)
@@ -0,0 +1,195 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import time
+import threading
+
+import pytest
+
+# center has to be loaded before qt (qt -> clibs -> center -> qt).
+from knossos import center  # noqa
+from knossos import progress
+
+
+class _RecordTask(progress.Task):
+
+    def __init__(self, name, log, count=3, priority=None, resource=progress.RESOURCE_CPU, gate=None):
+        if priority is not None:
+            self.priority = priority
+
+        self.resource = resource
+        super(_RecordTask, self).__init__(work=[(name, i) for i in range(count)])
+        self._log = log
+        self._gate = gate
+
+    def work(self, item):
+        if self._gate is not None:
+            self._gate.wait(5)
+
+        self._log.append(item)
+
+
+def _wait(cond, timeout=5):
+    end = time.time() + timeout
+    while not cond():
+        if time.time() > end:
+            return False
+
+        time.sleep(0.01)
+
+    return True
+
+
+@pytest.fixture
+def master():
+    m = progress.Master()
+    m.set_pool_size(progress.RESOURCE_CPU, 1)
+    m.start_workers()
+    yield m
+    m.stop_workers()
+
+
+# Occupies the only CPU worker until the returned event is set.
+def _block(master, log):
+    gate = threading.Event()
+    blocker = _RecordTask('blocker', log, 1, gate=gate)
+    master.add_task(blocker)
+    assert _wait(lambda: blocker._running == 1)
+    return gate
+
+
+def test_priority(master):
+    log = []
+    gate = _block(master, log)
+
+    low = _RecordTask('low', log, priority=progress.PRIORITY_BACKGROUND)
+    high = _RecordTask('high', log, priority=progress.PRIORITY_HIGH)
+    master.add_task(low)
+    master.add_task(high)
+    gate.set()
+
+    assert _wait(lambda: len(log) == 7)
+    assert [name for name, i in log] == ['blocker'] + ['high'] * 3 + ['low'] * 3
+
+
+def test_background_tasks_default_to_low_priority():
+    class Background(progress.Task):
+        background = True
+
+    assert Background().priority == progress.PRIORITY_BACKGROUND
+    assert progress.Task().priority == progress.PRIORITY_NORMAL
+
+
+def test_round_robin(master):
+    log = []
+    gate = _block(master, log)
+
+    master.add_task(_RecordTask('a', log))
+    master.add_task(_RecordTask('b', log))
+    gate.set()
+
+    assert _wait(lambda: len(log) == 7)
+    assert log[1:] == [('a', 0), ('b', 0), ('a', 1), ('b', 1), ('a', 2), ('b', 2)]
+
+
+def test_resource_classes_dont_share_workers(master):
+    log = []
+    gate = _block(master, log)
+
+    master.add_task(_RecordTask('io', log, resource=progress.RESOURCE_IO))
+    assert _wait(lambda: len(log) == 3)
+    assert [name for name, i in log] == ['io'] * 3
+
+    gate.set()
+
+
+class _StepTask(progress.MultistepTask):
+    _steps = 1
+    resource = progress.RESOURCE_CPU
+
+    def __init__(self, name, log, gate=None):
+        super(_StepTask, self).__init__()
+        self._name = name
+        self._log = log
+        self._gate = gate
+
+    def init1(self):
+        self.add_work([self._name])
+
+    def work1(self, name):
+        if self._gate is not None:
+            self._gate.wait(5)
+
+        self._log.append(name)
+
+
+@pytest.fixture
+def elastic_master():
+    m = progress.Master()
+    m.set_pool_size(progress.RESOURCE_CPU, 4)
+    m._pools[progress.RESOURCE_CPU].idle_timeout = 0.2
+    m.start_workers()
+    yield m
+    m.stop_workers()
+
+
+def test_pool_grows_and_shrinks(elastic_master):
+    pool = elastic_master._pools[progress.RESOURCE_CPU]
+    assert len(pool._workers) == pool.min_workers
+
+    log = []
+    gate = threading.Event()
+    elastic_master.add_task(_RecordTask('a', log, 10, gate=gate))
+    assert _wait(lambda: len(pool._workers) == 4)
+
+    gate.set()
+    assert _wait(lambda: len(log) == 10)
+    assert _wait(lambda: len(pool._workers) == pool.min_workers)
+
+
+def test_pool_size_limit(elastic_master):
+    pool = elastic_master._pools[progress.RESOURCE_CPU]
+    log = []
+    gate = threading.Event()
+    elastic_master.add_task(_RecordTask('a', log, 10, gate=gate))
+    assert _wait(lambda: len(pool._workers) == 4)
+
+    # Surplus workers quit once they're done with their current work.
+    elastic_master.set_pool_size(progress.RESOURCE_CPU, 2)
+    gate.set()
+    assert _wait(lambda: len(log) == 10)
+    assert len(pool._workers) <= 2
+
+
+def test_multistep_tasks_start_while_the_pool_is_busy(elastic_master):
+    pool = elastic_master._pools[progress.RESOURCE_CPU]
+    log = []
+    gate = threading.Event()
+
+    first = _StepTask('first', log, gate)
+    elastic_master.add_task(first)
+    assert _wait(lambda: first._cur_step == 0 and first._running == 1)
+    # Only the worker which is stuck in the first task is left.
+    assert _wait(lambda: len(pool._workers) == 1)
+
+    # The second task has nothing in its queue until its first step was initialized.
+    elastic_master.add_task(_StepTask('second', log))
+    try:
+        assert _wait(lambda: log == ['second'], 2)
+    finally:
+        gate.set()
+
+    assert _wait(lambda: log == ['second', 'first'])
@@ -0,0 +1,129 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import json
+
+from knossos import repo, snapshot
+
+
+DATA = {'mods': [{'id': 'test', 'version': '1.0.0', 'values': [1, 2.5, None, True, (1, 2)]}], 'pins': {}}
+
+
+def test_roundtrip(tmpdir):
+    path = str(tmpdir.join('snap'))
+    snapshot.save(path, DATA, [b'first', b'', b'{"a": 1}'])
+
+    data, blobs = snapshot.load(path)
+    assert data == DATA
+    assert [b.get_bytes() for b in blobs] == [b'first', b'', b'{"a": 1}']
+    assert blobs[2].load_json() == {'a': 1}
+    assert not tmpdir.join('snap.tmp').exists()
+
+
+def test_missing(tmpdir):
+    assert snapshot.load(str(tmpdir.join('missing'))) is None
+
+
+def test_damaged(tmpdir):
+    path = tmpdir.join('snap')
+    snapshot.save(str(path), DATA)
+
+    raw = bytearray(path.read_binary())
+    raw[-3] ^= 0xff
+    path.write_binary(bytes(raw))
+    assert snapshot.load(str(path)) is None
+
+    # Truncated files are rejected as well.
+    path.write_binary(bytes(raw[:snapshot.HEADER.size - 1]))
+    assert snapshot.load(str(path)) is None
+
+    snapshot.save(str(path), DATA)
+    path.write_binary(path.read_binary()[:-1])
+    assert snapshot.load(str(path)) is None
+
+
+def test_version_mismatch(tmpdir, monkeypatch):
+    path = str(tmpdir.join('snap'))
+    snapshot.save(path, DATA)
+    assert snapshot.load(path) is not None
+
+    monkeypatch.setattr(snapshot, '_PY_VERSION', (2, 7))
+    assert snapshot.load(path) is None
+
+    monkeypatch.undo()
+    monkeypatch.setattr(snapshot, 'FORMAT_VERSION', snapshot.FORMAT_VERSION + 1)
+    assert snapshot.load(path) is None
+
+
+def test_repo_roundtrip(tmpdir):
+    files = [{'filename': 'test.7z', 'dest': '', 'checksum': ['sha256', 'abc'], 'filesize': 10, 'urls': []}]
+    filelist = [{'filename': 'data/test.vp', 'archive': 'test.7z', 'orig_name': 'data/test.vp',
+                 'checksum': ['sha256', 'def']}]
+
+    r = repo.Repo()
+    r.parse(json.dumps({'mods': [{
+        'id': 'test',
+        'title': 'Test',
+        'version': '1.0.0',
+        'packages': [{'name': 'Core', 'status': 'required', 'files': files, 'filelist': filelist}]
+    }]}))
+
+    path = str(tmpdir.join('mods.snap'))
+    r.save_snapshot(path)
+
+    loaded = repo.Repo()
+    assert loaded.load_snapshot(path)
+    assert loaded.get() == r.get()
+
+    pkg = loaded.query('test').packages[0]
+    assert pkg.files['test.7z']['filesize'] == 10
+    assert pkg.filelist[0]['filename'] == 'data/test.vp'
+
+    # A damaged snapshot tells the caller to fall back to JSON.
+    tmpdir.join('mods.snap').write_binary(b'garbage')
+    assert not repo.Repo().load_snapshot(path)
+
+
+def test_installed_roundtrip(tmpdir):
+    engine = repo.InstalledMod({
+        'id': 'fso',
+        'title': 'FSO',
+        'type': 'engine',
+        'version': '3.8.0',
+        'folder': str(tmpdir.join('fso')),
+        'notes': 'Needs OpenAL',
+        'check_notes': 'Some files are missing.',
+        'actions': [{'type': 'delete', 'paths': ['old.exe']}],
+        'packages': [{'name': 'Linux', 'status': 'required', 'files': [], 'filelist': [],
+                      'check_notes': 'fs2_open is missing.'}]
+    })
+
+    r = repo.InstalledRepo()
+    r.add_mod(engine)
+
+    path = str(tmpdir.join('installed.snap'))
+    r.save_snapshot(path)
+
+    loaded = repo.InstalledRepo()
+    assert loaded.load_snapshot(path)
+
+    mod = loaded.query('fso')
+    assert mod.mtype == 'engine'
+    assert mod.folder == engine.folder
+    assert mod.notes == 'Needs OpenAL'
+    assert mod.check_notes == 'Some files are missing.'
+    assert mod.actions == [{'type': 'delete', 'paths': ['old.exe']}]
+    assert mod.packages[0].check_notes == 'fs2_open is missing.'
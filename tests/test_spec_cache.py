@@ -0,0 +1,46 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+from knossos import util
+
+
+def test_lru_cache():
+    calls = []
+
+    def factory(key):
+        calls.append(key)
+        return key * 2
+
+    cache = util.LRUCache(2)
+    assert cache.get(1, factory) == 2
+    assert cache.get(2, factory) == 4
+    assert cache.get(1, factory) == 2
+    assert calls == [1, 2]
+
+    # 2 is the least recently used entry now.
+    cache.get(3, factory)
+    cache.get(1, factory)
+    cache.get(2, factory)
+    assert calls == [1, 2, 3, 2]
+
+    cache.clear()
+    cache.get(1, factory)
+    assert calls == [1, 2, 3, 2, 1]
+
+
+def test_spec_cache_shares_instances():
+    assert util.get_spec('>=1.0.0') is util.get_spec('>=1.0.0')
+    assert util.get_version('1.2.3') is util.get_version('1.2.3')
@@ -0,0 +1,450 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import hashlib
+
+import pytest
+
+# The import order matters: qt -> clibs -> center -> qt and tasks -> api -> tasks are cycles.
+from knossos import center
+from knossos import api  # noqa
+from knossos import repo, tasks, util
+
+
+def _file(name, archive):
+    return {'filename': name, 'archive': archive, 'orig_name': 'orig/' + name, 'checksum': ['md5', name]}
+
+
+@pytest.fixture
+def installed(tmpdir, monkeypatch):
+    monkeypatch.setitem(center.settings, 'base_path', str(tmpdir))
+    monkeypatch.setattr(center, 'installed', repo.InstalledRepo())
+    return center.installed
+
+
+@pytest.fixture
+def mod(installed):
+    r = repo.Repo()
+    r.parse(json.dumps({'mods': [{
+        'id': 'test',
+        'title': 'Test',
+        'version': '1.0.0',
+        'packages': [{
+            'name': 'Core',
+            'status': 'required',
+            'files': [],
+            'filelist': [_file('data/a.vp', 'core.7z'), _file('data/b.vp', 'core.7z'), _file('data/c.vp', 'maps.7z')]
+        }, {
+            'name': 'Extra',
+            'status': 'optional',
+            'files': [],
+            'filelist': [_file('data/d.vp', 'extra.7z')]
+        }]
+    }]}))
+
+    mod = r.query('test')
+    for pkg in mod.packages:
+        installed.add_pkg(pkg)
+
+    return installed.query('test')
+
+
+def _summary(corrupt=(), missing=()):
+    return {'ok': 0, 'corrupt': list(corrupt), 'missing': list(missing)}
+
+
+def test_repair_only_fetches_damaged_files(mod):
+    core, extra = mod.packages
+    results = [
+        (core, False, 2, _summary(['data/a.vp'], ['data/c.vp'])),
+        (extra, True, 1, _summary()),
+        (None, False, 0, _summary(['unknown.vp']))
+    ]
+
+    task = tasks.RepairTask(mod, results, check_after=False)
+
+    # Intact packages are left alone.
+    assert [pkg.name for pkg in task._pkgs] == ['Core']
+    assert task._get_archives() == {
+        ('test', 'Core', 'core.7z'): {'orig/data/a.vp'},
+        ('test', 'Core', 'maps.7z'): {'orig/data/c.vp'}
+    }
+
+
+def test_repair_of_intact_mod(mod):
+    results = [(pkg, True, 1, _summary()) for pkg in mod.packages]
+    task = tasks.RepairTask(mod, results, check_after=False)
+
+    assert task._pkgs == []
+    assert task._get_archives() == {}
+
+
+class _FakeTask(object):
+    aborted = False
+
+    def __init__(self):
+        self.work = []
+
+    def add_work(self, items):
+        self.work.extend(items)
+
+
+def test_pipeline_stage_limit():
+    task = _FakeTask()
+    stage = tasks._PipelineStage(task, 'download', 2)
+
+    for i in range(5):
+        stage.submit(i)
+
+    assert task.work == [('download', 0), ('download', 1)]
+
+    # Every released slot is handed to the next waiting item.
+    stage.release()
+    assert task.work[2:] == [('download', 2)]
+    assert stage._active == 2
+
+    for i in range(4):
+        stage.release()
+
+    assert task.work[3:] == [('download', 3), ('download', 4)]
+    assert stage._active == 0
+
+
+def test_pipeline_stage_abort():
+    task = _FakeTask()
+    stage = tasks._PipelineStage(task, 'extract', 1)
+    stage.submit('a')
+    stage.submit('b')
+
+    task.aborted = True
+    stage.release()
+
+    assert task.work == [('extract', 'a')]
+    assert stage._active == 0
+
+
+@pytest.fixture
+def install_task(installed, monkeypatch):
+    task = tasks.InstallTask([], check_after=False)
+    monkeypatch.setattr(task, '_get_archives', lambda: {})
+    task.init2()
+    return task
+
+
+def _fail(*args, **kwargs):
+    raise OSError(28, 'No space left on device')
+
+
+def _run_queued(task):
+    while task._work:
+        task.work2(task._work.popleft())
+
+
+def test_failed_download_leaves_the_pipeline(install_task, monkeypatch):
+    monkeypatch.setattr(tasks.util, 'download_segmented', _fail)
+    archive = {'filename': 'test.7z', 'urls': ['http://localhost/test.7z'], 'md5sum': 'abc'}
+
+    for i in range(install_task.max_in_flight + 1):
+        install_task._stages['download'].submit(dict(archive))
+
+    _run_queued(install_task)
+
+    assert install_task._error
+    assert install_task._tmp_dirs == set()
+    assert install_task._stages['download']._active == 0
+
+
+def test_failed_verify_leaves_the_pipeline(install_task, tmpdir, monkeypatch):
+    monkeypatch.setattr(tasks.util, 'gen_hash', _fail)
+    archive = {'filename': 'test.7z', 'urls': [], 'md5sum': 'abc'}
+    tpath = str(tmpdir.join('tmp'))
+    os.mkdir(tpath)
+
+    install_task._stages['download'].submit(archive)
+    install_task._work.clear()
+    install_task._stages['verify'].submit(archive, tpath, os.path.join(tpath, 'test.7z'))
+    _run_queued(install_task)
+
+    assert install_task._error
+    assert not os.path.exists(tpath)
+    assert install_task._stages['download']._active == 0
+    assert install_task._stages['verify']._active == 0
+
+
+ARCHIVE_DATA = os.urandom(1000)
+
+
+@pytest.fixture
+def partial_downloads(tmpdir, monkeypatch):
+    store = util.PartialDownloads()
+    store.open(str(tmpdir.join('downloads')))
+    monkeypatch.setattr(util, 'PARTIAL_DOWNLOADS', store)
+    return store
+
+
+def _new_install_task(monkeypatch):
+    task = tasks.InstallTask([], check_after=False)
+    monkeypatch.setattr(task, '_get_archives', lambda: {})
+    monkeypatch.setattr(task, '_install_archive', lambda *args: None)
+    task.init2()
+    return task
+
+
+def _install(task, archive):
+    task._stages['download'].submit(dict(archive))
+    _run_queued(task)
+
+
+def test_segmented_download_resumes_in_the_next_task(partial_downloads, installed, monkeypatch):
+    archive = {'filename': 'test.7z', 'urls': ['http://localhost/test.7z'],
+               'md5sum': hashlib.md5(ARCHIVE_DATA).hexdigest()}
+    first = _new_install_task(monkeypatch)
+
+    def interrupted(urls, path, segments=None, parts=None):
+        with open(path, 'wb') as stream:
+            stream.write(ARCHIVE_DATA[:300] + b'\0' * 200 + ARCHIVE_DATA[500:800] + b'\0' * 200)
+
+        parts[:] = [[0, 300, 500], [500, 800, 1000]]
+        first.aborted = True
+        return False
+
+    monkeypatch.setattr(util, 'download_segmented', interrupted)
+    _install(first, archive)
+
+    path = os.path.join(partial_downloads._path, archive['md5sum'])
+    assert partial_downloads.load_state(path) == ('test.7z', [[0, 300, 500], [500, 800, 1000]])
+
+    requested = []
+
+    def resumed(urls, path, segments=None, parts=None):
+        requested.append([list(p) for p in parts])
+        with open(path, 'r+b') as stream:
+            for part in parts:
+                stream.seek(part[1])
+                stream.write(ARCHIVE_DATA[part[1]:part[2]])
+                part[1] = part[2]
+
+        return True
+
+    second = _new_install_task(monkeypatch)
+    monkeypatch.setattr(util, 'download_segmented', resumed)
+    _install(second, archive)
+
+    assert requested == [[[0, 300, 500], [500, 800, 1000]]]
+    assert not second._error
+    # The folder is removed once the archive is installed.
+    assert not os.path.exists(path)
+
+
+def test_sequential_download_resumes_in_the_next_task(partial_downloads, installed, monkeypatch):
+    archive = {'filename': 'test.zip', 'urls': ['http://localhost/test.zip'],
+               'md5sum': hashlib.md5(ARCHIVE_DATA).hexdigest()}
+    monkeypatch.setattr(util, 'download_segmented', lambda *args, **kwargs: None)
+    first = _new_install_task(monkeypatch)
+
+    def interrupted(url, stream, hasher=None):
+        stream.write(ARCHIVE_DATA[:400])
+        first.aborted = True
+        return False
+
+    monkeypatch.setattr(util, 'download', interrupted)
+    _install(first, archive)
+
+    offsets = []
+
+    def resumed(url, stream, hasher=None):
+        offsets.append(stream.tell())
+        stream.write(ARCHIVE_DATA[400:])
+        hasher.update(ARCHIVE_DATA[400:])
+        return True
+
+    second = _new_install_task(monkeypatch)
+    monkeypatch.setattr(util, 'download', resumed)
+    _install(second, archive)
+
+    assert offsets == [400]
+    assert not second._error
+    assert os.listdir(partial_downloads._path) == []
+
+
+class _FakeWatcher(object):
+
+    def __init__(self):
+        self.ready = False
+        self.timeouts = []
+        self.pops = 0
+
+    def set_paths(self, paths):
+        pass
+
+    def set_files(self, files):
+        pass
+
+    def wait_ready(self, timeout=None):
+        self.timeouts.append(timeout)
+        return self.ready
+
+    def pop_changes(self):
+        # Like the real thing, the first call after the watcher became ready doesn't know what changed.
+        self.pops += 1
+        return None if self.pops == 1 else set()
+
+
+def test_check_doesnt_wait_for_the_watcher(installed, monkeypatch):
+    fake = _FakeWatcher()
+    monkeypatch.setattr(center, 'file_watcher', fake)
+    monkeypatch.setitem(center.settings, 'base_dirs', [])
+
+    first = tasks.CheckTask()
+    first.init1()
+
+    assert fake.timeouts == [0]
+    assert first._changes is None
+
+    # The watches were added while we looked for mods.
+    fake.ready = True
+    first._done.set()
+    first.init2()
+    assert fake.pops == 1
+
+    second = tasks.CheckTask()
+    second.init1()
+    assert second._changes == set()
+
+
+class _FakeResponse(object):
+
+    def __init__(self, link, text, etag):
+        self.url = link
+        self.text = text
+        self.headers = {'etag': etag}
+
+
+class _FakeServer(object):
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+
+    def get(self, link, headers=None, random_ua=False, raw=False):
+        text = self.files[link]
+        etag = hashlib.md5(text.encode('utf8')).hexdigest()
+        self.requests.append(link)
+
+        if (headers or {}).get('If-None-Match') == etag:
+            return 304
+
+        return _FakeResponse(link, text, etag)
+
+
+REPO_LINK = 'http://localhost/repo.json'
+
+
+def _repo_text(version):
+    mods = []
+    for mid in ('first', 'second'):
+        mods.append({
+            'id': mid,
+            'title': mid,
+            'version': version if mid == 'second' else '1.0.0',
+            'packages': [{'name': 'Core', 'status': 'required', 'files': [], 'filelist': []}]
+        })
+
+    return json.dumps({'mods': mods})
+
+
+@pytest.fixture
+def fetch_env(tmpdir, monkeypatch):
+    server = _FakeServer()
+    server.files[REPO_LINK] = _repo_text('1.0.0')
+    decoded = []
+
+    def decode_repo(task, text):
+        decoded.append(text)
+        return tasks.parallel.decode_repo(text, True)
+
+    monkeypatch.setattr(util, 'get', server.get)
+    monkeypatch.setattr(tasks.FetchTask, '_decode_repo', decode_repo)
+    monkeypatch.setattr(tasks, 'run_task', lambda task: None)
+    monkeypatch.setattr(api, 'save_settings', lambda: None)
+    monkeypatch.setattr(repo, 'CPU_INFO', {})
+    monkeypatch.setattr(center, 'settings_path', str(tmpdir))
+    monkeypatch.setitem(center.settings, 'repos', [(REPO_LINK, 'Test')])
+    monkeypatch.setattr(center, 'mods', None)
+    monkeypatch.setattr(util, 'HTTP_CACHE', util.HttpCache())
+    return server, decoded
+
+
+def _fetch():
+    task = tasks.FetchTask()
+    while task._work:
+        task.work(task._work.popleft())
+
+    task._done.set()
+    task.finish()
+
+
+# Simulates a new start of Knossos.
+def _restart():
+    center.mods = repo.Repo()
+    assert center.mods.load_snapshot(os.path.join(center.settings_path, 'mods.snap'))
+
+    util.HTTP_CACHE = util.HttpCache()
+    util.HTTP_CACHE.open(os.path.join(center.settings_path, 'http_cache'))
+
+
+def test_fetch_reuses_the_mod_list_after_a_restart(fetch_env):
+    server, decoded = fetch_env
+    util.HTTP_CACHE.open(os.path.join(center.settings_path, 'http_cache'))
+
+    _fetch()
+    assert len(decoded) == 1
+
+    _restart()
+    first = center.mods.query('first')
+    _fetch()
+
+    # The server was asked but nothing was parsed again.
+    assert server.requests == [REPO_LINK] * 2
+    assert len(decoded) == 1
+    assert center.mods.query('first') is first
+
+    server.files[REPO_LINK] = _repo_text('1.1.0')
+    _restart()
+    first = center.mods.query('first')
+    _fetch()
+
+    assert len(decoded) == 2
+    assert center.mods.query('first') is first
+    assert str(center.mods.query('second').version) == '1.1.0'
+
+
+def test_fetch_parses_if_the_cache_doesnt_match(fetch_env):
+    server, decoded = fetch_env
+    util.HTTP_CACHE.open(os.path.join(center.settings_path, 'http_cache'))
+
+    _fetch()
+
+    # The cached response changed but the mod list wasn't saved (i.e. because the fetch failed).
+    util.HTTP_CACHE.set(REPO_LINK, {'url': REPO_LINK, 'etag': None, 'last_modified': None, 'text': _repo_text('2.0.0')})
+    server.files[REPO_LINK] = _repo_text('2.0.0')
+    _restart()
+    _fetch()
+
+    assert len(decoded) == 2
+    assert str(center.mods.query('second').version) == '2.0.0'
@@ -0,0 +1,123 @@
+## Copyright 2017 Knossos authors, see NOTICE file
+##
+## Licensed under the Apache License, Version 2.0 (the "License");
+## you may not use this file except in compliance with the License.
+## You may obtain a copy of the License at
+##
+##     http://www.apache.org/licenses/LICENSE-2.0
+##
+## Unless required by applicable law or agreed to in writing, software
+## distributed under the License is distributed on an "AS IS" BASIS,
+## WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+## See the License for the specific language governing permissions and
+## limitations under the License.
+
+from __future__ import absolute_import, print_function
+
+import os
+import time
+
+import pytest
+
+from knossos import watcher
+
+
+def _wait_for_changes(w, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+        if w.has_changes():
+            # Give the watcher a moment to pick up the rest of the events.
+            time.sleep(0.2)
+            return w.pop_changes()
+
+        time.sleep(0.05)
+
+    return w.pop_changes()
+
+
+def _write(path, data='data'):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as stream:
+        stream.write(data)
+
+
+@pytest.fixture
+def mod_dir(tmpdir):
+    path = str(tmpdir.join('mod'))
+    _write(os.path.join(path, 'data', 'a.vp'))
+    _write(os.path.join(path, 'mod.json'), '{}')
+    return path
+
+
+def _start(mod_dir, monkeypatch, poll):
+    if poll:
+        monkeypatch.setattr(watcher, '_libc', None)
+    elif watcher._libc is None:
+        pytest.skip('inotify is not available')
+
+    w = watcher.Watcher(interval=0.2, poll=poll)
+    w.set_files([os.path.join(mod_dir, 'data', 'a.vp'), os.path.join(mod_dir, 'data', 'b.vp')])
+    w.set_paths([mod_dir])
+    assert w.wait_ready(5)
+
+    # We don't know what happened before the watches were in place.
+    assert w.pop_changes() is None
+    assert w.pop_changes() == set()
+    return w
+
+
+@pytest.mark.parametrize('poll', [False, True])
+def test_reports_package_files(mod_dir, monkeypatch, poll):
+    w = _start(mod_dir, monkeypatch, poll)
+    try:
+        _write(os.path.join(mod_dir, 'data', 'a.vp'), 'changed')
+        _write(os.path.join(mod_dir, 'data', 'b.vp'))
+        _write(os.path.join(mod_dir, 'mod.json'), '{"changed": true}')
+
+        changes = _wait_for_changes(w)
+        assert changes is not None
+        assert {os.path.join(mod_dir, 'data', 'a.vp'), os.path.join(mod_dir, 'data', 'b.vp'),
+                os.path.join(mod_dir, 'mod.json')} <= changes
+    finally:
+        w.stop()
+
+
+@pytest.mark.parametrize('poll', [False, True])
+def test_ignores_other_files(mod_dir, monkeypatch, poll):
+    w = _start(mod_dir, monkeypatch, poll)
+    try:
+        _write(os.path.join(mod_dir, 'fs2_open.log'))
+        _write(os.path.join(mod_dir, 'data', 'players', 'pilot.plr'))
+
+        assert not _wait_for_changes(w, 1)
+    finally:
+        w.stop()
+
+
+def test_is_relevant(tmpdir):
+    w = watcher.Watcher()
+    path = os.path.join(str(tmpdir), 'mod', 'Data', 'A.vp')
+    assert w._is_relevant(path)
+
+    w.set_files([path])
+    assert w._is_relevant(path.lower())
+    assert w._is_relevant(os.path.join(str(tmpdir), 'mod', 'data'))
+    assert w._is_relevant(os.path.join(str(tmpdir), 'other', 'MOD.INI'))
+    assert not w._is_relevant(os.path.join(str(tmpdir), 'mod', 'data', 'b.vp'))
+
+    w.set_files(None)
+    assert w._is_relevant(os.path.join(str(tmpdir), 'mod', 'data', 'b.vp'))
+
+
+def test_polling_is_opt_in(mod_dir, monkeypatch):
+    monkeypatch.setattr(watcher, '_libc', None)
+
+    w = watcher.Watcher()
+    assert not w.is_supported()
+
+    w.set_paths([mod_dir])
+    assert not w.is_active()
+    assert not w.wait_ready(0)
+    assert w.pop_changes() is None
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Compares the dependency resolver (knossos.resolver) with the previous breadth-first implementation
+of Repo.process_pkg_selection on a generated mod repository.
+
+Usage: bench_resolver.py [mods] [versions per mod] [dependencies per package] [runs]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from knossos import repo  # noqa
+
+
+def legacy_process_pkg_selection(pkgs):
+    """The implementation of Repo.process_pkg_selection before knossos.resolver was added."""
+    dep_dict = {}
+    ndeps = pkgs
+
+    while len(ndeps) > 0:
+        _nd = ndeps
+        ndeps = []
+
+        for pkg in _nd:
+            for dep, version in pkg.resolve_deps():
+                mid = dep.get_mod().mid
+
+                if mid not in dep_dict:
+                    dep_dict[mid] = {}
+
+                if dep.name not in dep_dict[mid]:
+                    dep_dict[mid][dep.name] = {}
+
+                if version not in dep_dict[mid][dep.name]:
+                    dep_dict[mid][dep.name][version] = dep
+                    ndeps.append(dep)
+
+    dep_list = set()
+    for mid, deps in dep_dict.items():
+        for name, variants in deps.items():
+            if len(variants) == 1:
+                dep_list.add(next(iter(variants.values())))
+            else:
+                specs = variants.keys()
+                remains = []
+
+                for v in variants.values():
+                    if all(spec.match(v.get_mod().version) for spec in specs):
+                        remains.append(v)
+
+                if len(remains) == 0:
+                    raise repo.PackageNotFound('Conflict', mid, name)
+                else:
+                    remains.sort(key=lambda v: v.get_mod().version)
+                    dep_list.add(remains[-1])
+
+    dep_list |= set(pkgs)
+    return dep_list
+
+
+def generate(mod_count, version_count, dep_count):
+    """Generates a layered repository. Every mod depends on a few mods in the following layers."""
+    rand = random.Random(42)
+    mods = []
+
+    for i in range(mod_count):
+        for v in range(version_count):
+            deps = []
+            if i + 1 < mod_count:
+                for d in rand.sample(range(i + 1, min(mod_count, i + 20)), min(dep_count, mod_count - i - 1)):
+                    deps.append({'id': 'mod%d' % d, 'version': '>=1.%d.0' % rand.randint(0, version_count - 1),
+                                 'packages': []})
+
+            mods.append({
+                'id': 'mod%d' % i,
+                'title': 'Mod %d' % i,
+                'version': '1.%d.0' % v,
+                'packages': [{
+                    'name': 'Core',
+                    'status': 'required',
+                    'dependencies': deps,
+                    'files': [],
+                    'filelist': []
+                }]
+            })
+
+    r = repo.Repo()
+    r.parse(json.dumps({'mods': mods}))
+    return r
+
+
+def measure(func, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        result = func()
+        duration = time.time() - start
+
+        if best is None or duration < best:
+            best = duration
+
+    return best, result
+
+
+def main(args):
+    mod_count = int(args[0]) if len(args) > 0 else 300
+    version_count = int(args[1]) if len(args) > 1 else 10
+    dep_count = int(args[2]) if len(args) > 2 else 3
+    runs = int(args[3]) if len(args) > 3 else 5
+
+    r = generate(mod_count, version_count, dep_count)
+    roots = r.query('mod0').packages
+
+    legacy, legacy_res = measure(lambda: legacy_process_pkg_selection(roots), runs)
+    new, new_res = measure(lambda: r.process_pkg_selection(roots), runs)
+
+    print('%d mods, %d versions each, %d dependencies per package' % (mod_count, version_count, dep_count))
+    print('legacy:   %.2f ms (%d packages)' % (legacy * 1000, len(legacy_res)))
+    print('resolver: %.2f ms (%d packages)' % (new * 1000, len(new_res)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])